@@ -3,7 +3,9 @@ from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 import os
+from uuid import uuid4
 from dotenv import load_dotenv
+from app.services.pool_stats import InstrumentedAsyncPool
 
 # Загрузка переменных окружения из .env
 dotenv_path = os.path.join(os.path.dirname(__file__), '..', 'app', '.env')
@@ -16,8 +18,39 @@ if not DATABASE_URL:
 # Строка подключения для asyncpg
 DATABASE_URL = DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://", 1)
 
+# Настройки пула соединений
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 20))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 10))  # Сколько секунд ждать свободное соединение
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))  # Пересоздавать соединения старше N секунд
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", 100))  # Кэш prepared statements asyncpg
+# За PgBouncer в режиме transaction prepared statements не переживают смену соединения
+DB_PGBOUNCER = os.getenv("DB_PGBOUNCER", "0") == "1"
+DB_ECHO = os.getenv("DB_ECHO", "0") == "1"  # Печать всех SQL-запросов — только для отладки
+
+statement_cache_size = 0 if DB_PGBOUNCER else DB_STATEMENT_CACHE_SIZE
+connect_args = {
+    "statement_cache_size": statement_cache_size,  # Кэш самого asyncpg
+    "prepared_statement_cache_size": statement_cache_size,  # Кэш диалекта SQLAlchemy
+}
+if DB_PGBOUNCER:
+    # Уникальные имена, чтобы не пересечься с чужими prepared statements на общем серверном соединении
+    connect_args["prepared_statement_name_func"] = lambda: f"__asyncpg_{uuid4()}__"
+
 # Создаем асинхронный движок SQLAlchemy
-engine = create_async_engine(DATABASE_URL, echo=True, future=True)
+engine = create_async_engine(
+    DATABASE_URL,
+    echo=DB_ECHO,
+    future=True,
+    poolclass=InstrumentedAsyncPool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=DB_POOL_PRE_PING,
+    connect_args=connect_args,
+)
 
 # Создаем асинхронный sessionmaker для SQLAlchemy
 AsyncSessionLocal = sessionmaker(
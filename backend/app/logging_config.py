@@ -0,0 +1,112 @@
+import atexit
+import itertools
+import logging
+import logging.handlers
+import os
+import queue
+
+# Общий уровень и уровни отдельных модулей: "sqlalchemy.engine=WARNING,app.services.signals=DEBUG"
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_LEVELS = os.getenv("LOG_LEVELS", "sqlalchemy.engine=WARNING,httpx=WARNING")
+
+# Файл логов с ротацией по размеру (size) или по времени (midnight, H, ...)
+LOG_FILE = os.getenv("LOG_FILE", os.path.join(os.path.dirname(__file__), "logs_signals.txt"))
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN", "size")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 50 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", 5))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+
+# Из сообщений по отдельным строкам (extra={"sampled": True}) пишем каждое N-е
+LOG_SAMPLE_EVERY = int(os.getenv("LOG_SAMPLE_EVERY", 100))
+
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+# Отметка для сообщений, которые пишутся на каждую строку (инвестицию, баланс, ...)
+SAMPLED = {"sampled": True}
+
+_listener = None
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает каждое N-е сообщение с отметкой sampled; предупреждения и ошибки — всегда"""
+
+    def __init__(self, every: int = LOG_SAMPLE_EVERY):
+        super().__init__()
+        self.every = max(every, 1)
+        self._counter = itertools.count()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, "sampled", False) or record.levelno >= logging.WARNING:
+            return True
+        return next(self._counter) % self.every == 0
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Не блокирует event loop при переполненной очереди: лишние записи отбрасываются"""
+
+    dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DroppingQueueHandler.dropped += 1
+
+
+def _file_handler() -> logging.Handler:
+    if LOG_ROTATE_WHEN == "size":
+        return logging.handlers.RotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+        )
+    return logging.handlers.TimedRotatingFileHandler(
+        LOG_FILE, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+    )
+
+
+def _parse_levels(spec: str) -> dict:
+    levels = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, level = item.partition("=")
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup_logging():
+    """
+    Настраивает логирование один раз на процесс.
+    Обработчики в потоках запросов только кладут запись в очередь; форматирование,
+    запись в файл с ротацией и вывод в консоль выполняет фоновый поток QueueListener.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [_file_handler(), logging.StreamHandler()]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter())
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(LOG_LEVEL.upper())
+
+    for name, level in _parse_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Дописывает остаток очереди и останавливает фоновый поток"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -1,13 +1,35 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
 import asyncio
+import time
+from app.logging_config import setup_logging, stop_logging
+
+# Настраиваем логирование до импорта остальных модулей приложения
+setup_logging()
+
 import nest_asyncio
-from app.database import get_db  # Импортируем функцию для получения сессии
-from app.services.signals import process_signals, create_static_signals  # Импортируем функции для обработки сигналов и создания статичных сигналов
-from app.routers import users, balances, signals_routes, general_routes  # Подключаем новые роутеры
-from app.telegram_bot import main as start_telegram_bot
+from app.database import get_db, engine  # Импортируем функцию для получения сессии
+from app.services.signals import process_signals, create_static_signals, current_moscow_time  # Импортируем функции для обработки сигналов и создания статичных сигналов
+from app.services.signal_scheduler import settlement_scheduler
+from app.statistics_services.ledger_writer import ledger_writer
+from app.services.schema import ensure_schema
+from app.services.referrals import backfill_referral_closure
+from app.services.token_reaper import token_reaper
+from app.services.balance_cache import balance_cache
+from app.services.http_client import http_clients
+from app.services.payments import payment_consumer
+from app.services.metrics import (
+    HTTP_REQUEST_DURATION, HTTP_DB_DURATION, HTTP_DB_QUERIES, QueryStats, current_query_stats,
+    instrument_engine, registry,
+)
+from app.services.query_budget import QUERY_BUDGET_STRICT, find_violations, route_budget, server_timing
+from app.routers import users, balances, signals_routes, general_routes, exports, telegram_webhook, payments  # Подключаем новые роутеры
+from app.telegram_bot import main as start_telegram_bot, stop as stop_telegram_bot
 from fastapi.middleware.cors import CORSMiddleware
 import logging
 
+logger = logging.getLogger(__name__)
+
 # Применяем nest_asyncio для разрешения работы с текущим event loop
 nest_asyncio.apply()
 
@@ -26,44 +48,108 @@ app.add_middleware(
     allow_credentials=True,  # Разрешить передачу cookies
     allow_methods=["*"],  # Разрешённые методы (GET, POST и т.д.)
     allow_headers=["*"],  # Разрешённые заголовки
+    expose_headers=["X-Next-Cursor", "Server-Timing"],  # Курсор следующей страницы и время ответа доступны фронту
 )
 
+# Учет SQL-запросов для метрик
+instrument_engine(engine)
+
+@app.middleware("http")
+async def metrics_middleware(request: Request, call_next):
+    """
+    Время ответа, количество и время запросов к БД по шаблону маршрута.
+    Проверяет бюджет SQL-запросов маршрута и отдает заголовок Server-Timing.
+    """
+    stats = QueryStats()
+    token = current_query_stats.set(stats)
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        current_query_stats.reset(token)
+        elapsed = time.perf_counter() - started
+        # Шаблон маршрута (/balance/{telegram_id}), а не сырой путь — иначе метки растут без предела
+        route = request.scope.get("route")
+        route_path = getattr(route, "path", "unmatched")
+        HTTP_REQUEST_DURATION.observe(elapsed, request.method, route_path, status)
+        HTTP_DB_QUERIES.observe(stats.count, route_path)
+        HTTP_DB_DURATION.observe(stats.duration, route_path)
+
+    violations = find_violations(route_path, route_budget(route), stats) if route is not None else []
+    if violations:
+        for violation in violations:
+            logger.warning("Бюджет запросов: %s", violation)
+        if QUERY_BUDGET_STRICT:
+            response = JSONResponse(status_code=500, content={"detail": "Query budget exceeded", "violations": violations})
+
+    response.headers["Server-Timing"] = server_timing(stats, elapsed)
+    return response
+
 # Подключаем маршруты
 app.include_router(users.router)
 app.include_router(balances.router)
 app.include_router(signals_routes.signalis_router)
 app.include_router(general_routes.router)
+app.include_router(exports.export_router)
+app.include_router(telegram_webhook.telegram_router)
+app.include_router(payments.payments_router)
 
 @app.on_event("startup")
 async def startup_event():
     """Запуск Telegram бота, создание статичных сигналов и фоновая задача для обработки сигналов."""
     try:
+        # Запускаем групповую запись журнала транзакций
+        await ledger_writer.start()
+
+        # Создаем недостающие таблицы и заполняем таблицу замыкания рефералов
+        await ensure_schema()
+        async with get_db() as db:
+            await backfill_referral_closure(db)
+
         # Создаем статичные сигналы
         async with get_db() as db:
             await create_static_signals(db)
 
+        # Запускаем фоновую очистку просроченных auth_tokens
+        token_reaper.start()
+
+        # Запускаем обработку очереди уведомлений NOWPayments
+        payment_consumer.start()
+
+        # Подписываем кэш балансов на изменения из других воркеров (BALANCE_CACHE_NOTIFY=1)
+        await balance_cache.start_listener(engine)
+
         # Запускаем Telegram бота
         asyncio.create_task(start_telegram_bot())
         
-        # Запускаем фоновую задачу для обработки сигналов каждые 60 секунд
-        asyncio.create_task(process_signals_task())
+        # Запускаем планировщик расчета сигналов по дедлайнам expires_at
+        await settlement_scheduler.seed()
+        asyncio.create_task(settlement_scheduler.run(process_signals, current_moscow_time))
         
     except Exception as e:
         logging.error(f"Ошибка при запуске фоновых задач: {e}")
         raise HTTPException(status_code=500, detail="Ошибка при запуске фоновых задач")
 
-async def process_signals_task():
-    """Обработка сигналов каждые 60 секунд."""
-    while True:
-        try:
-            async with get_db() as db:
-                await process_signals(db)
-            await asyncio.sleep(60)  # Подождать 1 минуту перед следующим запуском
-        except Exception as e:
-            logging.error(f"Ошибка при обработке сигналов: {e}")
-            await asyncio.sleep(60)  # Даже если ошибка, ждем 60 секунд
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Сбрасываем остаток журнала транзакций перед остановкой."""
+    await stop_telegram_bot()
+    await token_reaper.stop()
+    await payment_consumer.stop()
+    await balance_cache.stop_listener()
+    await ledger_writer.stop()
+    # Закрываем keep-alive соединения к внешним сервисам
+    await http_clients.close()
+    stop_logging()
 
 @app.get("/")
 def read_root():
     """Проверка работы сервера"""
     return {"message": "FastAPI is running!"}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """Метрики процесса в текстовом формате Prometheus"""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, Float, ForeignKey, String, Boolean, TIMESTAMP, BigInteger, DateTime
+from sqlalchemy import Column, Integer, Float, ForeignKey, String, Boolean, TIMESTAMP, BigInteger, DateTime, Index, Text
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from app.database import Base
@@ -14,7 +15,7 @@ class AuthTokens(Base):
     id = Column(Integer, primary_key=True, index=True)
     token = Column(String, unique=True, index=True, nullable=False)
     user_id = Column(BigInteger, ForeignKey('users.telegram_id', ondelete='CASCADE'), nullable=False)  # Обновили на telegram_id
-    expires_at = Column(DateTime(timezone=True), nullable=False)
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)  # Индекс для очистки просроченных
     created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
 
     # Связь с пользователем через telegram_id
@@ -57,6 +58,7 @@ class Balance(Base):
     trade_balance = Column(Float, default=0.0)  # Торговый баланс
     frozen_balance = Column(Float, default=0.0)  # Замороженные средства
     earned_balance = Column(Float, default=0.0)  # ✅ Новый столбец для хранения чистой прибыли
+    version = Column(BigInteger, nullable=False, default=0, server_default="0")  # Растет при каждом изменении
     user = relationship("User", back_populates="balance")
 
 
@@ -79,6 +81,20 @@ class Referrals(Base):
     referrer = relationship("User", foreign_keys=[referrer_id], back_populates="referred_by")
 
 
+class ReferralClosure(Base):
+    """Таблица замыкания реферального дерева: все пары (предок, потомок) по telegram_id"""
+    __tablename__ = 'referral_closure'
+
+    ancestor_id = Column(BigInteger, primary_key=True)
+    descendant_id = Column(BigInteger, primary_key=True)
+    depth = Column(Integer, nullable=False)  # 0 — сам пользователь, 1 — прямой реферер и т.д.
+
+    __table_args__ = (
+        Index('ix_referral_closure_descendant_depth', 'descendant_id', 'depth'),
+        Index('ix_referral_closure_ancestor_depth', 'ancestor_id', 'depth'),
+    )
+
+
 class Signal(Base):
     __tablename__ = 'signals'
 
@@ -104,6 +120,9 @@ class SignalInvestment(Base):
     signal = relationship("Signal", back_populates="investments")
     user = relationship("User", back_populates="investments")
 
+    # Индекс под постраничную выборку инвестиций пользователя
+    __table_args__ = (Index('ix_signal_investments_user_created', 'user_id', 'created_at', 'id'),)
+
 
 class Transaction(Base):
     __tablename__ = 'transactions'
@@ -115,6 +134,8 @@ class Transaction(Base):
     created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())  # ✅ Добавлено timezone=True
     user = relationship("User", back_populates="transactions")
 
+    __table_args__ = (Index('ix_transactions_user_created', 'user_id', 'created_at', 'id'),)
+
 
 class Profit(Base):
     __tablename__ = 'profits'
@@ -125,3 +146,42 @@ class Profit(Base):
     amount = Column(Float, nullable=False)
     created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())  # ✅ Добавлено timezone=True
     user = relationship("User", back_populates="profits")
+
+    __table_args__ = (Index('ix_profits_user_created', 'user_id', 'created_at', 'id'),)
+
+
+class Payment(Base):
+    """Платеж NOWPayments: один на внешний payment_id, зачисляется не более одного раза"""
+    __tablename__ = 'payments'
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), nullable=False, index=True)
+    order_id = Column(String(64), unique=True, nullable=False)
+    external_payment_id = Column(String(64), unique=True, nullable=False)  # payment_id провайдера
+    amount = Column(Float, nullable=False)  # Сумма зачисления (price_amount)
+    status = Column(String(32), nullable=False, default="waiting")  # Последний payment_status из IPN
+    credited_at = Column(TIMESTAMP(timezone=True), nullable=True)  # Заполняется в транзакции зачисления
+    created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
+    updated_at = Column(TIMESTAMP(timezone=True), server_default=func.now(), onupdate=func.now())
+
+
+class PaymentEvent(Base):
+    """Очередь входящих IPN-уведомлений: принимаются сразу, обрабатываются фоновым потребителем"""
+    __tablename__ = 'payment_events'
+
+    id = Column(BigInteger, primary_key=True)
+    event_key = Column(String(128), unique=True, nullable=False)  # payment_id:payment_status — повторы провайдера
+    external_payment_id = Column(String(64), nullable=False)
+    payment_status = Column(String(32), nullable=False)
+    payload = Column(JSONB, nullable=False)
+    status = Column(String(16), nullable=False, default="pending", server_default="pending")  # pending, done, failed
+    attempts = Column(Integer, nullable=False, default=0, server_default="0")
+    last_error = Column(Text, nullable=True)
+    available_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=func.now())  # Не раньше — при повторе
+    created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
+    processed_at = Column(TIMESTAMP(timezone=True), nullable=True)
+
+    # Частичный индекс под выборку очереди: обработанные события в него не попадают
+    __table_args__ = (
+        Index('ix_payment_events_pending', 'available_at', 'id', postgresql_where=(status == 'pending')),
+    )
@@ -1,20 +1,21 @@
 import logging
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
 from pydantic import BaseModel
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from sqlalchemy.orm import joinedload
 from app.services.get_db import get_db  # Импортируем get_db
 from app.models.models import Referrals, User, Balance 
-from app.services.balances import (
-    has_sufficient_trading_balance,
-    update_balance, 
-    has_sufficient_balance,
-    get_balance,
-    update_referral_by_url,
-    update_trading_balance,
-    freeze_balance,  # 🔹 Функция заморозки
-    unfreeze_balance  # 🔹 Функция разблокировки
+from app.services.ledger_operation import LedgerOperation, InsufficientFundsError
+from app.services.balance_cache import balance_cache, get_user_snapshot
+from app.services.query_budget import query_budget
+from app.services.referrals import (
+    REFERRAL_TREE_MAX_DEPTH,
+    fetch_referral_rows,
+    build_referral_tree,
+    build_flat_referral_list,
+    referral_to_dict,
+    get_ancestors,
+    get_downline_summary,
 )
 
 router = APIRouter()
@@ -26,30 +27,28 @@ class AmountRequest(BaseModel):
 class ReferralRequest(BaseModel):
     telegram_id: int
     referral_link: str
-# Отключаем логирование SQL-запросов (уровень logging.WARNING)
-logging.getLogger('sqlalchemy.engine').setLevel(logging.INFO)
 
 ### 🔹 **Получение баланса с учетом замороженных средств**
 @router.get("/balance/{telegram_id}")
+@query_budget(2)
 async def get_balance_by_telegram_id(telegram_id: int, db: AsyncSession = Depends(get_db)):
-    result = await db.execute(
-        select(User).options(joinedload(User.balance)).filter(User.telegram_id == telegram_id)
-    )
-    user = result.scalars().first()
+    # Снимок из кэша балансов; при промахе — один запрос User + Balance
+    snapshot = await get_user_snapshot(db, telegram_id)
 
-    if user is None:
+    if snapshot is None:
         raise HTTPException(status_code=404, detail="User not found")
 
     return {
-        "id": user.id,
-        "telegram_id": user.telegram_id,
-        "balance": user.balance.balance if user.balance else 0.0,
-        "trade_balance": user.balance.trade_balance if user.balance else 0.0,
-        "frozen_balance": user.balance.frozen_balance if user.balance else 0.0  # 🔹 Добавили
+        "id": snapshot["id"],
+        "telegram_id": snapshot["telegram_id"],
+        "balance": snapshot["balance"],
+        "trade_balance": snapshot["trade_balance"],
+        "frozen_balance": snapshot["frozen_balance"]  # 🔹 Добавили
     }
 
 ### 🔹 **Перевод на торговый баланс (с заморозкой)**
 @router.post("/transfer_to_trading/{telegram_id}")
+@query_budget(4)
 async def transfer_to_trading(telegram_id: int, request: AmountRequest, db: AsyncSession = Depends(get_db)):
     amount = request.amount
 
@@ -63,14 +62,26 @@ async def transfer_to_trading(telegram_id: int, request: AmountRequest, db: Asyn
     if user is None:
         raise HTTPException(status_code=404, detail="User not found")
 
-    if await has_sufficient_balance(db, user.id, amount):
-        if await update_balance(db, user.id, -amount):  # Уменьшаем основной баланс
-            if await update_trading_balance(db, user.id, amount):  # Добавляем в торговый баланс
-                await freeze_balance(db, user.id, amount)  # 🔹 Замораживаем средства
-                logging.info(f"Transferred {amount} to trading balance for user_id {user.id}, funds frozen")
-                return {"message": "Transfer successful, funds frozen"}
+    # Та же последовательность, что и раньше (списание -> торговый баланс -> заморозка), но одной транзакцией.
+    # С основного баланса уходит 2 * amount (amount на торговый баланс и amount в заморозку), поэтому
+    # операция проходит только при balance >= 2 * amount. Раньше при amount <= balance < 2 * amount
+    # заморозка молча пропускалась, а ответ все равно сообщал «funds frozen»; теперь это 400 без изменений.
+    operation = (
+        LedgerOperation()
+        .change(user.id, balance=-amount, trade_balance=amount)
+        .entry(user.id, -amount, "balance_update")
+        .entry(user.id, amount, "trade_balance_update")
+        .change(user.id, balance=-amount, frozen_balance=amount)
+        .entry(user.id, amount, "freeze")
+    )
+
+    try:
+        await operation.execute(db)
+    except InsufficientFundsError:
+        raise HTTPException(status_code=400, detail="Insufficient balance")
 
-    raise HTTPException(status_code=400, detail="Insufficient balance")
+    logging.info(f"Transferred {amount} to trading balance for user_id {user.id}, funds frozen")
+    return {"message": "Transfer successful, funds frozen"}
 
 @router.get("/unfreeze_balance/{telegram_id}")
 async def unfreeze(telegram_id: int, db: AsyncSession = Depends(get_db)):
@@ -92,8 +103,10 @@ async def unfreeze(telegram_id: int, db: AsyncSession = Depends(get_db)):
     amount_to_unfreeze = balance.frozen_balance
     balance.trade_balance += amount_to_unfreeze
     balance.frozen_balance = 0
+    balance.version += 1
 
     await db.commit()
+    balance_cache.invalidate(user.id)
 
     logging.info(f"Unfroze {amount_to_unfreeze} for user {user.id}")
 
@@ -104,6 +117,7 @@ async def unfreeze(telegram_id: int, db: AsyncSession = Depends(get_db)):
     }
 ### 🔹 **Пополнение баланса**
 @router.post("/deposit/{telegram_id}")
+@query_budget(4)
 async def deposit(telegram_id: int, request: AmountRequest, db: AsyncSession = Depends(get_db)):
     amount = request.amount
     
@@ -118,51 +132,32 @@ async def deposit(telegram_id: int, request: AmountRequest, db: AsyncSession = D
         logging.warning(f"User with telegram_id {telegram_id} not found")
         raise HTTPException(status_code=404, detail="User not found")
 
-    balance = await get_balance(db, user.id)
-    if balance is None:
+    operation = LedgerOperation().change(user.id, balance=amount).entry(user.id, amount, "balance_update")
+
+    try:
+        balances = await operation.execute(db)
+    except InsufficientFundsError:
         logging.warning(f"Balance not found for user {user.id}")
         raise HTTPException(status_code=404, detail="Balance not found")
 
-    success = await update_balance(db, user.id, amount)
-
-    if success:
-        # ✅ Запрашиваем обновленный баланс из базы
-        updated_balance = await get_balance(db, user.id)
-
-        logging.info(f"Deposited {amount} to user_id {user.id}, new_balance: {updated_balance.balance}")
-        return {"message": "Deposit successful", "new_balance": updated_balance.balance}
-
-
-    raise HTTPException(status_code=500, detail="Failed to update balance")
+    new_balance = balances[user.id].balance
+    logging.info(f"Deposited {amount} to user_id {user.id}, new_balance: {new_balance}")
+    return {"message": "Deposit successful", "new_balance": new_balance}
 
 
 @router.get("/referral_tree/{telegram_id}")
-async def get_referral_tree(telegram_id: str, db: AsyncSession = Depends(get_db)):
-    async def fetch_referrals(telegram_id):
-        """Рекурсивно получаем всех приглашённых пользователей по их Telegram ID"""
-        logging.info(f"Fetching referrals for telegram_id: {telegram_id}")  
-
-        result = await db.execute(
-            select(Referrals).filter(Referrals.referred_by == telegram_id)  # Ищем рефералов по telegram_id
-        )
-        referrals = result.scalars().all()
-
-        logging.info(f"Found {len(referrals)} referrals for telegram_id: {telegram_id}")  
-
-        return [
-            {
-                "id": r.id,
-                "user_id": r.user_id,
-                "telegram_id": r.telegram_id,
-                "referral_link": r.referral_link,
-                "invited_count": r.invited_count,
-                "referrer_id": r.referrer_id,
-                "referred_by": r.referred_by,
-                "invited_users": await fetch_referrals(r.telegram_id)  # Рекурсивно получаем рефералов
-            }
-            for r in referrals
-        ]
-
+async def get_referral_tree(
+    telegram_id: str,
+    max_depth: int = Query(10, ge=1, le=REFERRAL_TREE_MAX_DEPTH),
+    max_fanout: int = Query(1000, ge=1, le=10000),
+    flat: bool = False,
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Дерево приглашённых пользователей, выбранное одним рекурсивным запросом.
+    max_depth — глубина дерева, max_fanout — максимум приглашённых на один узел,
+    flat=true — плоский список с глубиной вместо вложенной структуры.
+    """
     try:
         logging.info(f"Received request to fetch referral tree for telegram_id: {telegram_id}")  
 
@@ -179,29 +174,30 @@ async def get_referral_tree(telegram_id: str, db: AsyncSession = Depends(get_db)
             logging.warning(f"User not found for telegram_id: {telegram_id}")  
             raise HTTPException(status_code=404, detail="User not found")
 
-        logging.info(f"Found user: {user.user_id} with telegram_id: {telegram_id}")  
+        rows = await fetch_referral_rows(db, user.telegram_id, max_depth, max_fanout)
 
-        # Получаем всех приглашённых пользователей (рефералов)
-        referral_tree = {
-            "id": user.id,
-            "user_id": user.user_id,
-            "telegram_id": user.telegram_id,
-            "referral_link": user.referral_link,
-            "invited_count": user.invited_count,
-            "referrer_id": user.referrer_id,
-            "referred_by": user.referred_by,
-            "invited_users": await fetch_referrals(user.telegram_id)  # Исправленный вызов
-        }
+        logging.info(f"Referral tree successfully retrieved for telegram_id: {telegram_id}, nodes: {len(rows)}")  
 
-        logging.info(f"Referral tree successfully retrieved for telegram_id: {telegram_id}")  
+        if flat:
+            return {**referral_to_dict(user), "invited_users": build_flat_referral_list(rows)}
+        return build_referral_tree(user, rows)
 
-        return referral_tree
+    except HTTPException:
+        raise
 
     except Exception as e:
         logging.error(f"Error retrieving referral tree for telegram_id: {telegram_id}: {e}", exc_info=True)  
         raise HTTPException(status_code=500, detail="An error occurred while retrieving referral tree.")
 
+@router.get("/referral_stats/{telegram_id}")
+async def get_referral_stats(telegram_id: int, db: AsyncSession = Depends(get_db)):
+    """Размер нижней линии, заработок поддерева и цепочка рефереров — по таблице замыкания"""
+    summary = await get_downline_summary(db, telegram_id)
+    ancestors = await get_ancestors(db, telegram_id)
+    return {"telegram_id": telegram_id, **summary, "ancestors": ancestors}
+
 @router.post("/transfer_to_main/{telegram_id}")
+@query_budget(4)
 async def transfer_to_main(telegram_id: int, request: AmountRequest, db: AsyncSession = Depends(get_db)):
     amount = request.amount
 
@@ -215,33 +211,27 @@ async def transfer_to_main(telegram_id: int, request: AmountRequest, db: AsyncSe
     if user is None:
         raise HTTPException(status_code=404, detail="User not found")
 
-    # Проверяем, хватает ли средств на торговом балансе
-    if await has_sufficient_trading_balance(db, user.id, amount):
-        # Уменьшаем торговый баланс
-        if await update_trading_balance(db, user.id, -amount):
-            # Добавляем на основной баланс
-            if await update_balance(db, user.id, amount):
-                logging.info(f"Transferred {amount} from trading to main balance for user_id {user.id}")
-                
-                # Получаем актуальные данные баланса
-                result = await db.execute(
-                    select(User).options(joinedload(User.balance)).filter(User.telegram_id == telegram_id)
-                )
-                user = result.scalars().first()
-
-                if user is None:
-                    raise HTTPException(status_code=404, detail="User not found")
-
-                # Возвращаем актуальные значения балансов
-                return {
-                    "id": user.id,
-                    "telegram_id": user.telegram_id,
-                    "balance": user.balance.balance if user.balance else 0.0,
-                    "trade_balance": user.balance.trade_balance if user.balance else 0.0,
-                    "frozen_balance": user.balance.frozen_balance if user.balance else 0.0  # 🔹 Замороженные средства
-                }
-
-    raise HTTPException(status_code=400, detail="Insufficient trading balance")
-
-
-     
\ No newline at end of file
+    # Списание с торгового баланса защищено условием в UPDATE, отдельная проверка не нужна
+    operation = (
+        LedgerOperation()
+        .change(user.id, trade_balance=-amount, balance=amount)
+        .entry(user.id, -amount, "trade_balance_update")
+        .entry(user.id, amount, "balance_update")
+    )
+
+    try:
+        balances = await operation.execute(db)
+    except InsufficientFundsError:
+        raise HTTPException(status_code=400, detail="Insufficient trading balance")
+
+    logging.info(f"Transferred {amount} from trading to main balance for user_id {user.id}")
+
+    # Возвращаем актуальные значения балансов из RETURNING
+    balance = balances[user.id]
+    return {
+        "id": user.id,
+        "telegram_id": user.telegram_id,
+        "balance": balance.balance,
+        "trade_balance": balance.trade_balance,
+        "frozen_balance": balance.frozen_balance  # 🔹 Замороженные средства
+    }
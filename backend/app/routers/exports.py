@@ -0,0 +1,90 @@
+import csv
+import hmac
+import io
+import json
+import logging
+import os
+from typing import Optional
+from fastapi import APIRouter, Header, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+from app.database import engine
+from app.models.models import User, Transaction, SignalInvestment, Signal
+
+# Логирование
+logger = logging.getLogger(__name__)
+
+# Сколько строк читаем с серверного курсора и отдаем клиенту за раз
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", 1000))
+# Выгрузки только для администратора: токен в заголовке X-Admin-Token (если ADMIN_TOKEN не задан — закрыты)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+export_router = APIRouter(prefix="/export", tags=["Export"])
+
+# Что выгружаем: запрос по колонкам таблицы (без ORM-объектов) в порядке первичного ключа
+EXPORTS = {
+    "users": lambda: select(*User.__table__.c).order_by(User.id),
+    "transactions": lambda: select(*Transaction.__table__.c).order_by(Transaction.id),
+    "investments": lambda: select(*SignalInvestment.__table__.c).order_by(SignalInvestment.id),
+    "signals": lambda: select(*Signal.__table__.c).filter(Signal.is_successful.isnot(None)).order_by(Signal.id),
+}
+
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+def _format_ndjson(columns, rows) -> str:
+    return "".join(json.dumps(dict(zip(columns, row)), default=str, ensure_ascii=False) + "\n" for row in rows)
+
+
+def _format_csv(rows) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue()
+
+
+async def _stream_export(entity: str, fmt: str):
+    """
+    Читает строки серверным курсором порциями по EXPORT_CHUNK_SIZE и сразу отдает их клиенту.
+    Соединение берется из пула только на время выгрузки и возвращается сразу после нее.
+    """
+    query = EXPORTS[entity]().execution_options(yield_per=EXPORT_CHUNK_SIZE)
+    exported = 0
+
+    async with engine.connect() as conn:
+        result = await conn.stream(query)
+        columns = list(result.keys())
+
+        if fmt == "csv":
+            yield _format_csv([columns])
+
+        async for rows in result.partitions(EXPORT_CHUNK_SIZE):
+            exported += len(rows)
+            yield _format_csv(rows) if fmt == "csv" else _format_ndjson(columns, rows)
+
+    logger.info(f"Выгрузка {entity} ({fmt}) завершена: {exported} строк")
+
+
+@export_router.get("/{entity}")
+async def export_entity(
+    entity: str,
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    x_admin_token: Optional[str] = Header(None),
+):
+    """
+    Потоковая выгрузка users, transactions, investments или signals (только рассчитанные)
+    в формате NDJSON или CSV. Память воркера не растет с размером таблицы.
+    """
+    if not ADMIN_TOKEN or not x_admin_token or not hmac.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    if entity not in EXPORTS:
+        raise HTTPException(status_code=404, detail=f"Unknown export: {entity}")
+
+    return StreamingResponse(
+        _stream_export(entity, format),
+        media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{entity}.{format}"'},
+    )
@@ -6,10 +6,15 @@ from app.models.models import AuthTokens, User
 from app.services.get_db import get_db
 from datetime import datetime, timezone
 from tzlocal import get_localzone
-from sqlalchemy.orm import subqueryload
 from app.database import get_db as main
+from app.statistics_services.ledger_writer import ledger_writer
+from app.services.telegram_service import is_signed_token, verify_signed_token
+from app.services.token_reaper import token_reaper
+from app.services.balance_cache import PROFILE_FIELDS, balance_cache, get_user_snapshot
+from app.services.pool_stats import pool_stats
+from app.services.http_client import http_clients
+from app.services.payments import payment_consumer
 # Настройка логирования
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/api", tags=["Auth"])  # Используем ОДИН роутер
@@ -18,33 +23,43 @@ router = APIRouter(prefix="/api", tags=["Auth"])  # Используем ОДИ
 async def auth_with_token(token: str, db: AsyncSession = Depends(get_db)):
     """Проверка токена и вход в систему"""
     
-    logger.info(f"Получаем токен: {token}")
-    
-    result = await db.execute(select(AuthTokens).filter(AuthTokens.token == token))
-    auth_token = result.scalars().first()
-
-    if auth_token:
-        logger.info(f"Найден токен: {auth_token.token}, Время истечения: {auth_token.expires_at}")
+    logger.debug("Проверяем токен авторизации")
+
+    if is_signed_token(token):
+        # Подписанный токен проверяется в процессе, без запроса к auth_tokens
+        claims = verify_signed_token(token)
+        if claims is None:
+            logger.warning("Подписанный токен недействителен, просрочен или уже использован")
+            raise HTTPException(status_code=403, detail="Недействительный или просроченный токен")
+        telegram_id, expires_at = claims
     else:
-        logger.warning(f"Токен {token} не найден в базе данных")
-        raise HTTPException(status_code=403, detail="Недействительный или просроченный токен")
+        result = await db.execute(select(AuthTokens).filter(AuthTokens.token == token))
+        auth_token = result.scalars().first()
+
+        if auth_token:
+            logger.debug("Найден токен пользователя %s, время истечения: %s", auth_token.user_id, auth_token.expires_at)
+        else:
+            logger.warning("Токен не найден в базе данных")
+            raise HTTPException(status_code=403, detail="Недействительный или просроченный токен")
+
+        if auth_token.expires_at < datetime.now(timezone.utc):
+            logger.warning("Токен пользователя %s просрочен.", auth_token.user_id)
+            raise HTTPException(status_code=403, detail="Недействительный или просроченный токен")
 
-    if auth_token.expires_at < datetime.now(timezone.utc):
-        logger.warning(f"Токен {token} просрочен.")
-        raise HTTPException(status_code=403, detail="Недействительный или просроченный токен")
+        telegram_id, expires_at = auth_token.user_id, auth_token.expires_at
 
-    logger.info(f"Получаем пользователя с ID: {auth_token.user_id}")
-    result = await db.execute(select(User).filter(User.telegram_id == auth_token.user_id))
+    logger.info(f"Получаем пользователя с ID: {telegram_id}")
+    result = await db.execute(select(User).filter(User.telegram_id == telegram_id))
     user = result.scalars().first()
 
     if user:
         logger.info(f"Найден пользователь: {user.username}, Telegram ID: {user.telegram_id}")
     else:
-        logger.warning(f"Пользователь с ID {auth_token.user_id} не найден в базе данных")
+        logger.warning(f"Пользователь с ID {telegram_id} не найден в базе данных")
         raise HTTPException(status_code=404, detail="Пользователь не найден")
 
     local_tz = get_localzone()
-    expires_at_local = auth_token.expires_at.astimezone(local_tz)
+    expires_at_local = expires_at.astimezone(local_tz)
 
     logger.info(f"Время истечения токена в локальном часовом поясе: {expires_at_local}")
 
@@ -59,45 +74,18 @@ async def auth_with_token(token: str, db: AsyncSession = Depends(get_db)):
 
 # Настройка логгера
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
 
 # Функция получения пользователя по telegram_id
 @router.get("/user/{telegram_id}")
 async def get_user_by_telegram_id(telegram_id: int, db: AsyncSession = Depends(get_db)):
     try:
-        result = await db.execute(
-            select(User)
-            .options(
-                subqueryload(User.balance),
-                subqueryload(User.referred_by)
-            )
-            .filter(User.telegram_id == telegram_id)
-        )
-        user = result.scalars().first()
-
-        if not user:
+        snapshot = await get_user_snapshot(db, telegram_id)
+
+        if not snapshot:
             logger.warning(f"Пользователь с telegram_id {telegram_id} не найден.")
             raise HTTPException(status_code=404, detail="User not found")
 
-        return {
-            "id": user.id,
-            "telegram_id": user.telegram_id,
-            "username": user.username,
-            "first_name": user.first_name,
-            "last_name": user.last_name,
-            "language_code": user.language_code,
-            "is_bot": user.is_bot,
-            "photo_url": user.photo_url,
-            "created_at": user.created_at,
-            "updated_at": user.updated_at,
-            "balance": user.balance.balance if user.balance else 0.0,
-            "trade_balance": user.balance.trade_balance if user.balance else 0.0,
-            "referred_by": {
-                "id": user.referred_by.id if user.referred_by else None,
-                "telegram_id": user.referred_by.telegram_id if user.referred_by else None,
-                "username": user.referred_by.username if user.referred_by else None
-            } if user.referred_by else None
-        }
+        return {field: snapshot[field] for field in PROFILE_FIELDS}
 
     except HTTPException:
         raise  # Оставляем только исходное исключение 404
@@ -106,3 +94,38 @@ async def get_user_by_telegram_id(telegram_id: int, db: AsyncSession = Depends(g
         logger.error(f"Ошибка при получении пользователя {telegram_id}: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
+
+@router.get("/stats/ledger")
+async def get_ledger_stats():
+    """Глубина очереди и задержки групповой записи журнала транзакций"""
+    return ledger_writer.stats()
+
+
+@router.get("/stats/auth_tokens")
+async def get_auth_tokens_stats():
+    """Сколько токенов удалено и текущий размер таблицы auth_tokens"""
+    return token_reaper.stats()
+
+
+@router.get("/stats/balance_cache")
+async def get_balance_cache_stats():
+    """Размер и попадания кэша балансов"""
+    return balance_cache.stats()
+
+
+@router.get("/stats/pool")
+async def get_pool_stats():
+    """Занятые соединения, ожидание выдачи соединения и переполнения пула"""
+    return pool_stats.stats()
+
+
+@router.get("/stats/http")
+async def get_http_stats():
+    """Исходящие HTTP-клиенты: задержки, повторы и состояние предохранителя по каждому сервису"""
+    return http_clients.stats()
+
+
+@router.get("/stats/payments")
+async def get_payments_stats():
+    """Обработка очереди IPN-уведомлений: зачисления, повторы и ошибки"""
+    return payment_consumer.stats()
@@ -0,0 +1,38 @@
+import json
+import logging
+from fastapi import APIRouter, Depends, Header, HTTPException, Request
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.services.get_db import get_db
+from app.services.payments import enqueue_ipn_event, payment_consumer, verify_ipn_signature
+
+# Логирование
+logger = logging.getLogger(__name__)
+
+payments_router = APIRouter(prefix="/payments", tags=["Payments"])
+
+
+@payments_router.post("/ipn")
+async def nowpayments_ipn(
+    request: Request,
+    x_nowpayments_sig: str = Header(None),
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Принимает уведомление NOWPayments: проверяет подпись, ставит событие в очередь и сразу отвечает.
+    Зачисление выполняет фоновый потребитель, повторы уведомлений отбрасываются по ключу события.
+    """
+    try:
+        payload = json.loads(await request.body())
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+
+    if not isinstance(payload, dict) or not verify_ipn_signature(payload, x_nowpayments_sig):
+        logger.warning("Отклонено IPN-уведомление с неверной подписью")
+        raise HTTPException(status_code=403, detail="Invalid signature")
+
+    if "payment_id" not in payload or "payment_status" not in payload:
+        raise HTTPException(status_code=400, detail="payment_id and payment_status are required")
+
+    if await enqueue_ipn_event(db, payload):
+        payment_consumer.notify()
+    return {"ok": True}
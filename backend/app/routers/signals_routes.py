@@ -1,29 +1,18 @@
 import logging
-import os
 import random
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from sqlalchemy.sql import func
 from app.services.get_db import get_db  # Импортируем get_db
-from app.models.models import User, Balance, Signal, SignalInvestment
-from app.services.balances import freeze_balance, update_trading_balance
+from app.models.models import User, Signal, SignalInvestment
+from app.services.ledger_operation import LedgerOperation, InsufficientFundsError
+from app.services.pagination import PAGE_SIZE_MAX, keyset_page, page_limit, split_page
 from app.services.signals import create_signal  # Импортируем метод создания сигнала
-
-# Отключаем логирование SQL-запросов (уровень logging.WARNING)
-logging.getLogger('sqlalchemy.engine').setLevel(logging.WARNING)
-
-# Настройка логирования в файл logs_signals.txt (рядом с main)
-log_file_path = os.path.join(os.path.dirname(__file__), "../logs_signals.txt")
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler(log_file_path, encoding="utf-8"),
-        logging.StreamHandler()
-    ]
-)
+from app.services.signal_cache import active_signals_cache, etag_matches
+from app.services.query_budget import query_budget
 
 signalis_router = APIRouter(prefix="/signals", tags=["Signals"])
 
@@ -43,6 +32,7 @@ class RandomSignalRequest(BaseModel):
 
 ### 🔹 **Маршрут для входа в сигнал**
 @signalis_router.post("/join")
+@query_budget(6)
 async def join_signal(request: JoinSignalRequest, db: AsyncSession = Depends(get_db)):
     """ Пользователь входит в сигнал. Средства с trade_balance переносятся в frozen_balance. """
     telegram_id = request.telegram_id
@@ -60,30 +50,37 @@ async def join_signal(request: JoinSignalRequest, db: AsyncSession = Depends(get
             logging.warning(f"User {telegram_id} not found while trying to join signal {signal_id}")
             raise HTTPException(status_code=404, detail="User not found")
 
-        balance_result = await db.execute(select(Balance).filter(Balance.user_id == user.id))
-        balance = balance_result.scalars().first()
-        if not balance or balance.trade_balance < amount:
-            logging.warning(f"User {user.id} has insufficient balance for signal {signal_id}")
-            raise HTTPException(status_code=400, detail="Insufficient trading balance")
-
         signal_result = await db.execute(select(Signal).filter(Signal.id == signal_id, Signal.join_until > func.now()))
         signal = signal_result.scalars().first()
         if not signal:
             logging.warning(f"Signal {signal_id} is not available for user {user.id}")
             raise HTTPException(status_code=400, detail="Signal is not available for joining")
 
-        # Обновление баланса и заморозка средств
-        await update_trading_balance(db, user.id, -amount)
-        await freeze_balance(db, user.id, amount)
+        # Списание с торгового баланса, заморозка средств и инвестиция — одной транзакцией.
+        # Нужны и trade_balance >= amount, и balance >= amount (заморозка берется с основного баланса):
+        # раньше при нехватке основного баланса инвестиция создавалась без заморозки,
+        # и расчет сигнала потом размораживал средства других позиций
+        operation = (
+            LedgerOperation()
+            .change(user.id, trade_balance=-amount)
+            .entry(user.id, -amount, "trade_balance_update")
+            .change(user.id, balance=-amount, frozen_balance=amount)
+            .entry(user.id, amount, "freeze")
+            .add(SignalInvestment(signal_id=signal_id, user_id=user.id, amount=amount))
+        )
 
-        # Добавляем инвестицию в базу данных
-        investment = SignalInvestment(signal_id=signal_id, user_id=user.id, amount=amount)
-        db.add(investment)
-        await db.commit()
+        try:
+            await operation.execute(db)
+        except InsufficientFundsError:
+            logging.warning(f"User {user.id} has insufficient balance for signal {signal_id}")
+            raise HTTPException(status_code=400, detail="Insufficient trading balance")
 
-        logging.info(f"User {user.id} successfully joined signal {signal_id} with {amount} frozen funds.")
+        logging.info("User %s successfully joined signal %s with %s frozen funds.", user.id, signal_id, amount)
         return {"message": "Successfully joined the signal", "signal_id": signal_id, "amount": amount}
 
+    except HTTPException:
+        raise
+
     except Exception as e:
         logging.error(f"Error while user {telegram_id} joining signal {signal_id}: {str(e)}")
         raise HTTPException(status_code=500, detail="An error occurred while joining the signal.")
@@ -105,7 +102,8 @@ async def create_random_signal(request: RandomSignalRequest, db: AsyncSession =
     profit_percent = round(random.uniform(1.01, 1.20), 2)  # 1.01 - 1.20 (1-20% прибыли)
 
     try:
-        signal = await create_signal(db, name, join_time, active_time, burn_chance, profit_percent)
+        # В БД шанс сгорания хранится долей 0..1
+        signal = await create_signal(db, name, join_time, active_time, burn_chance / 100, profit_percent)
         logging.info(f"Random signal created: {signal.name} (ID: {signal.id}), join_until: {signal.join_until}, expires_at: {signal.expires_at}, burn_chance: {signal.burn_chance}, profit_percent: {signal.profit_percent}")
 
         return {
@@ -125,7 +123,7 @@ class CustomSignalRequest(BaseModel):
     name: str
     join_time: int
     active_time: int
-    burn_chance: float
+    burn_chance: float  # Шанс сгорания в процентах, 0-100
     profit_percent: float
 
 @signalis_router.post("/create_custom")
@@ -138,12 +136,13 @@ async def create_custom_signal(request: CustomSignalRequest, db: AsyncSession =
     profit_percent = request.profit_percent
 
     # Проверка валидности значений
-    if join_time <= 0 or active_time <= 0 or burn_chance < 0 or profit_percent < 1:
+    if join_time <= 0 or active_time <= 0 or not 0 <= burn_chance <= 100 or profit_percent < 1:
         logging.warning(f"Invalid parameters for {name}: join_time={join_time}, active_time={active_time}, burn_chance={burn_chance}, profit_percent={profit_percent}")
-        raise HTTPException(status_code=400, detail="Invalid parameters: join_time and active_time must be > 0, burn_chance >= 0, profit_percent >= 1")
+        raise HTTPException(status_code=400, detail="Invalid parameters: join_time and active_time must be > 0, burn_chance 0-100 (%), profit_percent >= 1")
 
     try:
-        signal = await create_signal(db, name, join_time, active_time, burn_chance, profit_percent)
+        # В БД шанс сгорания хранится долей 0..1
+        signal = await create_signal(db, name, join_time, active_time, burn_chance / 100, profit_percent)
         logging.info(f"Custom signal created: {signal.name} (ID: {signal.id}), join_until: {signal.join_until}, expires_at: {signal.expires_at}, burn_chance: {signal.burn_chance}, profit_percent: {signal.profit_percent}")
 
         return {
@@ -160,37 +159,32 @@ async def create_custom_signal(request: CustomSignalRequest, db: AsyncSession =
         raise HTTPException(status_code=500, detail="An error occurred while creating a custom signal.")
 
 @signalis_router.get("/active")
-async def get_active_signals(db: AsyncSession = Depends(get_db)):
-    """ Получает список всех активных сигналов, которые доступны для входа. """
+async def get_active_signals(request: Request, db: AsyncSession = Depends(get_db)):
+    """ Получает список всех активных сигналов, которые доступны для входа (из снимка в памяти). """
     try:
-        active_signals_result = await db.execute(
-            select(Signal).filter(Signal.join_until > func.now())
-        )
-        active_signals = active_signals_result.scalars().all()
+        payload, etag = await active_signals_cache.get(db)
 
-        if not active_signals:
-            return {"message": "No active signals available."}
+        # Клиент уже видел этот список — отвечаем 304 без тела
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers={"ETag": etag})
 
-        signals_data = [
-            {
-                "signal_id": signal.id,
-                "name": signal.name,
-                "join_until": signal.join_until,
-                "expires_at": signal.expires_at
-            }
-            for signal in active_signals
-        ]
-        
-        return {"active_signals": signals_data}
+        return JSONResponse(payload, headers={"ETag": etag, "Cache-Control": "no-cache"})
     except Exception as e:
         logging.error(f"Error retrieving active signals: {str(e)}")
         raise HTTPException(status_code=500, detail="An error occurred while retrieving active signals.")
     
 @signalis_router.get("/investments/{telegram_id}")
-async def get_user_investments(telegram_id: int, db: AsyncSession = Depends(get_db)):
+async def get_user_investments(
+    telegram_id: int,
+    cursor: str = None,
+    limit: int = Query(None, ge=1, le=PAGE_SIZE_MAX),
+    db: AsyncSession = Depends(get_db),
+):
     """
-    Ищет user_id по telegram_id, затем получает все инвестиции пользователя.
+    Ищет user_id по telegram_id, затем получает инвестиции пользователя.
+    С limit или cursor — постранично (от новых к старым), курсор следующей страницы возвращается в next_cursor.
     """
+    limit = page_limit(cursor, limit)
     # 1. Ищем user_id по telegram_id
     user_result = await db.execute(select(User.id).filter(User.telegram_id == telegram_id))
     user = user_result.scalar()
@@ -198,11 +192,17 @@ async def get_user_investments(telegram_id: int, db: AsyncSession = Depends(get_
     if not user:
         return {"message": "Пользователь не найден"}
 
-    # 2. Ищем все инвестиции пользователя
-    investments_result = await db.execute(select(SignalInvestment).filter(SignalInvestment.user_id == user))
-    investments = investments_result.scalars().all()
-
-    if not investments:
+    # 2. Ищем страницу инвестиций пользователя
+    investments_result = await db.execute(keyset_page(
+        select(SignalInvestment).filter(SignalInvestment.user_id == user),
+        [SignalInvestment.created_at, SignalInvestment.id],
+        cursor,
+        limit,
+    ))
+    investments, next_cursor = split_page(investments_result.scalars().all(), limit, ["created_at", "id"])
+
+    # Пустая следующая страница — это не «нет инвестиций»
+    if not investments and not cursor:
         return {"message": "У пользователя нет инвестиций"}
 
     # 3. Формируем ответ
@@ -217,5 +217,6 @@ async def get_user_investments(telegram_id: int, db: AsyncSession = Depends(get_
                 "created_at": inv.created_at
             }
             for inv in investments
-        ]
+        ],
+        "next_cursor": next_cursor
     }
\ No newline at end of file
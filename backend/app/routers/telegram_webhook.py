@@ -0,0 +1,43 @@
+import hmac
+import logging
+from fastapi import APIRouter, Header, HTTPException, Request
+from telegram import Update
+from app import telegram_bot
+from app.services.telegram_dispatcher import update_dispatcher
+
+# Логирование
+logger = logging.getLogger(__name__)
+
+telegram_router = APIRouter(prefix="/telegram", tags=["Telegram"])
+
+
+@telegram_router.post("/webhook")
+async def telegram_webhook(
+    request: Request,
+    x_telegram_bot_api_secret_token: str = Header(None),
+):
+    """
+    Принимает обновление от Telegram и сразу отвечает.
+    Обработка идет в фоне: параллельно по чатам, по порядку внутри чата.
+    """
+    secret = telegram_bot.TELEGRAM_WEBHOOK_SECRET
+    if not secret or not x_telegram_bot_api_secret_token \
+            or not hmac.compare_digest(x_telegram_bot_api_secret_token, secret):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    if telegram_bot.application is None:
+        raise HTTPException(status_code=503, detail="Bot is not started")
+
+    update = Update.de_json(await request.json(), telegram_bot.application.bot)
+    if not update_dispatcher.submit(update):
+        # Telegram повторит доставку позже
+        logger.warning("Очередь обновлений Telegram переполнена, обновление %s отклонено", update.update_id)
+        raise HTTPException(status_code=503, detail="Too many pending updates")
+
+    return {"ok": True}
+
+
+@telegram_router.get("/stats")
+async def telegram_stats():
+    """Очередь и конкурентность обработки обновлений"""
+    return {"mode": telegram_bot.TELEGRAM_MODE, **update_dispatcher.stats()}
@@ -1,5 +1,8 @@
-from fastapi import APIRouter, Depends, FastAPI, HTTPException
-from pydantic import BaseModel
+import hmac
+import os
+from typing import List, Optional
+from fastapi import APIRouter, Depends, FastAPI, Header, HTTPException, Query, Response
+from pydantic import BaseModel, Field
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from sqlalchemy.orm import joinedload
@@ -7,30 +10,51 @@ from app.services.get_db import get_db  # Импортируем get_db
 from app.database import get_db as main 
 from app.models.models import Profit, Transaction, User, Referrals, Balance  # Убедитесь, что Balance подключена
 from sqlalchemy.orm import subqueryload
-from app.services.users import add_referral
+from app.services.users import add_referral, bulk_register_users
+from app.services.referrals import link_referral_closure
+from app.services.pagination import PAGE_SIZE_DEFAULT, PAGE_SIZE_MAX, NEXT_CURSOR_HEADER, keyset_page, page_limit, split_page
+from app.services.balance_cache import PROFILE_FIELDS, balance_cache, build_referrer, get_user_snapshot
 # Логирование
 import logging
 
 
 logger = logging.getLogger(__name__)
-logging.getLogger('sqlalchemy.engine').setLevel(logging.INFO)
+
+# Административные маршруты: токен в заголовке X-Admin-Token (если ADMIN_TOKEN не задан — маршруты закрыты)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+# Максимальный размер одной пачки массовой регистрации
+BULK_REGISTER_MAX = int(os.getenv("BULK_REGISTER_MAX", 10000))
 
 app = FastAPI()
 
 router = APIRouter()
 
 @router.get("/users")
-async def get_users(db: AsyncSession = Depends(get_db)):  # db - это сессия
+async def get_users(
+    response: Response,
+    cursor: str = None,
+    limit: int = Query(PAGE_SIZE_DEFAULT, ge=1, le=PAGE_SIZE_MAX),
+    db: AsyncSession = Depends(get_db),  # db - это сессия
+):
+    """
+    Список пользователей всегда постранично (keyset по id, от новых к старым), по умолчанию — первые
+    PAGE_SIZE_DEFAULT; курсор следующей страницы — в X-Next-Cursor. Фронтенд этот список не запрашивает.
+    """
     try:
         # Выполняем запрос через сессию db
-        result = await db.execute(
-            select(User)
-            .options(
+        query = keyset_page(
+            select(User).options(
                 subqueryload(User.balance),  # Используем subqueryload для баланса
-                subqueryload(User.referred_by)  # Используем subqueryload для реферера
-            )
+                subqueryload(User.referrals).joinedload(Referrals.referrer)  # Собственная запись Referrals с реферером
+            ),
+            [User.id],
+            cursor,
+            limit,
         )
-        users = result.scalars().all()  # Получаем список пользователей
+        result = await db.execute(query)
+        users, next_cursor = split_page(result.scalars().all(), limit, ["id"])  # Получаем страницу пользователей
+        if next_cursor:
+            response.headers[NEXT_CURSOR_HEADER] = next_cursor
 
         return [
             {
@@ -46,14 +70,12 @@ async def get_users(db: AsyncSession = Depends(get_db)):  # db - это сесс
                 "updated_at": u.updated_at,
                 "balance": u.balance.balance if u.balance else 0.0,
                 "trade_balance": u.balance.trade_balance if u.balance else 0.0,
-                "referred_by": {
-                    "id": u.referred_by.id if u.referred_by else None,
-                    "telegram_id": u.referred_by.telegram_id if u.referred_by else None,
-                    "username": u.referred_by.username if u.referred_by else None
-                } if u.referred_by else None
+                "referred_by": build_referrer(u)
             }
             for u in users
         ]
+    except HTTPException:
+        raise
     except Exception as e:
         # Логирование ошибки
         logger.error(f"Ошибка при получении пользователей: {e}", exc_info=True)
@@ -64,42 +86,16 @@ async def get_user_by_telegram_id(telegram_id: int, db: AsyncSession = Depends(g
     try:
         logger.info(f"Пытаемся получить пользователя с telegram_id: {telegram_id}")
 
-        # Выполняем запрос через сессию db с использованием subqueryload для балансa и реферера
-        result = await db.execute(
-            select(User)
-            .options(
-                subqueryload(User.balance),  # Используем subqueryload для баланса
-                subqueryload(User.referred_by)  # Используем subqueryload для реферера
-            )
-            .filter(User.telegram_id == telegram_id)  # Фильтрация по telegram_id
-        )
-        user = result.scalars().first()  # Получаем пользователя
+        # Снимок из кэша балансов; при промахе — один запрос User + Balance
+        snapshot = await get_user_snapshot(db, telegram_id)
 
-        if user is None:
+        if snapshot is None:
             logger.warning(f"Пользователь с telegram_id {telegram_id} не найден.")
             raise HTTPException(status_code=404, detail="User not found")
 
         logger.info(f"Пользователь с telegram_id {telegram_id} найден. Возвращаем данные.")
 
-        return {
-            "id": user.id,
-            "telegram_id": user.telegram_id,
-            "username": user.username,
-            "first_name": user.first_name,
-            "last_name": user.last_name,
-            "language_code": user.language_code,
-            "is_bot": user.is_bot,
-            "photo_url": user.photo_url,
-            "created_at": user.created_at,
-            "updated_at": user.updated_at,
-            "balance": user.balance.balance if user.balance else 0.0,
-            "trade_balance": user.balance.trade_balance if user.balance else 0.0,
-            "referred_by": {
-                "id": user.referred_by.id if user.referred_by else None,
-                "telegram_id": user.referred_by.telegram_id if user.referred_by else None,
-                "username": user.referred_by.username if user.referred_by else None
-            } if user.referred_by else None
-        }
+        return {field: snapshot[field] for field in PROFILE_FIELDS}
 
     except Exception as e:
         # Логирование ошибки с полными деталями
@@ -107,18 +103,30 @@ async def get_user_by_telegram_id(telegram_id: int, db: AsyncSession = Depends(g
         raise HTTPException(status_code=500, detail="An error occurred while retrieving the user.")
 
 @router.get("/transactions/{telegram_id}")
-async def get_transactions(telegram_id: int, db: AsyncSession = Depends(get_db)):
-    """ Получает список транзакций пользователя по telegram_id. """
+async def get_transactions(
+    telegram_id: int,
+    response: Response,
+    cursor: str = None,
+    limit: int = Query(None, ge=1, le=PAGE_SIZE_MAX),
+    db: AsyncSession = Depends(get_db),
+):
+    """ Получает транзакции пользователя по telegram_id; с limit или cursor — постранично, от новых к старым. """
+    limit = page_limit(cursor, limit)
     try:
         user_result = await db.execute(select(User).filter(User.telegram_id == telegram_id))
         user = user_result.scalars().first()
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
 
-        transactions_result = await db.execute(
-            select(Transaction).filter(Transaction.user_id == user.id)
-        )
-        transactions = transactions_result.scalars().all()
+        transactions_result = await db.execute(keyset_page(
+            select(Transaction).filter(Transaction.user_id == user.id),
+            [Transaction.created_at, Transaction.id],
+            cursor,
+            limit,
+        ))
+        transactions, next_cursor = split_page(transactions_result.scalars().all(), limit, ["created_at", "id"])
+        if next_cursor:
+            response.headers[NEXT_CURSOR_HEADER] = next_cursor
 
         return [{
             "id": transaction.id,
@@ -126,23 +134,37 @@ async def get_transactions(telegram_id: int, db: AsyncSession = Depends(get_db))
             "transaction_type": transaction.transaction_type,
             "created_at": transaction.created_at
         } for transaction in transactions]
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error retrieving transactions for telegram_id {telegram_id}: {str(e)}")
         raise HTTPException(status_code=500, detail="An error occurred while retrieving transactions.")
 
 @router.get("/profits/{telegram_id}")
-async def get_profits(telegram_id: int, db: AsyncSession = Depends(get_db)):
-    """ Получает список прибыли пользователя по telegram_id. """
+async def get_profits(
+    telegram_id: int,
+    response: Response,
+    cursor: str = None,
+    limit: int = Query(None, ge=1, le=PAGE_SIZE_MAX),
+    db: AsyncSession = Depends(get_db),
+):
+    """ Получает прибыль пользователя по telegram_id; с limit или cursor — постранично, от новых к старым. """
+    limit = page_limit(cursor, limit)
     try:
         user_result = await db.execute(select(User).filter(User.telegram_id == telegram_id))
         user = user_result.scalars().first()
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
 
-        profits_result = await db.execute(
-            select(Profit).filter(Profit.user_id == user.id)
-        )
-        profits = profits_result.scalars().all()
+        profits_result = await db.execute(keyset_page(
+            select(Profit).filter(Profit.user_id == user.id),
+            [Profit.created_at, Profit.id],
+            cursor,
+            limit,
+        ))
+        profits, next_cursor = split_page(profits_result.scalars().all(), limit, ["created_at", "id"])
+        if next_cursor:
+            response.headers[NEXT_CURSOR_HEADER] = next_cursor
 
         return [{
             "id": profit.id,
@@ -150,6 +172,8 @@ async def get_profits(telegram_id: int, db: AsyncSession = Depends(get_db)):
             "signal_id": profit.signal_id,
             "created_at": profit.created_at
         } for profit in profits]
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error retrieving profits for telegram_id {telegram_id}: {str(e)}")
         raise HTTPException(status_code=500, detail="An error occurred while retrieving profits.")
@@ -161,8 +185,8 @@ class ReferralRequest(BaseModel):
 @router.post("/check_referral")
 async def check_referral(request: ReferralRequest, db: AsyncSession = Depends(get_db)):
     """ 
-    Привязывает пользователя к владельцу реферальной ссылки,
-    записывая его telegram_id в поле referred_by.
+    Привязывает пользователя к владельцу реферальной ссылки:
+    telegram_id владельца — в referrer_id, его users.id — в referred_by.
     """
     # Ищем владельца реферальной ссылки
     referrer_result = await db.execute(
@@ -187,22 +211,25 @@ async def check_referral(request: ReferralRequest, db: AsyncSession = Depends(ge
                 "message": "Пользователь уже привязан",
                 "referral_data": {
                     "telegram_id": referral.telegram_id,
-                    "referred_by": referral.referred_by
+                    "referred_by": referral.referrer_id
                 }
             }
-        # Записываем telegram_id владельца ссылки в referred_by
-        referral.referred_by = referrer.telegram_id
+        # Записываем владельца ссылки по обоим внешним ключам
+        referral.referrer_id = referrer.telegram_id
+        referral.referred_by = referrer.user_id
         referrer.invited_count += 1  # Увеличиваем счётчик приглашённых
+        await link_referral_closure(db, referral.telegram_id, referrer.telegram_id)
 
         # Сохраняем изменения в БД
         await db.commit()
+        balance_cache.invalidate(referral.user_id)  # В снимке профиля — поле referred_by
 
         return {
             "exists": True,
             "message": "Пользователь успешно привязан",
             "referral_data": {
                 "telegram_id": referral.telegram_id,
-                "referred_by": referral.referred_by
+                "referred_by": referral.referrer_id
             }
         }
 
@@ -210,3 +237,49 @@ async def check_referral(request: ReferralRequest, db: AsyncSession = Depends(ge
 
 
 
+
+
+### 🔹 **Массовая регистрация пользователей (импорт из другого бота, повтор /start)**
+class BulkUserProfile(BaseModel):
+    telegram_id: int
+    username: Optional[str] = Field(None, max_length=255)
+    first_name: Optional[str] = Field(None, max_length=255)
+    last_name: Optional[str] = Field(None, max_length=255)
+    language_code: Optional[str] = Field(None, max_length=10)
+    is_bot: bool = False
+    photo_url: Optional[str] = Field(None, max_length=255)
+    referrer_telegram_id: Optional[int] = None
+
+
+class BulkRegisterRequest(BaseModel):
+    users: List[BulkUserProfile]
+
+
+@router.post("/admin/users/bulk")
+async def bulk_register(
+    request: BulkRegisterRequest,
+    x_admin_token: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Создает или обновляет пачку пользователей вместе с балансами и реферальными записями.
+    Возвращает итог по каждому профилю: created, updated или duplicate (повтор в пачке).
+    """
+    if not ADMIN_TOKEN or not x_admin_token or not hmac.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    if len(request.users) > BULK_REGISTER_MAX:
+        raise HTTPException(status_code=413, detail=f"Batch too large, max {BULK_REGISTER_MAX} users")
+
+    try:
+        outcomes = await bulk_register_users(db, [profile.dict() for profile in request.users])
+    except Exception as e:
+        logger.error(f"Ошибка массовой регистрации: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail="An error occurred during bulk registration.")
+
+    return {
+        "total": len(outcomes),
+        "created": sum(1 for outcome in outcomes if outcome["status"] == "created"),
+        "updated": sum(1 for outcome in outcomes if outcome["status"] == "updated"),
+        "results": outcomes,
+    }
@@ -0,0 +1,245 @@
+import logging
+import os
+from collections import OrderedDict
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy.orm import joinedload, selectinload
+from app.models.models import Referrals, User
+
+# Логирование
+logger = logging.getLogger(__name__)
+
+BALANCE_CACHE_SIZE = int(os.getenv("BALANCE_CACHE_SIZE", 100000))  # Сколько пользователей держим в памяти
+# Межпроцессная инвалидация через Postgres LISTEN/NOTIFY (для нескольких воркеров API)
+BALANCE_CACHE_NOTIFY = os.getenv("BALANCE_CACHE_NOTIFY", "0") == "1"
+BALANCE_NOTIFY_CHANNEL = "balance_changed"
+
+BALANCE_FIELDS = ("balance", "trade_balance", "frozen_balance", "earned_balance")
+
+# Поля ответа /user/{telegram_id}
+PROFILE_FIELDS = (
+    "id", "telegram_id", "username", "first_name", "last_name", "language_code",
+    "is_bot", "photo_url", "created_at", "updated_at", "balance", "trade_balance", "referred_by",
+)
+
+_PUBLISH_VERSIONS = text("""
+    SELECT pg_notify(:channel, t.user_id || ':' || t.version)
+    FROM unnest(CAST(:user_ids AS INTEGER[]), CAST(:versions AS BIGINT[])) AS t(user_id, version)
+""")
+
+
+class BalanceSnapshotCache:
+    """
+    Ограниченный LRU-кэш снимков пользователя с балансом, ключи — user_id и telegram_id.
+    Каждый снимок несет balances.version: запись с меньшей версией никогда не затирает более новую.
+    Пока идут загрузки при промахе, кэш запоминает, каких пользователей успели изменить:
+    снимок, прочитанный до такого изменения, в кэш не кладется.
+    """
+
+    def __init__(self, max_size: int = BALANCE_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._by_telegram = {}
+        self._listener_conn = None
+
+        # Поколение растет при каждом изменении; _touched — последнее поколение по user_id, пока есть загрузки
+        self._generation = 0
+        self._cleared_at = 0
+        self._loads_in_flight = 0
+        self._touched = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.stale_writes = 0
+
+    def get_by_telegram(self, telegram_id: int):
+        user_id = self._by_telegram.get(telegram_id)
+        snapshot = self._entries.get(user_id) if user_id is not None else None
+        if snapshot is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return snapshot
+
+    def begin_load(self) -> int:
+        """Отмечает начало чтения из БД при промахе; возвращает поколение для put(since=...)"""
+        self._loads_in_flight += 1
+        return self._generation
+
+    def end_load(self):
+        self._loads_in_flight -= 1
+        if not self._loads_in_flight:
+            self._touched.clear()
+
+    def _touch(self, user_id: int):
+        self._generation += 1
+        if self._loads_in_flight:
+            self._touched[user_id] = self._generation
+
+    def put(self, snapshot: dict, since: int = None):
+        """
+        Кладет полный снимок, если он не старее закэшированного.
+        since — поколение из begin_load: если пользователя меняли после начала чтения, снимок отбрасывается.
+        """
+        user_id = snapshot["id"]
+        if since is not None and (self._touched.get(user_id, 0) > since or self._cleared_at > since):
+            self.stale_writes += 1
+            return
+        current = self._entries.get(user_id)
+        if current is not None and current["version"] > snapshot["version"]:
+            self.stale_writes += 1
+            return
+
+        self._entries[user_id] = snapshot
+        self._entries.move_to_end(user_id)
+        self._by_telegram[snapshot["telegram_id"]] = user_id
+
+        while len(self._entries) > self.max_size:
+            _, evicted = self._entries.popitem(last=False)
+            self._by_telegram.pop(evicted["telegram_id"], None)
+
+    def apply_balance(self, row):
+        """
+        Write-through из UPDATE ... RETURNING: обновляет баланс в закэшированном снимке.
+        Если пользователя нет в кэше, ничего не делаем — его загрузит следующее чтение.
+        """
+        self._touch(row.user_id)
+        snapshot = self._entries.get(row.user_id)
+        if snapshot is None:
+            return
+        if snapshot["version"] > row.version:
+            self.stale_writes += 1
+            return
+        for field in BALANCE_FIELDS:
+            snapshot[field] = getattr(row, field)
+        snapshot["version"] = row.version
+
+    def invalidate(self, user_id: int, version: int = None):
+        """Удаляет снимок; с version — только если закэширована более старая версия"""
+        self._touch(user_id)
+        snapshot = self._entries.get(user_id)
+        if snapshot is None:
+            return
+        if version is not None and snapshot["version"] >= version:
+            return
+        del self._entries[user_id]
+        self._by_telegram.pop(snapshot["telegram_id"], None)
+
+    def clear(self):
+        self._generation += 1
+        self._cleared_at = self._generation
+        self._entries.clear()
+        self._by_telegram.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale_writes": self.stale_writes,
+            "notify": BALANCE_CACHE_NOTIFY,
+        }
+
+    # --- LISTEN/NOTIFY ---
+
+    def _on_notify(self, connection, pid, channel, payload):
+        user_id, _, version = payload.partition(":")
+        try:
+            self.invalidate(int(user_id), int(version) if version else None)
+        except ValueError:
+            logger.warning(f"Некорректное уведомление {channel}: {payload}")
+
+    async def start_listener(self, engine):
+        """Подписывается на изменения балансов из других воркеров"""
+        if not BALANCE_CACHE_NOTIFY or self._listener_conn is not None:
+            return
+        self._listener_conn = await engine.connect()
+        raw = await self._listener_conn.get_raw_connection()
+        await raw.driver_connection.add_listener(BALANCE_NOTIFY_CHANNEL, self._on_notify)
+        logger.info("Кэш балансов подписан на уведомления об изменениях")
+
+    async def stop_listener(self):
+        if self._listener_conn is not None:
+            await self._listener_conn.close()
+            self._listener_conn = None
+
+
+# Единый кэш на процесс
+balance_cache = BalanceSnapshotCache()
+
+
+def build_referrer(user):
+    """
+    Кто пригласил пользователя — по его собственной записи Referrals (user.referrals с загруженным referrer).
+    User.referred_by — обратная сторона связи: это записи приглашенных им пользователей.
+    """
+    referral = next((row for row in user.referrals if row.referrer is not None), None)
+    if referral is None:
+        return None
+    referrer = referral.referrer
+    return {"id": referrer.id, "telegram_id": referrer.telegram_id, "username": referrer.username}
+
+
+def build_user_snapshot(user) -> dict:
+    """Снимок пользователя с балансом в формате ответов /user и /balance"""
+    balance = user.balance
+    return {
+        "id": user.id,
+        "telegram_id": user.telegram_id,
+        "username": user.username,
+        "first_name": user.first_name,
+        "last_name": user.last_name,
+        "language_code": user.language_code,
+        "is_bot": user.is_bot,
+        "photo_url": user.photo_url,
+        "created_at": user.created_at,
+        "updated_at": user.updated_at,
+        "balance": balance.balance if balance else 0.0,
+        "trade_balance": balance.trade_balance if balance else 0.0,
+        "frozen_balance": balance.frozen_balance if balance else 0.0,
+        "earned_balance": balance.earned_balance if balance else 0.0,
+        "version": balance.version if balance else 0,
+        "referred_by": build_referrer(user),
+    }
+
+
+async def get_user_snapshot(db: AsyncSession, telegram_id: int):
+    """Снимок из кэша; при промахе — один запрос User + Balance и запись в кэш"""
+    snapshot = balance_cache.get_by_telegram(telegram_id)
+    if snapshot is not None:
+        return snapshot
+
+    since = balance_cache.begin_load()
+    try:
+        result = await db.execute(
+            select(User)
+            .options(joinedload(User.balance), selectinload(User.referrals).joinedload(Referrals.referrer))
+            .filter(User.telegram_id == telegram_id)
+        )
+        user = result.scalars().first()
+        if user is None:
+            return None
+
+        snapshot = build_user_snapshot(user)
+        # Запись, закоммиченная во время чтения, делает снимок устаревшим — тогда он только возвращается
+        balance_cache.put(snapshot, since)
+        return snapshot
+    finally:
+        balance_cache.end_load()
+
+
+async def publish_balance_versions(db: AsyncSession, rows):
+    """
+    Отправляет NOTIFY о новых версиях балансов (в транзакции вызывающего — доставка после COMMIT).
+    Без BALANCE_CACHE_NOTIFY ничего не делает.
+    """
+    if not BALANCE_CACHE_NOTIFY or not rows:
+        return
+    await db.execute(_PUBLISH_VERSIONS, {
+        "channel": BALANCE_NOTIFY_CHANNEL,
+        "user_ids": [row.user_id for row in rows],
+        "versions": [row.version for row in rows],
+    })
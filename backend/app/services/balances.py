@@ -1,26 +1,28 @@
 import logging
+from sqlalchemy import update
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
 from sqlalchemy.exc import SQLAlchemyError
 from app.models.models import Balance, Referrals
 from app.statistics_services.balance_actions import log_transaction
 from app.database import get_db
+from app.services.referrals import link_referral_closure
+from app.services.balance_cache import balance_cache, publish_balance_versions
 # Настройка логирования
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.INFO)
-
-# Отключаем логирование SQL-запросов (уровень logging.WARNING)
-logging.getLogger('sqlalchemy.engine').setLevel(logging.INFO)
 
 # Получение баланса пользователя
 async def get_balance(db: AsyncSession, user_id: int) -> Balance:
     try:
-        logger.info(f"Получение баланса для пользователя {user_id}")
+        logger.debug("Получение баланса для пользователя %s", user_id)
         result = await db.execute(select(Balance).filter(Balance.user_id == user_id))
         balance = result.scalars().first()
 
         if balance:
-            logger.info(f"Баланс: {balance.balance}, Торговый баланс: {balance.trade_balance}, Замороженный баланс: {balance.frozen_balance}")
+            logger.debug("Баланс: %s, Торговый баланс: %s, Замороженный баланс: %s",
+                         balance.balance, balance.trade_balance, balance.frozen_balance)
         else:
             logger.warning(f"Баланс для пользователя {user_id} не найден.")
 
@@ -48,27 +50,63 @@ async def create_or_update_balance(db: AsyncSession, user_id: int, balance: floa
 
         await db.commit()
         await db.refresh(user_balance)
+        balance_cache.invalidate(user_id)
         return user_balance
     except SQLAlchemyError as e:
         logger.error(f"Ошибка обновления баланса {user_id}: {e}")
         await db.rollback()
         return None
 
+# Атомарное изменение баланса одним UPDATE ... RETURNING.
+# Условие (guard) проверяется в самом запросе, поэтому параллельные запросы не теряют обновления.
+# Каждое изменение увеличивает version — по ней кэш балансов отличает новые значения от устаревших.
+def balance_update_statement(user_id: int, values: dict, guards: tuple = ()):
+    return (
+        update(Balance)
+        .where(Balance.user_id == user_id, *guards)
+        .values(**values, version=Balance.version + 1)
+        .returning(
+            Balance.id, Balance.user_id, Balance.balance, Balance.trade_balance,
+            Balance.frozen_balance, Balance.earned_balance, Balance.version,
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+def sync_balance_identity(db: AsyncSession, row):
+    """Переносит новые значения из RETURNING в уже загруженный в сессию объект Balance"""
+    instance = db.identity_map.get(identity_key(Balance, row.id))
+    if instance is not None:
+        for field in ("balance", "trade_balance", "frozen_balance", "earned_balance", "version"):
+            set_committed_value(instance, field, getattr(row, field))
+    balance_cache.apply_balance(row)
+
+async def apply_balance_update(db: AsyncSession, user_id: int, values: dict, guards: tuple = ()):
+    """
+    Выполняет guarded UPDATE и коммитит его, обновляя кэш балансов.
+
+    :return: Строка с новыми значениями баланса или None, если баланс не найден или условие не выполнено
+    """
+    result = await db.execute(balance_update_statement(user_id, values, guards))
+    row = result.first()
+    if row is not None:
+        await publish_balance_versions(db, [row])
+    await db.commit()
+
+    if row is not None:
+        sync_balance_identity(db, row)
+    return row
+
 # Обновление основного баланса
 async def update_balance(db: AsyncSession, user_id: int, amount: float) -> bool:
     try:
-        logger.info(f"Обновление баланса {user_id} на {amount}")
-        result = await db.execute(select(Balance).filter(Balance.user_id == user_id))
-        balance = result.scalars().first()
-
-        if balance:
-            balance.balance += amount
-            await db.commit()
-            await db.refresh(balance)
+        logger.debug("Обновление баланса %s на %s", user_id, amount)
+        # Списание не может увести баланс в минус
+        guards = (Balance.balance + amount >= 0,) if amount < 0 else ()
+        row = await apply_balance_update(db, user_id, {"balance": Balance.balance + amount}, guards)
 
+        if row:
             # Логируем операцию
             await log_transaction(db, user_id, amount, "balance_update")
-
             return True
         return False
     except SQLAlchemyError as e:
@@ -79,18 +117,13 @@ async def update_balance(db: AsyncSession, user_id: int, amount: float) -> bool:
 # Обновление торгового баланса
 async def update_trading_balance(db: AsyncSession, user_id: int, amount: float) -> bool:
     try:
-        logger.info(f"Обновление торгового баланса {user_id} на {amount}")
-        result = await db.execute(select(Balance).filter(Balance.user_id == user_id))
-        balance = result.scalars().first()
-
-        if balance:
-            balance.trade_balance += amount
-            await db.commit()
-            await db.refresh(balance)
+        logger.debug("Обновление торгового баланса %s на %s", user_id, amount)
+        guards = (Balance.trade_balance + amount >= 0,) if amount < 0 else ()
+        row = await apply_balance_update(db, user_id, {"trade_balance": Balance.trade_balance + amount}, guards)
 
+        if row:
             # Логируем операцию
             await log_transaction(db, user_id, amount, "trade_balance_update")
-
             return True
         return False
     except SQLAlchemyError as e:
@@ -101,19 +134,17 @@ async def update_trading_balance(db: AsyncSession, user_id: int, amount: float)
 # Заморозка средств
 async def freeze_balance(db: AsyncSession, user_id: int, amount: float) -> bool:
     try:
-        logger.info(f"Замораживаем {amount} для пользователя {user_id}")
-        result = await db.execute(select(Balance).filter(Balance.user_id == user_id))
-        balance = result.scalars().first()
-
-        if balance and balance.balance >= amount:
-            balance.balance -= amount
-            balance.frozen_balance += amount
-            await db.commit()
-            await db.refresh(balance)
-
+        logger.debug("Замораживаем %s для пользователя %s", amount, user_id)
+        row = await apply_balance_update(
+            db,
+            user_id,
+            {"balance": Balance.balance - amount, "frozen_balance": Balance.frozen_balance + amount},
+            (Balance.balance >= amount,),
+        )
+
+        if row:
             # Логируем операцию
             await log_transaction(db, user_id, amount, "freeze")
-
             return True
         logger.warning(f"Недостаточно средств для заморозки у пользователя {user_id}")
         return False
@@ -125,19 +156,17 @@ async def freeze_balance(db: AsyncSession, user_id: int, amount: float) -> bool:
 # Размораживание средств
 async def unfreeze_balance(db: AsyncSession, user_id: int, amount: float) -> bool:
     try:
-        logger.info(f"Размораживаем {amount} для пользователя {user_id}")
-        result = await db.execute(select(Balance).filter(Balance.user_id == user_id))
-        balance = result.scalars().first()
-
-        if balance and balance.frozen_balance >= amount:
-            balance.frozen_balance -= amount
-            balance.balance += amount
-            await db.commit()
-            await db.refresh(balance)
-
+        logger.debug("Размораживаем %s для пользователя %s", amount, user_id)
+        row = await apply_balance_update(
+            db,
+            user_id,
+            {"frozen_balance": Balance.frozen_balance - amount, "balance": Balance.balance + amount},
+            (Balance.frozen_balance >= amount,),
+        )
+
+        if row:
             # Логируем операцию
             await log_transaction(db, user_id, amount, "unfreeze")
-
             return True
         logger.warning(f"Недостаточно замороженных средств для разморозки у пользователя {user_id}")
         return False
@@ -211,15 +240,18 @@ async def update_referral_by_url(referral_by_telegram: Referrals, referral_by_li
             referral_owner.invited_count += 1
             
             # Обновляем referred_by у пользователя, который перешел по ссылке
-            referral_by_telegram.referred_by = link_telegram_id  # Присваиваем ему ID владельца ссылки
+            referral_by_telegram.referrer_id = link_telegram_id  # Telegram ID владельца ссылки
+            referral_by_telegram.referred_by = referral_owner.user_id  # users.id владельца ссылки
+            await link_referral_closure(db, telegram_id, link_telegram_id)
 
             # Сохраняем изменения в базе данных
             await db.commit()  # Подтверждаем изменения
+            balance_cache.invalidate(referral_by_telegram.user_id)  # В снимке профиля — поле referred_by
             await db.refresh(referral_by_telegram)  # Обновляем данные после коммита
             await db.refresh(referral_owner)  # Обновляем данные после коммита
 
             # Логируем операцию
-            logger.info(f"Обновлены данные для telegram_id {telegram_id}. Referred_by: {referral_by_telegram.referred_by}, Invited_count: {referral_owner.invited_count}")
+            logger.info(f"Обновлены данные для telegram_id {telegram_id}. Referrer: {referral_by_telegram.referrer_id}, Invited_count: {referral_owner.invited_count}")
 
             return True
 
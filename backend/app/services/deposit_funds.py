@@ -1,10 +1,10 @@
 import os
-import aiohttp
 import logging
-from app.models.models import Balance, Transaction
+import uuid
+from app.models.models import Payment
 from app.database import get_db as main
+from app.services.http_client import CircuitOpenError, http_clients
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.future import select
 
 # Логирование
 logger = logging.getLogger(__name__)
@@ -12,12 +12,23 @@ logger = logging.getLogger(__name__)
 # Ваш API ключ NOWPayments
 API_KEY = os.getenv("API_KEY")
 
-# URL для создания платежа
-NOWPAYMENTS_API_URL = "https://api.nowpayments.io/v1/payment"
+# Базовый URL API NOWPayments; соединения берутся из общего пула исходящих клиентов
+NOWPAYMENTS_API_URL = os.getenv("NOWPAYMENTS_API_URL", "https://api.nowpayments.io/v1")
+NOWPAYMENTS_READ_TIMEOUT = float(os.getenv("NOWPAYMENTS_READ_TIMEOUT", 15))
+
+# Публичный адрес маршрута /payments/ipn, на который NOWPayments шлет уведомления
+NOWPAYMENTS_IPN_CALLBACK_URL = os.getenv("NOWPAYMENTS_IPN_CALLBACK_URL")
+
+http_clients.register(
+    "nowpayments", NOWPAYMENTS_API_URL,
+    read_timeout=NOWPAYMENTS_READ_TIMEOUT,
+    headers={"Authorization": f"Bearer {API_KEY}", "Content-Type": "application/json"},
+)
 
 async def create_payment_address(user_id: int, amount: float, session: AsyncSession = None):
     """
     Метод для создания платежа через NOWPayments для пополнения баланса пользователя.
+    Баланс здесь не меняется: зачисление делает потребитель payment_events после IPN со статусом finished.
 
     :param user_id: ID пользователя
     :param amount: Сумма для пополнения баланса
@@ -25,61 +36,54 @@ async def create_payment_address(user_id: int, amount: float, session: AsyncSess
     :return: URL для оплаты и информация о транзакции
     """
     if session is None:
-        session = main()
+        async with main() as session:
+            return await create_payment_address(user_id, amount, session)
 
+    order_id = f"user_{user_id}_deposit_{uuid.uuid4().hex[:16]}"
     try:
-        # Получаем баланс пользователя (если нужно)
-        result = await session.execute(select(Balance).filter_by(user_id=user_id))
-        balance = result.scalars().first()
+        # Создаем запрос на API NOWPayments для генерации адреса для пополнения
+        data = {
+            "price_amount": amount,
+            "price_currency": "usd",  # Замените на нужную валюту
+            "pay_currency": "usdttrc20",  # Указываем криптовалюту для оплаты
+            "ipn_callback_url": NOWPAYMENTS_IPN_CALLBACK_URL,  # URL для обратного вызова
+            "order_id": order_id,
+        }
 
-        if balance is None:
-            # Если у пользователя нет записи о балансе, создаем новую
-            balance = Balance(user_id=user_id, amount=0)
+        # Создание платежа не идемпотентно — POST не повторяется, иначе возможны два платежа
+        response = await http_clients.request("nowpayments", "POST", "/payment", json=data)
+        response_data = response.json()
 
-        # Создаем запрос на API NOWPayments для генерации адреса для пополнения
-        async with aiohttp.ClientSession() as client:
-            headers = {
-                "Authorization": f"Bearer {API_KEY}",
-                "Content-Type": "application/json",
-            }
-            data = {
-                "amount": amount,
-                "currency": "usd",  # Замените на нужную валюту
-                "pay_currency": "usdttrc20",  # Указываем криптовалюту для оплаты
-                "ipn_callback_url": "https://yourdomain.com/callback",  # URL для обратного вызова
-                "order_id": f"user_{user_id}_deposit"
-            }
-            
-            # Отправляем POST запрос
-            async with client.post(NOWPAYMENTS_API_URL, json=data, headers=headers) as response:
-                response_data = await response.json()
-                
-                if response.status == 200:
-                    payment_url = response_data.get('invoice_url')
-                    transaction_id = response_data.get('payment_id')
+        if response.status_code in (200, 201):
+            payment_url = response_data.get('invoice_url')
+            transaction_id = str(response_data.get('payment_id'))
 
-                    # Создаем запись о транзакции
-                    transaction = Transaction(
-                        user_id=user_id,
-                        amount=amount,
-                        transaction_type="deposit",
-                        status="pending",
-                        external_transaction_id=transaction_id
-                    )
-                    session.add(transaction)
+            # Запоминаем платеж: по external_payment_id потребитель IPN найдет пользователя и сумму
+            session.add(Payment(
+                user_id=user_id,
+                order_id=order_id,
+                external_payment_id=transaction_id,
+                amount=amount,
+                status=response_data.get('payment_status', "waiting"),
+            ))
 
-                    # Сохраняем изменения
-                    await session.commit()
+            # Сохраняем изменения
+            await session.commit()
 
-                    logger.info(f"Платеж для пользователя {user_id} успешно создан. Ссылка на оплату: {payment_url}")
+            logger.info(f"Платеж {transaction_id} для пользователя {user_id} успешно создан")
 
-                    return {
-                        "payment_url": payment_url,
-                        "transaction_id": transaction_id
-                    }
-                else:
-                    logger.error(f"Ошибка при создании платежа через NOWPayments: {response_data}")
-                    return {"error": "Не удалось создать платеж"}
+            return {
+                "payment_url": payment_url,
+                "pay_address": response_data.get('pay_address'),
+                "transaction_id": transaction_id
+            }
+        else:
+            logger.error(f"Ошибка при создании платежа через NOWPayments: {response_data}")
+            return {"error": "Не удалось создать платеж"}
+    except CircuitOpenError:
+        logger.warning(f"NOWPayments недоступен, платеж для пользователя {user_id} не создан")
+        return {"error": "Платежный сервис временно недоступен"}
     except Exception as e:
+        await session.rollback()
         logger.error(f"Ошибка при обработке запроса для пользователя {user_id}: {str(e)}")
         return {"error": "Ошибка при обработке запроса"}
@@ -0,0 +1,230 @@
+import asyncio
+import logging
+import os
+import random
+import time
+import httpx
+from app.services.metrics import registry
+
+# Логирование
+logger = logging.getLogger(__name__)
+
+# Настройки по умолчанию для всех внешних сервисов
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 3))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", 10))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 20))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", 10))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", 2))  # Повторы только для идемпотентных запросов
+HTTP_RETRY_BACKOFF = float(os.getenv("HTTP_RETRY_BACKOFF", 0.2))  # База экспоненциальной задержки, секунды
+HTTP_BREAKER_THRESHOLD = int(os.getenv("HTTP_BREAKER_THRESHOLD", 5))  # Подряд неудач до размыкания
+HTTP_BREAKER_COOLDOWN = float(os.getenv("HTTP_BREAKER_COOLDOWN", 30))  # Секунд до пробного запроса
+
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+RETRY_STATUSES = frozenset({429, 502, 503, 504})
+
+HTTP_CLIENT_DURATION = registry.histogram(
+    "http_client_duration_seconds", "Время запроса к внешнему сервису", ("upstream", "status"))
+
+
+class CircuitOpenError(Exception):
+    """Внешний сервис временно отключен предохранителем — запрос не отправлялся"""
+
+    def __init__(self, upstream: str):
+        super().__init__(f"Сервис {upstream} временно недоступен")
+        self.upstream = upstream
+
+
+class CircuitBreaker:
+    """
+    Предохранитель: после threshold неудач подряд запросы сразу отклоняются на cooldown секунд,
+    затем пропускается один пробный запрос (half-open).
+    """
+
+    def __init__(self, threshold: int = HTTP_BREAKER_THRESHOLD, cooldown: float = HTTP_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        """
+        Разрешает запрос. True в состоянии half_open означает пробный запрос:
+        вызывающий обязан вызвать release() после него, чем бы он ни закончился.
+        """
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._trial_in_flight:
+            self._trial_in_flight = True
+            return True
+        return False
+
+    def release(self):
+        """Снимает отметку пробного запроса (в finally вокруг запроса)"""
+        self._trial_in_flight = False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold or self.opened_at is not None:
+            self.opened_at = time.monotonic()
+
+
+class Upstream:
+    """Клиент с пулом keep-alive соединений к одному внешнему сервису и его счетчики"""
+
+    def __init__(self, name: str, base_url: str, connect_timeout: float, read_timeout: float,
+                 max_connections: int, max_keepalive: int, retries: int, headers: dict = None):
+        self.name = name
+        self.base_url = base_url
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive)
+        self.retries = retries
+        self.headers = headers or {}
+        self.breaker = CircuitBreaker()
+        self.client = None
+
+        self.requests = 0
+        self.failures = 0
+        self.retried = 0
+        self.rejected = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def open(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                base_url=self.base_url, timeout=self.timeout, limits=self.limits, headers=self.headers,
+            )
+        return self.client
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def observe(self, seconds: float, status):
+        self.requests += 1
+        self.latency_total += seconds
+        self.latency_max = max(self.latency_max, seconds)
+        HTTP_CLIENT_DURATION.observe(seconds, self.name, status)
+
+    def pool_stats(self) -> dict:
+        """Соединения пула httpcore: занятые запросами и простаивающие keep-alive"""
+        pool = getattr(getattr(self.client, "_transport", None), "_pool", None)
+        connections = list(getattr(pool, "connections", ()))
+        in_use = sum(1 for connection in connections if not connection.is_idle())
+        return {
+            "connections": len(connections),
+            "in_use": in_use,
+            "idle": len(connections) - in_use,
+            "queued_requests": len(getattr(pool, "_requests", ())) - in_use if pool is not None else 0,
+        }
+
+    def stats(self) -> dict:
+        return {
+            "base_url": self.base_url,
+            "open": self.client is not None,
+            "pool": self.pool_stats(),
+            "breaker": self.breaker.state,
+            "requests": self.requests,
+            "failures": self.failures,
+            "retried": self.retried,
+            "rejected_by_breaker": self.rejected,
+            "latency_avg_ms": round(self.latency_total / self.requests * 1000, 2) if self.requests else 0.0,
+            "latency_max_ms": round(self.latency_max * 1000, 2),
+            "max_connections": self.limits.max_connections,
+            "max_keepalive": self.limits.max_keepalive_connections,
+        }
+
+
+class HttpClientPool:
+    """
+    Общий слой исходящих HTTP-запросов: по одному долгоживущему клиенту на внешний сервис.
+    Клиенты закрываются при остановке приложения (close в shutdown).
+    """
+
+    def __init__(self):
+        self._upstreams = {}
+
+    def register(self, name: str, base_url: str, *, connect_timeout: float = HTTP_CONNECT_TIMEOUT,
+                 read_timeout: float = HTTP_READ_TIMEOUT, max_connections: int = HTTP_MAX_CONNECTIONS,
+                 max_keepalive: int = HTTP_MAX_KEEPALIVE, retries: int = HTTP_RETRIES, headers: dict = None):
+        """Описывает внешний сервис; клиент создается при первом запросе"""
+        if name not in self._upstreams:
+            self._upstreams[name] = Upstream(
+                name, base_url, connect_timeout, read_timeout, max_connections, max_keepalive, retries, headers,
+            )
+        return self._upstreams[name]
+
+    async def request(self, name: str, method: str, url: str, *, idempotent: bool = None, **kwargs) -> httpx.Response:
+        """
+        Выполняет запрос к сервису name. Идемпотентные запросы повторяются при сетевых ошибках,
+        таймаутах и ответах 429/5xx с экспоненциальной задержкой и случайным разбросом.
+
+        :raises CircuitOpenError: Если предохранитель сервиса разомкнут
+        :raises httpx.HTTPError: Если все попытки завершились сетевой ошибкой
+        """
+        upstream = self._upstreams[name]
+        method = method.upper()
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        attempts = 1 + (upstream.retries if idempotent else 0)
+
+        for attempt in range(attempts):
+            trial = upstream.breaker.state == "half_open"
+            if not upstream.breaker.allow():
+                upstream.rejected += 1
+                raise CircuitOpenError(name)
+
+            started = time.perf_counter()
+            try:
+                response = await upstream.open().request(method, url, **kwargs)
+            except (httpx.TransportError, httpx.TimeoutException) as e:
+                upstream.observe(time.perf_counter() - started, "error")
+                upstream.failures += 1
+                upstream.breaker.record_failure()
+                if attempt + 1 >= attempts:
+                    logger.warning(f"{name}: {method} {url} не выполнен: {e!r}")
+                    raise
+            else:
+                upstream.observe(time.perf_counter() - started, response.status_code)
+                if response.status_code >= 500 or response.status_code == 429:
+                    upstream.failures += 1
+                    upstream.breaker.record_failure()
+                    if response.status_code not in RETRY_STATUSES or attempt + 1 >= attempts:
+                        return response
+                else:
+                    upstream.breaker.record_success()
+                    return response
+            finally:
+                # Отмена или любая другая ошибка не должны оставить предохранитель ждать пробный запрос вечно
+                if trial:
+                    upstream.breaker.release()
+
+            upstream.retried += 1
+            # Экспоненциальная задержка с полным разбросом, чтобы повторы не шли волной
+            await asyncio.sleep(random.uniform(0, HTTP_RETRY_BACKOFF * 2 ** attempt))
+
+    async def close(self):
+        for upstream in self._upstreams.values():
+            await upstream.close()
+
+    def stats(self) -> dict:
+        return {name: upstream.stats() for name, upstream in self._upstreams.items()}
+
+
+# Единый пул на процесс
+http_clients = HttpClientPool()
@@ -0,0 +1,92 @@
+import logging
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.models.models import Balance, Transaction
+from app.services.balances import balance_update_statement, sync_balance_identity
+from app.services.balance_cache import publish_balance_versions
+
+# Логирование
+logger = logging.getLogger(__name__)
+
+BALANCE_FIELDS = ("balance", "trade_balance", "frozen_balance", "earned_balance")
+
+
+class InsufficientFundsError(Exception):
+    """Баланс не найден или после операции ушел бы в минус"""
+
+    def __init__(self, user_id: int):
+        super().__init__(f"Недостаточно средств у пользователя {user_id}")
+        self.user_id = user_id
+
+
+class LedgerOperation:
+    """
+    Сборщик многошаговой денежной операции.
+    Копит изменения балансов, записи журнала и дополнительные строки,
+    а затем выполняет всё одной транзакцией: по одному guarded UPDATE на пользователя,
+    один multi-row INSERT в журнал и один COMMIT.
+    """
+
+    def __init__(self):
+        self._deltas = {}
+        self._entries = []
+        self._rows = []
+
+    def change(self, user_id: int, **deltas: float) -> "LedgerOperation":
+        """Добавляет изменения полей баланса (balance, trade_balance, frozen_balance, earned_balance)"""
+        user_deltas = self._deltas.setdefault(user_id, {})
+        for field, delta in deltas.items():
+            if field not in BALANCE_FIELDS:
+                raise ValueError(f"Неизвестное поле баланса: {field}")
+            user_deltas[field] = user_deltas.get(field, 0.0) + delta
+        return self
+
+    def entry(self, user_id: int, amount: float, transaction_type: str) -> "LedgerOperation":
+        """Добавляет запись в журнал транзакций"""
+        self._entries.append({"user_id": user_id, "amount": amount, "transaction_type": transaction_type})
+        return self
+
+    def add(self, row) -> "LedgerOperation":
+        """Добавляет ORM-объект, который должен сохраниться в той же транзакции"""
+        self._rows.append(row)
+        return self
+
+    async def execute(self, db: AsyncSession) -> dict:
+        """
+        Выполняет операцию одной транзакцией.
+        Отрицательные изменения защищены условием «поле + изменение >= 0» прямо в UPDATE.
+
+        :return: Новые значения балансов по user_id
+        :raises InsufficientFundsError: Если хотя бы одно списание не прошло (всё откатывается)
+        """
+        balances = {}
+        try:
+            # Фиксированный порядок обновлений исключает взаимные блокировки между операциями
+            for user_id in sorted(self._deltas):
+                deltas = {field: delta for field, delta in self._deltas[user_id].items() if delta}
+                if not deltas:
+                    continue
+
+                values = {field: getattr(Balance, field) + delta for field, delta in deltas.items()}
+                guards = tuple(
+                    getattr(Balance, field) + delta >= 0 for field, delta in deltas.items() if delta < 0
+                )
+                result = await db.execute(balance_update_statement(user_id, values, guards))
+                row = result.first()
+                if row is None:
+                    raise InsufficientFundsError(user_id)
+                balances[user_id] = row
+
+            if self._entries:
+                await db.execute(insert(Transaction), self._entries)
+
+            db.add_all(self._rows)
+            await publish_balance_versions(db, list(balances.values()))
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+
+        for row in balances.values():
+            sync_balance_identity(db, row)
+        return balances
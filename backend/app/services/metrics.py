@@ -0,0 +1,213 @@
+import bisect
+import contextvars
+import functools
+import threading
+import time
+from sqlalchemy import event
+
+# Границы корзин гистограмм задержек, в секундах
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Границы для количества запросов к БД на один HTTP-запрос
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+# Границы для задержки выплаты после expires_at, в секундах
+LAG_BUCKETS = (0.1, 0.5, 1.0, 5.0, 15.0, 30.0, 60.0, 300.0, 900.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """
+    Монотонный счетчик с метками.
+    Если задан callback, значение читается в момент выдачи метрик (счетчик, который ведет сам компонент).
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), callback=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.callback = callback
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self) -> list:
+        if self.callback is not None:
+            value = self.callback()
+            return [] if value is None else [f"{self.name} {value}"]
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labels, labels)} {value}" for labels, value in items]
+
+
+class Gauge(Counter):
+    """Текущее значение; если задан callback, значение читается в момент выдачи метрик"""
+
+    kind = "gauge"
+
+    def set(self, value: float, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами, как в клиенте Prometheus"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list:
+        with self._lock:
+            items = [(labels, (list(counts), total, count)) for labels, (counts, total, count) in self._series.items()]
+
+        lines = []
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, labels, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels, labels, le)} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, labels)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """Все метрики процесса; render() отдает их в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: tuple = (), callback=None) -> Counter:
+        return self.register(Counter(name, documentation, labels, callback))
+
+    def gauge(self, name: str, documentation: str, labels: tuple = (), callback=None) -> Gauge:
+        return self.register(Gauge(name, documentation, labels, callback))
+
+    def histogram(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# Единый реестр на процесс
+registry = MetricsRegistry()
+
+HTTP_REQUEST_DURATION = registry.histogram(
+    "http_request_duration_seconds", "Время обработки HTTP-запроса", ("method", "route", "status"))
+HTTP_DB_QUERIES = registry.histogram(
+    "http_request_db_queries", "Запросов к БД на один HTTP-запрос", ("route",), QUERY_COUNT_BUCKETS)
+HTTP_DB_DURATION = registry.histogram(
+    "http_request_db_duration_seconds", "Суммарное время запросов к БД на один HTTP-запрос", ("route",))
+
+DB_QUERIES = registry.counter("db_queries_total", "Выполненные SQL-запросы")
+DB_QUERY_DURATION = registry.histogram("db_query_duration_seconds", "Время выполнения SQL-запроса")
+DB_POOL_WAIT = registry.histogram("db_pool_wait_seconds", "Ожидание соединения из пула")
+
+SETTLEMENT_DURATION = registry.histogram("settlement_run_duration_seconds", "Длительность прогона расчета сигналов")
+SETTLEMENT_ROWS = registry.counter("settlement_rows_total", "Строки, обработанные расчетом сигналов", ("kind",))
+SETTLEMENT_PAYOUT_LAG = registry.histogram(
+    "settlement_payout_lag_seconds", "Задержка выплаты относительно expires_at сигнала", buckets=LAG_BUCKETS)
+
+TELEGRAM_HANDLER_DURATION = registry.histogram(
+    "telegram_handler_duration_seconds", "Время обработки обновления Telegram", ("handler", "status"))
+
+
+# --- Учет запросов к БД в рамках HTTP-запроса ---
+
+class QueryStats:
+    """Счетчик SQL-запросов и времени БД одного HTTP-запроса (с повторами по тексту запроса)"""
+
+    __slots__ = ("count", "duration", "statements")
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.statements = {}
+
+
+current_query_stats = contextvars.ContextVar("current_query_stats", default=None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._query_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - getattr(context, "_query_started", time.perf_counter())
+    DB_QUERIES.inc()
+    DB_QUERY_DURATION.observe(duration)
+
+    stats = current_query_stats.get()
+    if stats is not None:
+        stats.count += 1
+        stats.duration += duration
+        stats.statements[statement] = stats.statements.get(statement, 0) + 1
+
+
+def instrument_engine(engine):
+    """Подключает учет SQL-запросов к событиям движка SQLAlchemy"""
+    sync_engine = getattr(engine, "sync_engine", engine)
+    if not event.contains(sync_engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(sync_engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(sync_engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def track_telegram_handler(name: str):
+    """Декоратор обработчика Telegram: пишет время обработки обновления в гистограмму"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            status = "ok"
+            try:
+                return await handler(*args, **kwargs)
+            except Exception:
+                status = "error"
+                raise
+            finally:
+                TELEGRAM_HANDLER_DURATION.observe(time.perf_counter() - started, name, status)
+        return wrapper
+    return decorator
@@ -0,0 +1,84 @@
+import logging
+import re
+from dataclasses import dataclass
+from typing import Optional
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from app.models.models import Referrals, User
+from app.services.telegram_service import issue_auth_token
+from app.services.users import bulk_register_users
+
+# Логирование
+logger = logging.getLogger(__name__)
+
+# Полезная нагрузка deep link t.me/<bot>?start=<payload>: ref_<telegram_id>, <user_id>-<telegram_id> или <telegram_id>
+_START_PAYLOAD = re.compile(r"^(?:ref_)?(?:\d+-)?(\d{1,19})$")
+# telegram_id хранится в BIGINT
+_MAX_TELEGRAM_ID = 2 ** 63 - 1
+
+
+@dataclass
+class OnboardingResult:
+    user_id: int
+    telegram_id: int
+    first_name: Optional[str]
+    referral_link: Optional[str]
+    referrer_telegram_id: Optional[int]
+    token: str
+    is_new: bool
+
+
+def parse_start_payload(args) -> Optional[int]:
+    """Telegram ID реферера из аргумента /start или None"""
+    if not args:
+        return None
+    match = _START_PAYLOAD.match(args[0].strip())
+    if match is None:
+        return None
+    telegram_id = int(match.group(1))
+    return telegram_id if 0 < telegram_id <= _MAX_TELEGRAM_ID else None
+
+
+async def onboard_user(db: AsyncSession, profile: dict, referrer_telegram_id: int = None) -> OnboardingResult:
+    """
+    Находит или регистрирует пользователя /start и выпускает токен входа — одной транзакцией.
+    Новому пользователю в той же транзакции создаются баланс, реферальная запись и связи в таблице замыкания.
+    """
+    telegram_id = profile["telegram_id"]
+    try:
+        result = await db.execute(
+            select(User.id, User.first_name, Referrals.referral_link, Referrals.referrer_id)
+            .outerjoin(Referrals, Referrals.user_id == User.id)
+            .filter(User.telegram_id == telegram_id)
+        )
+        existing = result.first()
+
+        if existing is not None:
+            token = issue_auth_token(db, telegram_id)
+            await db.commit()
+            return OnboardingResult(
+                user_id=existing.id, telegram_id=telegram_id, first_name=existing.first_name,
+                referral_link=existing.referral_link, referrer_telegram_id=existing.referrer_id, token=token, is_new=False,
+            )
+
+        # Пользователь, баланс, реферальная запись и замыкание — тем же путем, что и массовая регистрация
+        outcome, = await bulk_register_users(
+            db, [{**profile, "referrer_telegram_id": referrer_telegram_id}], commit=False
+        )
+        token = issue_auth_token(db, telegram_id)
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        raise
+
+    # Параллельный /start того же пользователя мог успеть создать его первым
+    is_new = outcome["status"] == "created"
+    onboarded = OnboardingResult(
+        user_id=outcome["user_id"], telegram_id=telegram_id, first_name=profile.get("first_name"),
+        referral_link=f"https://app.com/ref/{outcome['user_id']}-{telegram_id}",
+        referrer_telegram_id=outcome.get("referrer_telegram_id"), token=token, is_new=is_new,
+    )
+
+    if is_new:
+        logger.info("Зарегистрирован пользователь %s (реферер %s)", telegram_id, onboarded.referrer_telegram_id)
+    return onboarded
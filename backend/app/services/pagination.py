@@ -0,0 +1,87 @@
+import base64
+import json
+import os
+from datetime import datetime
+from fastapi import HTTPException
+from sqlalchemy import and_, or_, tuple_
+
+# Размер страницы по умолчанию и верхняя граница
+PAGE_SIZE_DEFAULT = int(os.getenv("PAGE_SIZE_DEFAULT", 100))
+PAGE_SIZE_MAX = int(os.getenv("PAGE_SIZE_MAX", 500))
+
+# Заголовок с курсором следующей страницы (тело списков не меняется)
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(values: list) -> str:
+    """Упаковывает значения ключа последней строки в непрозрачный курсор"""
+    payload = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, size: int) -> list:
+    """Распаковывает курсор; первый элемент ключа из двух значений — created_at (может быть None)"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if not isinstance(values, list) or len(values) != size:
+            raise ValueError
+        if size == 2 and values[0] is not None:
+            values[0] = datetime.fromisoformat(values[0])
+        return values
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def page_limit(cursor: str = None, limit: int = None):
+    """
+    Размер страницы для списков, которые фронтенд запрашивает целиком (транзакции, инвестиции).
+    Без cursor и limit — None: список отдается целиком; с курсором без limit — PAGE_SIZE_DEFAULT.
+    """
+    if limit is None and not cursor:
+        return None
+    return min(limit or PAGE_SIZE_DEFAULT, PAGE_SIZE_MAX)
+
+
+def _after(key_columns: list, values: list):
+    """
+    Условие «строго после курсора» при сортировке по убыванию.
+    Строки с created_at IS NULL при DESC идут первыми (NULLS FIRST в Postgres), после них — остальные.
+    """
+    if len(key_columns) == 1:
+        return key_columns[0] < values[0]
+    created_at, row_id = key_columns
+    if values[0] is None:
+        return or_(and_(created_at.is_(None), row_id < values[1]), created_at.isnot(None))
+    # Сравнение кортежей с NULL не выполняется, так что строки без created_at сюда не попадут
+    return tuple_(*key_columns) < tuple_(*values)
+
+
+def keyset_page(query, key_columns: list, cursor: str = None, limit: int = PAGE_SIZE_DEFAULT):
+    """
+    Добавляет к запросу keyset-условие, сортировку по ключу (от новых к старым) и LIMIT limit + 1.
+    Лишняя строка показывает, есть ли следующая страница. limit=None без курсора — запрос без изменений.
+    """
+    if limit is None and not cursor:
+        return query
+    if cursor:
+        query = query.filter(_after(key_columns, decode_cursor(cursor, len(key_columns))))
+
+    return query.order_by(*[column.desc() for column in key_columns]).limit(page_limit(cursor, limit) + 1)
+
+
+def split_page(rows: list, limit: int, key_names: list):
+    """
+    Отрезает лишнюю строку и строит курсор следующей страницы.
+    limit=None (выдача целиком) — все строки без курсора.
+
+    :return: (строки страницы, курсор или None)
+    """
+    if limit is None:
+        return rows, None
+    limit = min(limit, PAGE_SIZE_MAX)
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor([getattr(last, name) for name in key_names])
@@ -0,0 +1,237 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import time
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.database import get_db
+from app.services.ledger_operation import LedgerOperation
+
+# Логирование
+logger = logging.getLogger(__name__)
+
+# Секрет IPN из кабинета NOWPayments; без него уведомления не принимаются
+NOWPAYMENTS_IPN_SECRET = os.getenv("NOWPAYMENTS_IPN_SECRET")
+
+PAYMENT_CONSUMER_WORKERS = int(os.getenv("PAYMENT_CONSUMER_WORKERS", 2))  # Параллельных обработчиков очереди
+PAYMENT_CONSUMER_INTERVAL = float(os.getenv("PAYMENT_CONSUMER_INTERVAL", 5))  # Опрос пустой очереди (сек)
+PAYMENT_EVENT_MAX_ATTEMPTS = int(os.getenv("PAYMENT_EVENT_MAX_ATTEMPTS", 10))  # После этого событие — failed
+PAYMENT_EVENT_RETRY_DELAY = float(os.getenv("PAYMENT_EVENT_RETRY_DELAY", 30))  # База задержки повтора (сек)
+
+# Статус, после которого средства зачисляются; остальные только обновляют статус платежа
+CREDIT_STATUS = "finished"
+
+_ENQUEUE_EVENT = text("""
+    INSERT INTO payment_events (event_key, external_payment_id, payment_status, payload)
+    VALUES (:event_key, :external_payment_id, :payment_status, CAST(:payload AS JSONB))
+    ON CONFLICT (event_key) DO NOTHING
+    RETURNING id
+""")
+
+_CLAIM_EVENT = text("""
+    SELECT id, external_payment_id, payment_status, attempts
+    FROM payment_events
+    WHERE status = 'pending' AND available_at <= now()
+    ORDER BY available_at, id
+    LIMIT 1
+    FOR UPDATE SKIP LOCKED
+""")
+
+# Завершенный платеж не откатывается запоздавшим промежуточным статусом
+_UPDATE_PAYMENT_STATUS = text("""
+    UPDATE payments
+    SET status = CASE WHEN status = :credit_status THEN status ELSE :payment_status END,
+        updated_at = now()
+    WHERE external_payment_id = :external_payment_id
+    RETURNING id
+""")
+
+# Зачисление ровно один раз на payment_id: строку забирает только первая транзакция
+_MARK_CREDITED = text("""
+    UPDATE payments
+    SET credited_at = now()
+    WHERE external_payment_id = :external_payment_id AND credited_at IS NULL
+    RETURNING user_id, amount
+""")
+
+_MARK_DONE = text("""
+    UPDATE payment_events
+    SET status = 'done', attempts = attempts + 1, processed_at = now(), last_error = NULL
+    WHERE id = :id
+""")
+
+
+def canonical_ipn_body(payload: dict) -> str:
+    """Тело IPN в виде, который подписывает NOWPayments: ключи отсортированы, без пробелов"""
+    return json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+
+def verify_ipn_signature(payload: dict, signature: str, secret: str = None) -> bool:
+    """Сверяет HMAC-SHA512 отсортированного тела с заголовком x-nowpayments-sig"""
+    secret = secret or NOWPAYMENTS_IPN_SECRET
+    if not secret or not signature:
+        return False
+    expected = hmac.new(secret.encode(), canonical_ipn_body(payload).encode(), hashlib.sha512).hexdigest()
+    return hmac.compare_digest(expected, signature.lower())
+
+
+async def enqueue_ipn_event(db: AsyncSession, payload: dict) -> bool:
+    """
+    Сохраняет уведомление в очередь payment_events.
+    Повтор того же статуса того же платежа игнорируется (ON CONFLICT по event_key).
+
+    :return: True — событие новое, False — дубликат
+    """
+    external_payment_id = str(payload["payment_id"])
+    payment_status = str(payload["payment_status"])
+    result = await db.execute(_ENQUEUE_EVENT, {
+        "event_key": f"{external_payment_id}:{payment_status}",
+        "external_payment_id": external_payment_id,
+        "payment_status": payment_status,
+        "payload": json.dumps(payload),
+    })
+    await db.commit()
+    return result.first() is not None
+
+
+class PaymentEventConsumer:
+    """
+    Фоновая обработка payment_events. Каждое событие забирается FOR UPDATE SKIP LOCKED
+    и обрабатывается одной транзакцией вместе с зачислением, поэтому несколько воркеров
+    и процессов не мешают друг другу, а сбой посреди обработки просто вернет событие в очередь.
+    """
+
+    def __init__(self, workers: int = PAYMENT_CONSUMER_WORKERS, interval: float = PAYMENT_CONSUMER_INTERVAL):
+        self.workers = workers
+        self.interval = interval
+        self._tasks = []
+        self._wakeup = asyncio.Event()
+
+        # Метрики
+        self.processed = 0
+        self.credited = 0
+        self.credited_amount = 0.0
+        self.retried = 0
+        self.failed = 0
+        self.last_event_ms = 0.0
+
+    def notify(self):
+        """Будит воркеров сразу после приема события, не дожидаясь следующего опроса"""
+        self._wakeup.set()
+
+    async def process_one(self) -> bool:
+        """Обрабатывает одно событие. False — очередь пуста"""
+        async with get_db() as db:
+            event = (await db.execute(_CLAIM_EVENT)).first()
+            if event is None:
+                await db.rollback()
+                return False
+
+            started = time.perf_counter()
+            try:
+                await self._apply(db, event)
+            except Exception as e:
+                await db.rollback()
+                await self._reschedule(db, event, e)
+                return True
+
+            self.processed += 1
+            self.last_event_ms = (time.perf_counter() - started) * 1000
+            return True
+
+    async def _apply(self, db: AsyncSession, event):
+        params = {"external_payment_id": event.external_payment_id}
+        payment = (await db.execute(_UPDATE_PAYMENT_STATUS, {
+            **params, "payment_status": event.payment_status, "credit_status": CREDIT_STATUS,
+        })).first()
+        if payment is None:
+            # Уведомление могло обогнать запись платежа — событие будет повторено
+            raise LookupError(f"Платеж {event.external_payment_id} не найден")
+
+        await db.execute(_MARK_DONE, {"id": event.id})
+
+        credit = None
+        if event.payment_status == CREDIT_STATUS:
+            credit = (await db.execute(_MARK_CREDITED, params)).first()
+
+        if credit is None:
+            await db.commit()
+            return
+
+        # Статусы события и платежа фиксируются тем же COMMIT, что и зачисление
+        await LedgerOperation() \
+            .change(credit.user_id, balance=credit.amount) \
+            .entry(credit.user_id, credit.amount, "deposit") \
+            .execute(db)
+
+        self.credited += 1
+        self.credited_amount += credit.amount
+        logger.info(f"Зачислен платеж {event.external_payment_id}: {credit.amount} пользователю {credit.user_id}")
+
+    async def _reschedule(self, db: AsyncSession, event, error: Exception):
+        """Возвращает событие в очередь с растущей задержкой или помечает failed после лимита попыток"""
+        attempts = event.attempts + 1
+        final = attempts >= PAYMENT_EVENT_MAX_ATTEMPTS
+        await db.execute(text("""
+            UPDATE payment_events
+            SET status = :status, attempts = :attempts, last_error = :error,
+                available_at = now() + make_interval(secs => :delay)
+            WHERE id = :id
+        """), {
+            "id": event.id, "status": "failed" if final else "pending", "attempts": attempts,
+            "error": str(error)[:1000], "delay": PAYMENT_EVENT_RETRY_DELAY * 2 ** min(attempts - 1, 6),
+        })
+        await db.commit()
+
+        if final:
+            self.failed += 1
+            logger.error(f"Событие платежа {event.id} не обработано за {attempts} попыток: {error}")
+        else:
+            self.retried += 1
+            logger.warning(f"Событие платежа {event.id} будет повторено: {error}")
+
+    async def _run(self):
+        while True:
+            try:
+                while await self.process_one():
+                    pass
+            except Exception as e:
+                logger.error(f"Ошибка обработки очереди платежей: {e}")
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+
+    def stats(self) -> dict:
+        return {
+            "workers": len(self._tasks),
+            "processed": self.processed,
+            "credited": self.credited,
+            "credited_amount": round(self.credited_amount, 2),
+            "retried": self.retried,
+            "failed": self.failed,
+            "last_event_ms": round(self.last_event_ms, 2),
+        }
+
+
+# Единый потребитель на процесс
+payment_consumer = PaymentEventConsumer()
@@ -0,0 +1,92 @@
+import logging
+import time
+from sqlalchemy import exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from app.services.metrics import DB_POOL_WAIT, registry
+
+# Логирование
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограммы ожидания соединения, в миллисекундах
+WAIT_BUCKETS_MS = (1, 5, 10, 50, 100, 250, 500, 1000, 5000)
+
+
+class PoolStats:
+    """Счетчики пула соединений: ожидание выдачи, переполнение и таймауты"""
+
+    def __init__(self):
+        self.pool = None
+        self.checkouts = 0
+        self.overflow_events = 0
+        self.timeouts = 0
+        self.wait_total_ms = 0.0
+        self.wait_max_ms = 0.0
+        self.wait_buckets = [0] * (len(WAIT_BUCKETS_MS) + 1)
+
+    def observe_wait(self, wait_ms: float):
+        DB_POOL_WAIT.observe(wait_ms / 1000)
+        self.checkouts += 1
+        self.wait_total_ms += wait_ms
+        self.wait_max_ms = max(self.wait_max_ms, wait_ms)
+        for index, bound in enumerate(WAIT_BUCKETS_MS):
+            if wait_ms <= bound:
+                self.wait_buckets[index] += 1
+                return
+        self.wait_buckets[-1] += 1
+
+    def stats(self) -> dict:
+        pool = self.pool
+        histogram = {f"le_{bound}ms": count for bound, count in zip(WAIT_BUCKETS_MS, self.wait_buckets)}
+        histogram["le_inf"] = self.wait_buckets[-1]
+        return {
+            "size": pool.size() if pool else None,
+            "checked_out": pool.checkedout() if pool else None,
+            "idle": pool.checkedin() if pool else None,
+            "overflow": pool.overflow() if pool else None,
+            "checkouts": self.checkouts,
+            "overflow_events": self.overflow_events,
+            "timeouts": self.timeouts,
+            "wait_avg_ms": round(self.wait_total_ms / self.checkouts, 3) if self.checkouts else 0.0,
+            "wait_max_ms": round(self.wait_max_ms, 3),
+            "wait_histogram": histogram,
+        }
+
+
+# Единые счетчики на процесс
+pool_stats = PoolStats()
+
+registry.gauge("db_pool_checked_out", "Занятые соединения пула",
+               callback=lambda: pool_stats.pool.checkedout() if pool_stats.pool else None)
+registry.gauge("db_pool_overflow", "Соединения сверх pool_size",
+               callback=lambda: pool_stats.pool.overflow() if pool_stats.pool else None)
+# Накопительные значения — счетчики, чтобы rate()/increase() учитывали сброс при перезапуске
+registry.counter("db_pool_overflow_events_total", "Сколько раз пул открывал соединение сверх pool_size",
+                 callback=lambda: pool_stats.overflow_events)
+registry.counter("db_pool_timeouts_total", "Таймауты ожидания соединения",
+                 callback=lambda: pool_stats.timeouts)
+
+
+class InstrumentedAsyncPool(AsyncAdaptedQueuePool):
+    """
+    Пул asyncpg-соединений, который замеряет время ожидания выдачи соединения.
+    Ожидание дольше нескольких миллисекунд означает, что пул исчерпан.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        pool_stats.pool = self
+
+    def _do_get(self):
+        overflow_before = self.overflow()
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            pool_stats.timeouts += 1
+            logger.warning(f"Пул соединений исчерпан: ожидание дольше {self._timeout} с, занято {self.checkedout()}")
+            raise
+
+        pool_stats.observe_wait((time.perf_counter() - started) * 1000)
+        if self.overflow() > overflow_before and self.overflow() > 0:
+            pool_stats.overflow_events += 1
+        return connection
@@ -0,0 +1,53 @@
+import logging
+import os
+
+# Логирование
+logger = logging.getLogger(__name__)
+
+# Сколько SQL-запросов допускается на HTTP-запрос, если маршрут не объявил свой бюджет
+QUERY_BUDGET = int(os.getenv("QUERY_BUDGET", 20))
+# Один и тот же запрос N раз за HTTP-запрос — признак N+1 (запрос в цикле)
+QUERY_REPEAT_THRESHOLD = int(os.getenv("QUERY_REPEAT_THRESHOLD", 5))
+# Строгий режим для тестов: превышение бюджета или N+1 превращается в ответ 500
+QUERY_BUDGET_STRICT = os.getenv("QUERY_BUDGET_STRICT", "0") == "1"
+
+
+def query_budget(max_queries: int):
+    """
+    Объявляет бюджет SQL-запросов маршрута. Ставится под декоратором роутера:
+
+        @router.post("/join")
+        @query_budget(6)
+        async def join_signal(...):
+    """
+    def decorator(endpoint):
+        endpoint.__query_budget__ = max_queries
+        return endpoint
+    return decorator
+
+
+def route_budget(route) -> int:
+    endpoint = getattr(route, "endpoint", None)
+    return getattr(endpoint, "__query_budget__", QUERY_BUDGET)
+
+
+def find_violations(route_path: str, budget: int, stats) -> list:
+    """Нарушения бюджета: превышение количества запросов и повторяющиеся запросы"""
+    violations = []
+    if stats.count > budget:
+        violations.append(f"{route_path}: {stats.count} SQL-запросов при бюджете {budget}")
+
+    for statement, count in stats.statements.items():
+        if count >= QUERY_REPEAT_THRESHOLD:
+            violations.append(
+                f"{route_path}: запрос выполнен {count} раз (возможен N+1): {' '.join(statement.split())[:200]}"
+            )
+    return violations
+
+
+def server_timing(stats, total_seconds: float) -> str:
+    """Значение заголовка Server-Timing: время БД с количеством запросов и общее время"""
+    return (
+        f'db;dur={stats.duration * 1000:.1f};desc="{stats.count} queries", '
+        f"app;dur={total_seconds * 1000:.1f}"
+    )
@@ -0,0 +1,310 @@
+import logging
+import os
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# Логирование
+logger = logging.getLogger(__name__)
+
+# Ограничения для дерева рефералов
+REFERRAL_TREE_MAX_DEPTH = int(os.getenv("REFERRAL_TREE_MAX_DEPTH", 50))
+REFERRAL_TREE_MAX_NODES = int(os.getenv("REFERRAL_TREE_MAX_NODES", 50000))
+
+# Реферальный бонус по уровням: доля прибыли приглашенного для 1-го, 2-го, ... уровня рефереров
+REFERRAL_BONUS_LEVELS = [
+    float(percent) for percent in os.getenv("REFERRAL_BONUS_LEVELS", "0.01").split(",") if percent.strip()
+]
+
+REFERRAL_FIELDS = ("id", "user_id", "telegram_id", "referral_link", "invited_count", "referrer_id", "referred_by")
+
+# Всё дерево одним рекурсивным запросом.
+# Дети узла — записи, у которых referrer_id (telegram_id реферера) равен telegram_id узла.
+# LATERAL ... LIMIT ограничивает число детей у каждого узла, path защищает от циклов.
+_REFERRAL_TREE = text("""
+    WITH RECURSIVE tree AS (
+        SELECT r.id, r.user_id, r.telegram_id, r.referral_link, r.invited_count, r.referrer_id, r.referred_by,
+               1 AS depth, ARRAY[CAST(:root AS BIGINT), r.telegram_id] AS path
+        FROM (
+            SELECT * FROM referrals WHERE referrer_id = :root ORDER BY id LIMIT :max_fanout
+        ) AS r
+        UNION ALL
+        SELECT c.id, c.user_id, c.telegram_id, c.referral_link, c.invited_count, c.referrer_id, c.referred_by,
+               t.depth + 1, t.path || c.telegram_id
+        FROM tree AS t
+        CROSS JOIN LATERAL (
+            SELECT * FROM referrals AS ch
+            WHERE ch.referrer_id = t.telegram_id
+            ORDER BY ch.id
+            LIMIT :max_fanout
+        ) AS c
+        WHERE t.depth < :max_depth AND NOT c.telegram_id = ANY(t.path)
+    )
+    SELECT id, user_id, telegram_id, referral_link, invited_count, referrer_id, referred_by, depth
+    FROM tree
+    ORDER BY depth, id
+    LIMIT :max_nodes
+""")
+
+
+def referral_to_dict(referral) -> dict:
+    return {field: getattr(referral, field) for field in REFERRAL_FIELDS}
+
+
+async def fetch_referral_rows(db: AsyncSession, root_telegram_id: int, max_depth: int, max_fanout: int,
+                              max_nodes: int = REFERRAL_TREE_MAX_NODES) -> list:
+    """Возвращает всех потомков root_telegram_id (по уровням) одним запросом"""
+    result = await db.execute(_REFERRAL_TREE, {
+        "root": root_telegram_id,
+        "max_depth": min(max_depth, REFERRAL_TREE_MAX_DEPTH),
+        "max_fanout": max_fanout,
+        "max_nodes": min(max_nodes, REFERRAL_TREE_MAX_NODES),
+    })
+    return result.all()
+
+
+def build_referral_tree(root, rows) -> dict:
+    """
+    Собирает вложенное дерево за один проход.
+    Строки отсортированы по глубине, поэтому родитель всегда встречается раньше детей.
+    """
+    tree = referral_to_dict(root)
+    tree["invited_users"] = []
+    nodes = {root.telegram_id: tree}
+
+    for row in rows:
+        node = referral_to_dict(row)
+        node["invited_users"] = []
+        parent = nodes.get(row.referrer_id)
+        if parent is None:
+            # Родитель отсечен лимитом строк — пропускаем поддерево
+            continue
+        parent["invited_users"].append(node)
+        nodes.setdefault(row.telegram_id, node)
+
+    return tree
+
+
+def build_flat_referral_list(rows) -> list:
+    """Плоский список потомков с глубиной — для больших деревьев"""
+    return [{**referral_to_dict(row), "depth": row.depth} for row in rows]
+
+
+# --- Таблица замыкания referral_closure ---
+
+_INSERT_SELF = text("""
+    INSERT INTO referral_closure (ancestor_id, descendant_id, depth)
+    VALUES (:telegram_id, :telegram_id, 0)
+    ON CONFLICT DO NOTHING
+""")
+
+# Все предки родителя становятся предками всего поддерева ребенка
+_LINK_SUBTREE = text("""
+    INSERT INTO referral_closure (ancestor_id, descendant_id, depth)
+    SELECT a.ancestor_id, d.descendant_id, a.depth + d.depth + 1
+    FROM referral_closure AS a
+    CROSS JOIN referral_closure AS d
+    WHERE a.descendant_id = :parent
+      AND d.ancestor_id = :child
+    ON CONFLICT DO NOTHING
+""")
+
+# При смене реферера поддерево ребенка отвязывается от всех его прежних предков
+_UNLINK_SUBTREE = text("""
+    DELETE FROM referral_closure AS x
+    USING referral_closure AS d, referral_closure AS a
+    WHERE d.ancestor_id = :child
+      AND a.descendant_id = :child AND a.depth > 0
+      AND x.descendant_id = d.descendant_id
+      AND x.ancestor_id = a.ancestor_id
+""")
+
+# Реферер в старых записях хранился по-разному: в referred_by (users.id) и/или в referrer_id.
+# Источник истины — referred_by (внешний ключ на users.id); referrer_id приводится к telegram_id того же пользователя.
+_NORMALIZE_REFERRER_ID = text("""
+    UPDATE referrals AS r
+    SET referrer_id = u.telegram_id
+    FROM users AS u
+    WHERE u.id = r.referred_by AND r.referrer_id IS DISTINCT FROM u.telegram_id
+""")
+
+_NORMALIZE_REFERRED_BY = text("""
+    UPDATE referrals AS r
+    SET referred_by = u.id
+    FROM users AS u
+    WHERE r.referred_by IS NULL AND u.telegram_id = r.referrer_id
+""")
+
+# Заполнение по существующим записям referrals (подъем по referrer_id — telegram_id реферера)
+_BACKFILL = text("""
+    INSERT INTO referral_closure (ancestor_id, descendant_id, depth)
+    WITH RECURSIVE chain AS (
+        SELECT telegram_id AS ancestor_id, telegram_id AS descendant_id, 0 AS depth, ARRAY[telegram_id] AS path
+        FROM referrals
+        UNION ALL
+        SELECT r.referrer_id, c.descendant_id, c.depth + 1, c.path || r.referrer_id
+        FROM chain AS c
+        JOIN referrals AS r ON r.telegram_id = c.ancestor_id
+        WHERE r.referrer_id IS NOT NULL AND NOT r.referrer_id = ANY(c.path)
+    )
+    SELECT ancestor_id, descendant_id, MIN(depth)
+    FROM chain
+    GROUP BY ancestor_id, descendant_id
+    ON CONFLICT DO NOTHING
+""")
+
+
+async def add_closure_node(db: AsyncSession, telegram_id: int):
+    """Добавляет пользователя в таблицу замыкания (без коммита)"""
+    await db.execute(_INSERT_SELF, {"telegram_id": telegram_id})
+
+
+async def link_referral_closure(db: AsyncSession, child_telegram_id: int, parent_telegram_id: int):
+    """
+    Привязывает поддерево child к parent в таблице замыкания (без коммита —
+    изменения попадают в транзакцию вызывающего вместе с самой записью referrals).
+    Прежние предки поддерева удаляются; связь, образующая цикл, не создается.
+    """
+    if child_telegram_id is None or parent_telegram_id is None or child_telegram_id == parent_telegram_id:
+        return
+    await db.execute(_INSERT_SELF, {"telegram_id": child_telegram_id})
+    await db.execute(_INSERT_SELF, {"telegram_id": parent_telegram_id})
+    if await is_upstream(db, child_telegram_id, parent_telegram_id):
+        logger.warning(f"Связь {child_telegram_id} -> {parent_telegram_id} образует цикл и не добавлена")
+        return
+    await db.execute(_UNLINK_SUBTREE, {"child": child_telegram_id})
+    await db.execute(_LINK_SUBTREE, {"child": child_telegram_id, "parent": parent_telegram_id})
+
+
+async def backfill_referral_closure(db: AsyncSession) -> int:
+    """
+    Приводит реферера в referrals к одному ключу и заполняет таблицу замыкания.
+    Если ключи пришлось исправлять, таблица, построенная по старым значениям, пересобирается.
+    Возвращает количество добавленных строк.
+    """
+    normalized = (await db.execute(_NORMALIZE_REFERRER_ID)).rowcount
+    normalized += (await db.execute(_NORMALIZE_REFERRED_BY)).rowcount
+    if normalized:
+        logger.info(f"Исправлен ключ реферера в {normalized} записях referrals, таблица замыкания пересобирается")
+        await db.execute(text("DELETE FROM referral_closure"))
+    else:
+        result = await db.execute(text("SELECT EXISTS (SELECT 1 FROM referral_closure)"))
+        if result.scalar():
+            await db.commit()
+            return 0
+
+    result = await db.execute(_BACKFILL)
+    await db.commit()
+    logger.info(f"Таблица referral_closure заполнена: {result.rowcount} строк")
+    return result.rowcount
+
+
+async def is_upstream(db: AsyncSession, ancestor_telegram_id: int, descendant_telegram_id: int) -> bool:
+    """Находится ли ancestor выше descendant в реферальном дереве"""
+    result = await db.execute(
+        text("""
+            SELECT EXISTS (
+                SELECT 1 FROM referral_closure
+                WHERE ancestor_id = :ancestor AND descendant_id = :descendant AND depth > 0
+            )
+        """),
+        {"ancestor": ancestor_telegram_id, "descendant": descendant_telegram_id},
+    )
+    return bool(result.scalar())
+
+
+async def get_ancestors(db: AsyncSession, telegram_id: int, max_depth: int = None) -> list:
+    """Цепочка рефереров пользователя от ближайшего к дальнему"""
+    result = await db.execute(
+        text("""
+            SELECT ancestor_id AS telegram_id, depth
+            FROM referral_closure
+            WHERE descendant_id = :telegram_id AND depth > 0
+              AND (CAST(:max_depth AS INTEGER) IS NULL OR depth <= :max_depth)
+            ORDER BY depth
+        """),
+        {"telegram_id": telegram_id, "max_depth": max_depth},
+    )
+    return [{"telegram_id": row.telegram_id, "depth": row.depth} for row in result.all()]
+
+
+async def get_downline_summary(db: AsyncSession, telegram_id: int) -> dict:
+    """Размер нижней линии, разбивка по уровням и сумма заработка поддерева"""
+    result = await db.execute(
+        text("""
+            SELECT c.depth, COUNT(*) AS members, COALESCE(SUM(b.earned_balance), 0) AS earned
+            FROM referral_closure AS c
+            LEFT JOIN users AS u ON u.telegram_id = c.descendant_id
+            LEFT JOIN balances AS b ON b.user_id = u.id
+            WHERE c.ancestor_id = :telegram_id AND c.depth > 0
+            GROUP BY c.depth
+            ORDER BY c.depth
+        """),
+        {"telegram_id": telegram_id},
+    )
+    levels = [{"depth": row.depth, "members": row.members, "earned": row.earned} for row in result.all()]
+    return {
+        "downline_size": sum(level["members"] for level in levels),
+        "downline_earned": sum(level["earned"] for level in levels),
+        "levels": levels,
+    }
+
+
+# --- Реферальные бонусы ---
+
+# Один запрос: прибыль по приглашенным -> рефереры по таблице замыкания (depth = уровень)
+# -> начисление на balance одним UPDATE -> записи журнала из RETURNING.
+# Возвращает новые значения балансов рефереров (для кэша балансов).
+_DISTRIBUTE_BONUSES = text("""
+    WITH earned AS (
+        SELECT e.user_id, e.profit
+        FROM unnest(CAST(:user_ids AS INTEGER[]), CAST(:profits AS FLOAT8[])) AS e(user_id, profit)
+        WHERE e.profit > 0
+    ),
+    bonus AS (
+        SELECT ru.id AS user_id, SUM(e.profit * lvl.percent) AS amount
+        FROM earned AS e
+        JOIN users AS u ON u.id = e.user_id
+        JOIN referral_closure AS c ON c.descendant_id = u.telegram_id AND c.depth BETWEEN 1 AND :levels
+        JOIN unnest(CAST(:percents AS FLOAT8[])) WITH ORDINALITY AS lvl(percent, depth) ON lvl.depth = c.depth
+        JOIN users AS ru ON ru.telegram_id = c.ancestor_id
+        GROUP BY ru.id
+    ),
+    credited AS (
+        UPDATE balances AS b
+        SET balance = b.balance + bonus.amount,
+            version = b.version + 1
+        FROM bonus
+        WHERE b.user_id = bonus.user_id AND bonus.amount > 0
+        RETURNING b.user_id, bonus.amount, b.balance, b.trade_balance, b.frozen_balance, b.earned_balance, b.version
+    ),
+    ledger AS (
+        INSERT INTO transactions (user_id, amount, transaction_type, created_at)
+        SELECT user_id, amount, 'referral_bonus', now()
+        FROM credited
+    )
+    SELECT user_id, balance, trade_balance, frozen_balance, earned_balance, version
+    FROM credited
+""")
+
+
+async def distribute_referral_bonuses(db: AsyncSession, user_ids: list, profits: list,
+                                      levels: list = None) -> list:
+    """
+    Начисляет реферальные бонусы сразу за пачку приглашенных (без коммита).
+
+    :param user_ids: users.id приглашенных
+    :param profits: Заработанная прибыль каждого приглашенного
+    :param levels: Доли бонуса по уровням (по умолчанию REFERRAL_BONUS_LEVELS)
+    :return: Новые значения балансов рефереров, получивших бонус
+    """
+    levels = REFERRAL_BONUS_LEVELS if levels is None else levels
+    if not user_ids or not levels:
+        return []
+
+    result = await db.execute(_DISTRIBUTE_BONUSES, {
+        "user_ids": list(user_ids),
+        "profits": list(profits),
+        "percents": levels,
+        "levels": len(levels),
+    })
+    return result.all()
@@ -0,0 +1,113 @@
+import logging
+import os
+import re
+from sqlalchemy import text
+from sqlalchemy.schema import CreateIndex
+from app.database import engine
+from app.models.models import Base
+from app.services.token_reaper import AUTH_TOKENS_PARTITIONED
+
+# Логирование
+logger = logging.getLogger(__name__)
+
+# Досоздавать недостающие индексы на существующих таблицах (CREATE INDEX CONCURRENTLY)
+SCHEMA_BUILD_INDEXES = os.getenv("SCHEMA_BUILD_INDEXES", "1") == "1"
+
+# Колонки, добавленные в модели после создания таблиц
+_ADD_COLUMNS = (
+    "ALTER TABLE balances ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0",
+)
+
+# Приведение старых данных к текущим единицам (повторный запуск ничего не меняет)
+_MIGRATE_DATA = (
+    # burn_chance хранится долей 0..1; create_random раньше писал проценты 1-10
+    "UPDATE signals SET burn_chance = burn_chance / 100 WHERE burn_chance > 1",
+)
+
+# Партиционированная auth_tokens (AUTH_TOKENS_PARTITIONED=1): уникальность токена — вместе с ключом партиции.
+# Партиция DEFAULT принимает строки, для дня которых партиция еще не создана.
+_AUTH_TOKENS_PARTITIONED_DDL = (
+    """
+    CREATE TABLE IF NOT EXISTS auth_tokens (
+        id SERIAL,
+        token VARCHAR NOT NULL,
+        user_id BIGINT NOT NULL REFERENCES users (telegram_id) ON DELETE CASCADE,
+        expires_at TIMESTAMPTZ NOT NULL,
+        created_at TIMESTAMPTZ,
+        PRIMARY KEY (id, expires_at),
+        UNIQUE (token, expires_at)
+    ) PARTITION BY RANGE (expires_at)
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_auth_tokens_expires_at ON auth_tokens (expires_at)",
+    "CREATE TABLE IF NOT EXISTS auth_tokens_default PARTITION OF auth_tokens DEFAULT",
+)
+
+_LIST_INDEXES = text("""
+    SELECT c.relname AS name, i.indisvalid AS valid
+    FROM pg_index AS i
+    JOIN pg_class AS c ON c.oid = i.indexrelid
+    JOIN pg_namespace AS n ON n.oid = c.relnamespace
+    WHERE n.nspname = current_schema()
+""")
+
+_CREATE_INDEX = re.compile(r"^CREATE (UNIQUE )?INDEX ")
+
+
+def _schema_tables():
+    """Таблицы, которыми управляет create_all; партиционированная auth_tokens создается отдельным DDL"""
+    return [
+        table for table in Base.metadata.sorted_tables
+        if not (AUTH_TOKENS_PARTITIONED and table.name == "auth_tokens")
+    ]
+
+
+async def _ensure_partitioned_auth_tokens(conn):
+    await conn.execute(text(_AUTH_TOKENS_PARTITIONED_DDL[0]))
+    relkind = (await conn.execute(text("SELECT relkind FROM pg_class WHERE oid = 'auth_tokens'::regclass"))).scalar()
+    if relkind != "p":
+        # Обычную таблицу нужно перенести в партиционированную вручную — автоматически данные не трогаем
+        logger.error("AUTH_TOKENS_PARTITIONED=1, но auth_tokens — обычная таблица; партиции не создаются")
+        return
+    for statement in _AUTH_TOKENS_PARTITIONED_DDL[1:]:
+        await conn.execute(text(statement))
+
+
+async def _create_missing_indexes():
+    """
+    Досоздает объявленные в моделях индексы существующих таблиц.
+    Индексы строятся CONCURRENTLY вне транзакции, чтобы не блокировать запись в большие таблицы;
+    недостроенный (INVALID) после прерванной попытки индекс пересоздается.
+    """
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        existing = {row.name: row.valid for row in (await conn.execute(_LIST_INDEXES)).all()}
+
+        for table in _schema_tables():
+            for index in table.indexes:
+                if existing.get(index.name):
+                    continue
+                if index.name in existing:
+                    await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {index.name}"))
+
+                ddl = str(CreateIndex(index, if_not_exists=True).compile(dialect=engine.dialect))
+                logger.info(f"Создается индекс {index.name} на {table.name}")
+                await conn.execute(text(_CREATE_INDEX.sub(r"CREATE \1INDEX CONCURRENTLY ", ddl, count=1)))
+
+
+async def ensure_schema():
+    """
+    Создает недостающие таблицы и индексы при старте.
+    Колонки существующих таблиц не изменяются (create_all с checkfirst),
+    кроме перечисленных в _ADD_COLUMNS; данные приводятся по _MIGRATE_DATA;
+    недостающие индексы досоздаются CONCURRENTLY.
+    """
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all, tables=_schema_tables())
+        if AUTH_TOKENS_PARTITIONED:
+            await _ensure_partitioned_auth_tokens(conn)
+        for statement in _ADD_COLUMNS + _MIGRATE_DATA:
+            await conn.execute(text(statement))
+
+    if SCHEMA_BUILD_INDEXES:
+        await _create_missing_indexes()
+    logger.info("Схема БД проверена")
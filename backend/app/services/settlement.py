@@ -0,0 +1,231 @@
+import logging
+import os
+import random
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.services.referrals import distribute_referral_bonuses
+from app.services.balance_cache import balance_cache, publish_balance_versions
+from app.services.metrics import SETTLEMENT_DURATION, SETTLEMENT_PAYOUT_LAG, SETTLEMENT_ROWS
+
+# Логирование
+logger = logging.getLogger(__name__)
+
+# Сколько сигналов рассчитываем в одной транзакции
+SETTLEMENT_BATCH_SIZE = int(os.getenv("SETTLEMENT_BATCH_SIZE", 100))
+
+
+def normalize_profit_rate(profit_percent: float) -> float:
+    """
+    Приводит profit_percent сигнала к доле прибыли.
+    Сигналы создаются в двух форматах: множитель (1.05 = +5%, create_random/create_custom)
+    и доля (0.03 = +3%, статичные сигналы).
+    """
+    if profit_percent is None:
+        return 0.0
+    return profit_percent - 1 if profit_percent >= 1 else profit_percent
+
+
+def normalize_burn_chance(burn_chance: float) -> float:
+    """
+    burn_chance хранится как вероятность 0..1 (create_signal принимает только ее,
+    старые записи в процентах переводит ensure_schema). Здесь только защита от NULL и выхода за границы.
+    """
+    if burn_chance is None:
+        return 0.0
+    return min(max(burn_chance, 0.0), 1.0)
+
+
+# Выбираем пачку истекших сигналов и блокируем их, чтобы параллельный воркер их не взял
+_SELECT_DUE_SIGNALS = text("""
+    SELECT id, burn_chance, profit_percent, expires_at
+    FROM signals
+    WHERE expires_at <= :now AND is_successful IS NULL
+    ORDER BY expires_at
+    LIMIT :limit
+    FOR UPDATE SKIP LOCKED
+""")
+
+# Проставляем profit каждой инвестиции (для сгоревших — минус сумма)
+_UPDATE_INVESTMENTS = text("""
+    UPDATE signal_investments AS si
+    SET profit = CASE WHEN o.success THEN si.amount * o.rate ELSE -si.amount END
+    FROM unnest(CAST(:ids AS INTEGER[]), CAST(:success AS BOOLEAN[]), CAST(:rates AS FLOAT8[]))
+        AS o(signal_id, success, rate)
+    WHERE si.signal_id = o.signal_id
+""")
+
+# Агрегируем выплаты по пользователям и применяем одним UPDATE.
+# Дельты совпадают с прежней пошаговой логикой:
+#   успех  — trade_balance += amount + profit, earned_balance += profit, balance += profit;
+#   всегда — разморозка amount (frozen_balance -> balance), но не больше, чем реально заморожено.
+_UPDATE_BALANCES = text("""
+    UPDATE balances AS b
+    SET trade_balance = b.trade_balance + d.trade_delta,
+        earned_balance = b.earned_balance + d.earned_delta,
+        balance = b.balance + d.earned_delta + LEAST(d.unfreeze, b.frozen_balance),
+        frozen_balance = b.frozen_balance - LEAST(d.unfreeze, b.frozen_balance),
+        version = b.version + 1
+    FROM (
+        SELECT si.user_id,
+               SUM(CASE WHEN o.success THEN si.amount + si.profit ELSE 0 END) AS trade_delta,
+               SUM(CASE WHEN o.success THEN si.profit ELSE 0 END) AS earned_delta,
+               SUM(si.amount) AS unfreeze
+        FROM signal_investments AS si
+        JOIN unnest(CAST(:ids AS INTEGER[]), CAST(:success AS BOOLEAN[])) AS o(signal_id, success)
+            ON si.signal_id = o.signal_id
+        GROUP BY si.user_id
+    ) AS d
+    WHERE b.user_id = d.user_id
+    RETURNING b.user_id, b.balance, b.trade_balance, b.frozen_balance, b.earned_balance, b.version
+""")
+
+# Журнал операций: те же типы записей, что писали update_trading_balance и unfreeze_balance
+_INSERT_LEDGER = text("""
+    INSERT INTO transactions (user_id, amount, transaction_type, created_at)
+    SELECT si.user_id, si.amount + si.profit, 'trade_balance_update', now()
+    FROM signal_investments AS si
+    WHERE si.signal_id = ANY(CAST(:won_ids AS INTEGER[]))
+    UNION ALL
+    SELECT si.user_id, si.amount, 'unfreeze', now()
+    FROM signal_investments AS si
+    WHERE si.signal_id = ANY(CAST(:ids AS INTEGER[]))
+""")
+
+# Прибыль каждого пользователя по успешным сигналам пачки — база для реферальных бонусов
+_EARNED_BY_USER = text("""
+    SELECT user_id, SUM(profit) AS profit
+    FROM signal_investments
+    WHERE signal_id = ANY(CAST(:won_ids AS INTEGER[])) AND profit > 0
+    GROUP BY user_id
+""")
+
+_UPDATE_SIGNALS = text("""
+    UPDATE signals AS s
+    SET is_successful = o.success
+    FROM unnest(CAST(:ids AS INTEGER[]), CAST(:success AS BOOLEAN[])) AS o(signal_id, success)
+    WHERE s.id = o.signal_id
+""")
+
+
+async def settle_signal_batch(db: AsyncSession, now: datetime, limit: int = SETTLEMENT_BATCH_SIZE,
+                              run_started: float = None) -> dict:
+    """
+    Рассчитывает одну пачку истекших сигналов набором set-based запросов в одной транзакции.
+    Исход и процент прибыли берутся из колонок burn_chance/profit_percent каждого сигнала.
+    run_started — perf_counter() начала прогона, к которому относится now (по умолчанию — начало пачки).
+
+    :return: Отчет о прогоне (количество сигналов, строк и время в мс)
+    """
+    started = time.perf_counter()
+
+    try:
+        result = await db.execute(_SELECT_DUE_SIGNALS, {"now": now, "limit": limit})
+        due = result.all()
+
+        report = {
+            "signals": len(due),
+            "won": 0,
+            "investments": 0,
+            "balances": 0,
+            "transactions": 0,
+            "referral_bonuses": 0,
+            "duration_ms": 0.0,
+        }
+
+        if not due:
+            await db.rollback()
+            report["duration_ms"] = round((time.perf_counter() - started) * 1000, 2)
+            return report
+
+        ids, success, rates = [], [], []
+        for row in due:
+            ids.append(row.id)
+            success.append(random.random() > normalize_burn_chance(row.burn_chance))
+            rates.append(normalize_profit_rate(row.profit_percent))
+        won_ids = [signal_id for signal_id, ok in zip(ids, success) if ok]
+
+        investments = await db.execute(_UPDATE_INVESTMENTS, {"ids": ids, "success": success, "rates": rates})
+        balances = (await db.execute(_UPDATE_BALANCES, {"ids": ids, "success": success})).all()
+        ledger = await db.execute(_INSERT_LEDGER, {"ids": ids, "won_ids": won_ids})
+
+        credited = []
+        if won_ids:
+            earned = (await db.execute(_EARNED_BY_USER, {"won_ids": won_ids})).all()
+            credited = await distribute_referral_bonuses(
+                db, [row.user_id for row in earned], [row.profit for row in earned]
+            )
+
+        await db.execute(_UPDATE_SIGNALS, {"ids": ids, "success": success})
+        await publish_balance_versions(db, balances + credited)
+        await db.commit()
+
+        # Write-through в кэш балансов: версии не дают затереть более новые значения
+        for row in balances + credited:
+            balance_cache.apply_balance(row)
+
+        # Задержка выплаты: от expires_at сигнала до фиксации расчета (в шкале now).
+        # now зафиксирован в начале прогона, поэтому время предыдущих пачек тоже учитывается
+        paid_at = now + timedelta(seconds=time.perf_counter() - (run_started or started))
+        for row in due:
+            expires_at = row.expires_at
+            if expires_at.tzinfo is None and paid_at.tzinfo is not None:
+                expires_at = expires_at.replace(tzinfo=paid_at.tzinfo)
+            SETTLEMENT_PAYOUT_LAG.observe(max((paid_at - expires_at).total_seconds(), 0.0))
+
+        report.update(
+            won=len(won_ids),
+            investments=investments.rowcount,
+            balances=len(balances),
+            transactions=ledger.rowcount,
+            referral_bonuses=len(credited),
+            duration_ms=round((time.perf_counter() - started) * 1000, 2),
+        )
+        return report
+    except Exception:
+        await db.rollback()
+        raise
+
+
+async def settle_expired_signals(db: AsyncSession, now: datetime, batch_size: int = SETTLEMENT_BATCH_SIZE) -> dict:
+    """
+    Рассчитывает все сигналы, истекшие к моменту now, пачками по batch_size.
+
+    :return: Суммарный отчет по всем пачкам
+    """
+    started = time.perf_counter()
+    total = {
+        "batches": 0, "signals": 0, "won": 0, "investments": 0, "balances": 0, "transactions": 0,
+        "referral_bonuses": 0,
+    }
+
+    while True:
+        report = await settle_signal_batch(db, now=now, limit=batch_size, run_started=started)
+        if not report["signals"]:
+            break
+
+        total["batches"] += 1
+        for key in ("signals", "won", "investments", "balances", "transactions", "referral_bonuses"):
+            total[key] += report[key]
+
+        logger.info(
+            f"Пачка сигналов рассчитана: сигналов {report['signals']} (успешных {report['won']}), "
+            f"инвестиций {report['investments']}, балансов {report['balances']}, "
+            f"записей журнала {report['transactions']}, реферальных бонусов {report['referral_bonuses']} "
+            f"за {report['duration_ms']} мс"
+        )
+
+        if report["signals"] < batch_size:
+            break
+
+    total["duration_ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+    SETTLEMENT_DURATION.observe(total["duration_ms"] / 1000)
+    for key in ("signals", "investments", "balances", "transactions", "referral_bonuses"):
+        if total[key]:
+            SETTLEMENT_ROWS.inc(total[key], key)
+
+    if total["signals"]:
+        logger.info(f"Расчет сигналов завершен: {total}")
+    return total
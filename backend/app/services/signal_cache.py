@@ -0,0 +1,117 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy.sql import func
+from app.models.models import Signal
+
+# Логирование
+logger = logging.getLogger(__name__)
+
+# Максимальный возраст снимка — страховка для нескольких воркеров, которые не видят инвалидацию друг друга
+ACTIVE_SIGNALS_CACHE_TTL = int(os.getenv("ACTIVE_SIGNALS_CACHE_TTL", 30))
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """
+    Проверка заголовка If-None-Match: список через запятую, слабые валидаторы W/ и "*".
+    Для If-None-Match сравнение слабое, поэтому префикс W/ не учитывается.
+    """
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+class ActiveSignalsCache:
+    """
+    Снимок списка активных сигналов в памяти процесса.
+    Сбрасывается при создании/расчете сигналов и сам истекает на ближайшем join_until.
+    Сброс во время загрузки повышает поколение: загруженный до него список возвращается, но не кэшируется.
+    """
+
+    def __init__(self, ttl: int = ACTIVE_SIGNALS_CACHE_TTL):
+        self.ttl = ttl
+        self._payload = None
+        self._etag = None
+        self._valid_until = None
+        self._generation = 0
+        self._lock = asyncio.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self):
+        self._generation += 1
+        self._payload = None
+
+    def _fresh(self) -> bool:
+        return self._payload is not None and datetime.now(timezone.utc) < self._valid_until
+
+    async def _load(self, db: AsyncSession):
+        """Читает активные сигналы; возвращает (payload, etag, valid_until)"""
+        now = datetime.now(timezone.utc)
+        result = await db.execute(select(Signal).filter(Signal.join_until > func.now()))
+        active_signals = result.scalars().all()
+
+        if active_signals:
+            payload = {
+                "active_signals": [
+                    {
+                        "signal_id": signal.id,
+                        "name": signal.name,
+                        "join_until": signal.join_until,
+                        "expires_at": signal.expires_at
+                    }
+                    for signal in active_signals
+                ]
+            }
+        else:
+            payload = {"message": "No active signals available."}
+
+        # Снимок устаревает, как только закрывается окно входа у первого из сигналов
+        valid_until = now + timedelta(seconds=self.ttl)
+        if active_signals:
+            valid_until = min(valid_until, min(signal.join_until for signal in active_signals))
+
+        payload = jsonable_encoder(payload)
+        body = json.dumps(payload, sort_keys=True, ensure_ascii=False).encode()
+        return payload, f'"{hashlib.sha1(body).hexdigest()}"', valid_until
+
+    async def get(self, db: AsyncSession):
+        """
+        Возвращает (payload, etag). БД запрашивается только при отсутствии свежего снимка.
+        """
+        if self._fresh():
+            self.hits += 1
+            return self._payload, self._etag
+
+        async with self._lock:
+            # Пока ждали блокировку, снимок мог обновить другой запрос
+            if self._fresh():
+                self.hits += 1
+                return self._payload, self._etag
+
+            self.misses += 1
+            generation = self._generation
+            payload, etag, valid_until = await self._load(db)
+            # invalidate() во время чтения: список мог не увидеть новый сигнал — не сохраняем его
+            if generation == self._generation:
+                self._payload, self._etag, self._valid_until = payload, etag, valid_until
+            return payload, etag
+
+
+# Единый кэш на процесс
+active_signals_cache = ActiveSignalsCache()
@@ -0,0 +1,90 @@
+import asyncio
+import heapq
+import logging
+import os
+from datetime import datetime
+from sqlalchemy import text
+from app.database import get_db
+
+# Логирование
+logger = logging.getLogger(__name__)
+
+# Страховочный обход таблицы signals, даже если в куче нет дедлайнов
+SAFETY_SWEEP_INTERVAL = int(os.getenv("SETTLEMENT_SAFETY_SWEEP", 600))  # 10 минут по умолчанию
+# Пауза перед повтором после ошибки расчета
+RETRY_DELAY = 5
+
+
+class SettlementScheduler:
+    """
+    Планировщик расчета сигналов по дедлайнам.
+    Держит в памяти min-heap из (expires_at, signal_id) и спит ровно до ближайшего дедлайна.
+    """
+
+    def __init__(self, sweep_interval: int = SAFETY_SWEEP_INTERVAL):
+        self.sweep_interval = sweep_interval
+        self._heap = []
+        self._wakeup = asyncio.Event()
+
+    def schedule(self, signal_id: int, expires_at: datetime):
+        """Добавляет дедлайн сигнала и будит цикл, если он стал ближайшим"""
+        if expires_at is None:
+            return
+        is_earliest = not self._heap or expires_at < self._heap[0][0]
+        heapq.heappush(self._heap, (expires_at, signal_id))
+        if is_earliest:
+            self._wakeup.set()
+
+    async def seed(self):
+        """Заполняет кучу нерассчитанными сигналами при старте"""
+        async with get_db() as db:
+            result = await db.execute(
+                text("SELECT id, expires_at FROM signals WHERE is_successful IS NULL AND expires_at IS NOT NULL")
+            )
+            rows = result.all()
+
+        self._heap = [(row.expires_at, row.id) for row in rows]
+        heapq.heapify(self._heap)
+        self._wakeup.set()
+        logger.info(f"Планировщик сигналов: загружено {len(self._heap)} дедлайнов")
+
+    def _seconds_until_next(self, now: datetime) -> float:
+        if not self._heap:
+            return self.sweep_interval
+        delay = (self._heap[0][0] - now).total_seconds()
+        return max(0.0, min(delay, self.sweep_interval))
+
+    def _pop_due(self, now: datetime):
+        while self._heap and self._heap[0][0] <= now:
+            heapq.heappop(self._heap)
+
+    async def run(self, settle, clock):
+        """
+        Основной цикл планировщика.
+
+        :param settle: Корутина, рассчитывающая истекшие сигналы (принимает сессию БД)
+        :param clock: Функция текущего времени в той же шкале, что и expires_at
+        """
+        while True:
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self._seconds_until_next(clock()))
+                # Разбудили новым дедлайном — пересчитываем время сна
+                continue
+            except asyncio.TimeoutError:
+                pass
+
+            now = clock()
+            try:
+                # Пустая куча означает страховочный обход по таймеру
+                async with get_db() as db:
+                    await settle(db)
+                self._pop_due(now)
+            except Exception as e:
+                logger.error(f"Ошибка при обработке сигналов: {e}")
+                # Дедлайны остаются в куче, повторяем попытку с паузой
+                await asyncio.sleep(RETRY_DELAY)
+
+
+# Единый планировщик на процесс
+settlement_scheduler = SettlementScheduler()
@@ -8,8 +8,14 @@ from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from sqlalchemy.orm import joinedload
-from app.models.models import Signal, SignalInvestment, Balance, User
+from app.logging_config import SAMPLED
+from app.models.models import Signal, SignalInvestment, Balance
 from app.services.balances import freeze_balance, unfreeze_balance, update_trading_balance
+from app.services.settlement import settle_expired_signals
+from app.services.referrals import distribute_referral_bonuses
+from app.services.signal_scheduler import settlement_scheduler
+from app.services.signal_cache import active_signals_cache
+from app.services.balance_cache import balance_cache, publish_balance_versions
 
 # Получаем процент прибыли/убытка из .env
 PROFIT_PERCENT = float(os.getenv("PROFIT_PERCENT", 1.01))  # 1% прибыль (1.01 = +1%)
@@ -19,7 +25,8 @@ BURN_CHANCE = float(os.getenv("BURN_CHANCE", 0.1))  # 10% шанс сгоран
 JOIN_TIME = int(os.getenv("JOIN_TIME", 300))  # 300 секунд (5 минут) по умолчанию
 ACTIVE_TIME = int(os.getenv("ACTIVE_TIME", 1800))  # 1800 секунд (30 минут) по умолчанию
 
-logging.getLogger('sqlalchemy.engine').setLevel(logging.WARNING)
+# Режим расчета сигналов: batch — set-based расчет пачками, legacy — старый пошаговый обход инвестиций
+SETTLEMENT_MODE = os.getenv("SETTLEMENT_MODE", "batch")
 
 # Максимально допустимое время для сигналов (10 лет)
 MAX_SECONDS = 10 * 365 * 24 * 60 * 60
@@ -29,11 +36,16 @@ def current_moscow_time():
     return datetime.now(timezone.utc) + timedelta(hours=3)
 
 async def create_signal(db: AsyncSession, name: str, join_time: int, active_time: int, burn_chance: float, profit_percent: float):
-    """Создаёт новый торговый сигнал с корректной обработкой временных зон"""
+    """
+    Создаёт новый торговый сигнал с корректной обработкой временных зон.
+    burn_chance — вероятность сгорания 0..1 (маршруты API принимают проценты и переводят их сами).
+    """
     
     # Ограничиваем максимальные значения, чтобы не выходить за пределы БД
     if join_time > MAX_SECONDS or active_time > MAX_SECONDS:
         raise ValueError("join_time или active_time слишком велики! Максимум — 10 лет.")
+    if not 0 <= burn_chance <= 1:
+        raise ValueError("burn_chance — вероятность от 0 до 1")
         
     try:
         now = current_moscow_time()
@@ -54,6 +66,10 @@ async def create_signal(db: AsyncSession, name: str, join_time: int, active_time
 
         db.add(signal)
         await db.commit()
+
+        # Сообщаем планировщику новый дедлайн расчета и сбрасываем снимок активных сигналов
+        settlement_scheduler.schedule(signal.id, signal.expires_at)
+        active_signals_cache.invalidate()
         return signal
     except Exception as e:
         await db.rollback()
@@ -67,6 +83,7 @@ async def create_static_signals(db: AsyncSession):
         # Удаляем старые сигналы
         await db.execute(text("DELETE FROM signals WHERE name LIKE 'Статичный сигнал%'"))
         await db.commit()
+        active_signals_cache.invalidate()
 
         # Генерация времени для добавления 6 часов
         six_hours_in_seconds = 6 * 60 * 60  # 6 часов = 21600 секунд
@@ -108,9 +125,20 @@ async def create_static_signals(db: AsyncSession):
 async def process_signals(db: AsyncSession):
     """
     Обрабатывает завершенные сигналы, обновляет балансы пользователей.
+    В режиме batch возвращает отчет о прогоне (сигналы, строки, время).
     """
     now = current_moscow_time()
 
+    if SETTLEMENT_MODE == "batch":
+        try:
+            report = await settle_expired_signals(db, now)
+            if report["signals"]:
+                active_signals_cache.invalidate()
+            return report
+        except Exception as e:
+            logging.error(f"Ошибка при обработке сигналов: {e}")
+            raise HTTPException(status_code=500, detail=f"Ошибка при обработке сигналов: {e}")
+
     try:
         result = await db.execute(
             select(Signal)
@@ -136,9 +164,9 @@ async def process_signals(db: AsyncSession):
                     await update_trading_balance(db, user_id, total_earned)
                     await update_earned_balance(db, user_id, profit)
 
-                    logging.info(f"Сигнал {signal.id} УСПЕШЕН. {user_id} получил {total_earned}")
+                    logging.info("Сигнал %s УСПЕШЕН. %s получил %s", signal.id, user_id, total_earned, extra=SAMPLED)
                 else:
-                    logging.info(f"Сигнал {signal.id} СГОРЕЛ. {user_id} потерял {amount}.")
+                    logging.info("Сигнал %s СГОРЕЛ. %s потерял %s.", signal.id, user_id, amount, extra=SAMPLED)
 
                 # Размораживаем средства пользователя
                 await unfreeze_balance(db, user_id, amount)
@@ -151,7 +179,7 @@ async def process_signals(db: AsyncSession):
 
 async def update_earned_balance(db: AsyncSession, user_id: int, earned_amount: float):
     """
-    Добавляет чистый заработок пользователю и начисляет 1% реферального бонуса.
+    Добавляет чистый заработок пользователю и начисляет реферальные бонусы.
     """
     balance_result = await db.execute(select(Balance).filter(Balance.user_id == user_id))
     balance = balance_result.scalars().first()
@@ -161,39 +189,22 @@ async def update_earned_balance(db: AsyncSession, user_id: int, earned_amount: f
 
     balance.earned_balance += earned_amount
     balance.balance += earned_amount
+    balance.version += 1
 
     await db.commit()
-    await process_referral_bonus(db, user_id)
+    balance_cache.invalidate(user_id)
+    await process_referral_bonus(db, user_id, earned_amount)
 
-async def process_referral_bonus(db: AsyncSession, user_id: int):
+async def process_referral_bonus(db: AsyncSession, user_id: int, earned_amount: float):
     """
-    Начисляет 1% реферального бонуса.
+    Начисляет реферальный бонус реферерам пользователя по уровням REFERRAL_BONUS_LEVELS.
     """
-    user_result = await db.execute(select(User).filter(User.id == user_id))
-    user = user_result.scalars().first()
-
-    if not user or not user.referred_by_id:
-        logging.info(f"Рефералка: У пользователя {user_id} нет пригласившего.")
-        return
-
-    referrer_id = user.referred_by_id
-
-    balance_result = await db.execute(select(Balance).filter(Balance.user_id == user_id))
-    balance = balance_result.scalars().first()
-
-    if not balance:
-        logging.warning(f"Баланс не найден для {user_id}, невозможно начислить реферальный бонус.")
-        return
-
-    referral_bonus = balance.earned_balance * 0.01
+    credited = await distribute_referral_bonuses(db, [user_id], [earned_amount])
+    await publish_balance_versions(db, credited)
+    await db.commit()
 
-    if referral_bonus > 0:
-        ref_balance_result = await db.execute(select(Balance).filter(Balance.user_id == referrer_id))
-        ref_balance = ref_balance_result.scalars().first()
+    for row in credited:
+        balance_cache.apply_balance(row)
 
-        if ref_balance:
-            ref_balance.balance += referral_bonus
-            await db.commit()
-            logging.info(f"Реферальный бонус {referral_bonus} начислен {referrer_id} от {user_id}")
-        else:
-            logging.warning(f"Баланс реферера {referrer_id} не найден.")
+    if not credited:
+        logging.info(f"Рефералка: У пользователя {user_id} нет пригласившего.")
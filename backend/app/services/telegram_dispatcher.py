@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import os
+
+# Логирование
+logger = logging.getLogger(__name__)
+
+# Сколько обновлений обрабатывается одновременно (по всем чатам)
+TELEGRAM_MAX_CONCURRENCY = int(os.getenv("TELEGRAM_MAX_CONCURRENCY", 32))
+# Сколько обновлений может ждать обработки; сверх этого вебхук отвечает 503 и Telegram повторит доставку
+TELEGRAM_MAX_PENDING = int(os.getenv("TELEGRAM_MAX_PENDING", 10000))
+
+
+def chat_key(update) -> int:
+    """Ключ упорядочивания: чат, иначе пользователь; без них обновления независимы"""
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return -update.update_id
+
+
+class UpdateDispatcher:
+    """
+    Конкурентная обработка обновлений Telegram с сохранением порядка внутри чата.
+    У каждого чата своя очередь и свой воркер, пока в очереди есть обновления;
+    общий семафор ограничивает число одновременно обрабатываемых обновлений.
+    """
+
+    def __init__(self, max_concurrency: int = TELEGRAM_MAX_CONCURRENCY, max_pending: int = TELEGRAM_MAX_PENDING):
+        self.max_pending = max_pending
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._max_concurrency = max_concurrency
+        self._queues = {}
+        self._workers = {}
+        self._application = None
+        self.pending = 0
+
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def start(self, application):
+        self._application = application
+
+    def submit(self, update) -> bool:
+        """Ставит обновление в очередь его чата. False — очередь переполнена"""
+        if self._application is None or self.pending >= self.max_pending:
+            self.rejected += 1
+            return False
+
+        key = chat_key(update)
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = asyncio.Queue()
+        queue.put_nowait(update)
+        self.pending += 1
+
+        if key not in self._workers:
+            self._workers[key] = asyncio.create_task(self._drain(key, queue))
+        return True
+
+    async def _drain(self, key, queue: asyncio.Queue):
+        """Обрабатывает обновления одного чата строго по очереди и завершается, когда очередь пуста"""
+        try:
+            while not queue.empty():
+                update = queue.get_nowait()
+                try:
+                    async with self._semaphore:
+                        await self._application.process_update(update)
+                    self.processed += 1
+                except Exception as e:
+                    self.failed += 1
+                    logger.error(f"Ошибка обработки обновления {update.update_id}: {e}", exc_info=True)
+                finally:
+                    self.pending -= 1
+        finally:
+            del self._workers[key]
+            del self._queues[key]
+
+    async def stop(self, timeout: float = 10.0):
+        """Дожидается обработки уже принятых обновлений"""
+        workers = list(self._workers.values())
+        if workers:
+            await asyncio.wait(workers, timeout=timeout)
+        self._application = None
+
+    def stats(self) -> dict:
+        return {
+            "max_concurrency": self._max_concurrency,
+            "in_flight": self._max_concurrency - self._semaphore._value,
+            "pending": self.pending,
+            "active_chats": len(self._workers),
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+        }
+
+
+# Единый диспетчер на процесс
+update_dispatcher = UpdateDispatcher()
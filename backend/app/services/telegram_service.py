@@ -1,6 +1,11 @@
+import base64
+import hashlib
+import hmac
+import os
 import secrets
 import logging
-from datetime import datetime, timedelta
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 import pytz
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
@@ -9,16 +14,114 @@ from app.models.models import AuthTokens
 
 # Настройка логирования
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)  # Уровень логирования INFO для логов
 
 TOKEN_EXPIRATION = timedelta(minutes=10)  # Время жизни токена
 MOSCOW_TZ = pytz.timezone("Europe/Moscow")  # Часовой пояс Москвы
 
+# Формат токенов: db — строка в auth_tokens, signed — самодостаточный HMAC-токен без обращения к БД.
+# Проверка принимает оба формата, поэтому переключение не ломает уже выданные ссылки.
+AUTH_TOKEN_MODE = os.getenv("AUTH_TOKEN_MODE", "db")
+SECRET_KEY = os.getenv("SECRET_KEY", "")
+SIGNED_TOKEN_VERSION = "v1"
+USED_TOKENS_LIMIT = int(os.getenv("USED_TOKENS_LIMIT", 100000))  # Сколько использованных токенов помним
+
+
+class UsedTokenRegistry:
+    """
+    Ограниченный набор использованных идентификаторов токенов (jti) для одноразовой семантики.
+    Запись живет до истечения токена — после этого токен отклоняется по сроку действия.
+    """
+
+    def __init__(self, limit: int = USED_TOKENS_LIMIT):
+        self.limit = limit
+        self._used = OrderedDict()
+
+    def _purge(self, now: float):
+        while self._used:
+            jti, expires_at = next(iter(self._used.items()))
+            if expires_at > now and len(self._used) < self.limit:
+                break
+            self._used.popitem(last=False)
+
+    def claim(self, jti: str, expires_at: float) -> bool:
+        """Отмечает токен использованным. False — если он уже был использован"""
+        now = datetime.now(timezone.utc).timestamp()
+        self._purge(now)
+        if jti in self._used:
+            return False
+        self._used[jti] = expires_at
+        return True
+
+
+used_tokens = UsedTokenRegistry()
+
+
+def _sign(payload: str) -> str:
+    digest = hmac.new(SECRET_KEY.encode(), payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+
+def is_signed_token(token: str) -> bool:
+    return token.startswith(f"{SIGNED_TOKEN_VERSION}.")
+
+
+def generate_signed_token(telegram_id: int) -> str:
+    """Токен вида v1.<telegram_id>.<expires_at>.<jti>.<подпись>, проверяется без БД"""
+    expires_at = int((datetime.now(timezone.utc) + TOKEN_EXPIRATION).timestamp())
+    payload = f"{SIGNED_TOKEN_VERSION}.{telegram_id}.{expires_at}.{secrets.token_urlsafe(12)}"
+    return f"{payload}.{_sign(payload)}"
+
+
+def verify_signed_token(token: str):
+    """
+    Проверяет подпись, срок действия и одноразовость токена.
+
+    :return: (telegram_id, expires_at) или None, если токен недействителен
+    """
+    parts = token.split(".")
+    if len(parts) != 5 or not SECRET_KEY:
+        return None
+
+    payload, signature = ".".join(parts[:4]), parts[4]
+    if not hmac.compare_digest(signature, _sign(payload)):
+        return None
+
+    try:
+        telegram_id, expires_at = int(parts[1]), int(parts[2])
+    except ValueError:
+        return None
+
+    if expires_at < datetime.now(timezone.utc).timestamp():
+        return None
+    if not used_tokens.claim(parts[3], expires_at):
+        return None
+
+    return telegram_id, datetime.fromtimestamp(expires_at, timezone.utc)
+
+def issue_auth_token(db: AsyncSession, telegram_id: int) -> str:
+    """
+    Выпускает одноразовый токен в транзакции вызывающего: без проверки пользователя и без коммита.
+    В режиме signed к БД не обращается.
+    """
+    if AUTH_TOKEN_MODE == "signed" and SECRET_KEY:
+        return generate_signed_token(telegram_id)
+
+    token = secrets.token_urlsafe(32)
+    expires_at = datetime.now(MOSCOW_TZ) + TOKEN_EXPIRATION
+    db.add(AuthTokens(user_id=telegram_id, token=token, expires_at=expires_at))
+    return token
+
+
 async def generate_auth_token(db: AsyncSession, telegram_id: int) -> str:
     """Генерация и сохранение одноразового токена с часовым поясом +03:00 для пользователя по telegram_id"""
     
     # Логируем начало работы функции
     logger.info(f"Начало генерации токена для пользователя с telegram_id {telegram_id}")
+
+    if AUTH_TOKEN_MODE == "signed":
+        if SECRET_KEY:
+            return generate_signed_token(telegram_id)
+        logger.warning("AUTH_TOKEN_MODE=signed, но SECRET_KEY не задан — используем токены в БД")
     
     try:
         # Ищем пользователя по telegram_id
@@ -30,7 +133,7 @@ async def generate_auth_token(db: AsyncSession, telegram_id: int) -> str:
 
         # Генерация безопасного токена
         token = secrets.token_urlsafe(32)
-        logger.info(f"Сгенерирован токен: {token}")
+        logger.debug("Сгенерирован токен для пользователя %s", telegram_id)
 
         # Получаем текущее время в Москве
         current_time_msk = datetime.now(MOSCOW_TZ)
@@ -0,0 +1,206 @@
+import asyncio
+import logging
+import os
+import re
+import time
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import text
+from app.database import get_db
+
+# Логирование
+logger = logging.getLogger(__name__)
+
+TOKEN_REAPER_INTERVAL = int(os.getenv("TOKEN_REAPER_INTERVAL", 300))  # Как часто чистим (сек)
+TOKEN_REAPER_BATCH = int(os.getenv("TOKEN_REAPER_BATCH", 5000))  # Сколько строк удаляем за одну транзакцию
+TOKEN_REAPER_PAUSE = float(os.getenv("TOKEN_REAPER_PAUSE", 0.1))  # Пауза между пачками (сек)
+
+# Партиционированная схема: auth_tokens разбита по дням expires_at, старые партиции удаляются целиком.
+# Таблицу и партицию auth_tokens_default создает ensure_schema (см. _AUTH_TOKENS_PARTITIONED_DDL в schema.py);
+# уже существующую обычную таблицу нужно перенести вручную.
+AUTH_TOKENS_PARTITIONED = os.getenv("AUTH_TOKENS_PARTITIONED", "0") == "1"
+TOKEN_PARTITIONS_AHEAD = int(os.getenv("TOKEN_PARTITIONS_AHEAD", 2))  # Сколько будущих дней создаем заранее
+TOKEN_PARTITION_RETENTION = int(os.getenv("TOKEN_PARTITION_RETENTION", 1))  # Сколько прошедших дней храним
+
+_PARTITION_NAME = re.compile(r"^auth_tokens_p(\d{8})$")
+
+_DELETE_EXPIRED_BATCH = text("""
+    DELETE FROM auth_tokens
+    WHERE id IN (
+        SELECT id FROM auth_tokens
+        WHERE expires_at < now()
+        LIMIT :batch
+        FOR UPDATE SKIP LOCKED
+    )
+""")
+
+_TABLE_SIZE = text("""
+    SELECT COALESCE(SUM(pg_total_relation_size(c.oid)), 0)::BIGINT AS total_bytes,
+           COALESCE(SUM(GREATEST(c.reltuples, 0)), 0)::BIGINT AS estimated_rows
+    FROM pg_class AS c
+    WHERE c.relkind IN ('r', 'p')
+      AND (c.relname IN ('auth_tokens', 'auth_tokens_default') OR c.relname ~ '^auth_tokens_p[0-9]{8}$')
+""")
+
+_LIST_PARTITIONS = text("""
+    SELECT child.relname
+    FROM pg_inherits
+    JOIN pg_class AS parent ON parent.oid = pg_inherits.inhparent
+    JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid
+    WHERE parent.relname = 'auth_tokens'
+""")
+
+
+_PARTITION_EXISTS = text("SELECT to_regclass(:name) IS NOT NULL")
+
+
+def _partition_ddl(day) -> list:
+    """
+    Создание партиции дня day. Границы — явные timestamptz в UTC, не зависят от TimeZone сессии.
+    Партицию нельзя создать, пока в auth_tokens_default есть строки ее диапазона, поэтому таблица
+    создается отдельно, строки диапазона переносятся в нее из DEFAULT, и только затем она подключается.
+    """
+    name = f"auth_tokens_p{day:%Y%m%d}"
+    start = f"{day.isoformat()} 00:00:00+00"
+    end = f"{(day + timedelta(days=1)).isoformat()} 00:00:00+00"
+    return [
+        f"CREATE TABLE {name} (LIKE auth_tokens INCLUDING DEFAULTS INCLUDING CONSTRAINTS)",
+        f"""
+        WITH moved AS (
+            DELETE FROM auth_tokens_default
+            WHERE expires_at >= TIMESTAMPTZ '{start}' AND expires_at < TIMESTAMPTZ '{end}'
+            RETURNING *
+        )
+        INSERT INTO {name} SELECT * FROM moved
+        """,
+        f"ALTER TABLE auth_tokens ATTACH PARTITION {name} FOR VALUES FROM ('{start}') TO ('{end}')",
+    ]
+
+
+class TokenReaper:
+    """Фоновая очистка просроченных auth_tokens небольшими пачками, чтобы не держать долгих блокировок"""
+
+    def __init__(self, interval: int = TOKEN_REAPER_INTERVAL, batch_size: int = TOKEN_REAPER_BATCH,
+                 partitioned: bool = AUTH_TOKENS_PARTITIONED):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.partitioned = partitioned
+        self._task = None
+
+        # Метрики
+        self.runs = 0
+        self.rows_reaped_total = 0
+        self.partitions_dropped_total = 0
+        self.last_run_rows = 0
+        self.last_run_ms = 0.0
+        self.table_bytes = None
+        self.table_rows_estimate = None
+
+    async def reap_expired(self) -> int:
+        """Удаляет просроченные токены пачками по batch_size, каждая пачка — отдельная короткая транзакция"""
+        total = 0
+        while True:
+            async with get_db() as db:
+                result = await db.execute(_DELETE_EXPIRED_BATCH, {"batch": self.batch_size})
+                await db.commit()
+
+            total += result.rowcount
+            if result.rowcount < self.batch_size:
+                return total
+            await asyncio.sleep(TOKEN_REAPER_PAUSE)
+
+    async def rotate_partitions(self) -> int:
+        """Создает партиции на ближайшие дни и удаляет партиции, целиком ушедшие в прошлое"""
+        today = datetime.now(timezone.utc).date()
+        dropped = 0
+
+        # Каждая партиция — своей транзакцией: ошибка одного дня не мешает остальным и удалению старых
+        for offset in range(TOKEN_PARTITIONS_AHEAD + 1):
+            day = today + timedelta(days=offset)
+            name = f"auth_tokens_p{day:%Y%m%d}"
+            try:
+                async with get_db() as db:
+                    if (await db.execute(_PARTITION_EXISTS, {"name": name})).scalar():
+                        continue
+                    for statement in _partition_ddl(day):
+                        await db.execute(text(statement))
+                    await db.commit()
+                logger.info(f"Создана партиция токенов {name}")
+            except Exception as e:
+                logger.error(f"Не удалось создать партицию токенов {name}: {e}")
+
+        async with get_db() as db:
+            result = await db.execute(_LIST_PARTITIONS)
+            oldest_kept = today - timedelta(days=TOKEN_PARTITION_RETENTION)
+            for (name,) in result.all():
+                match = _PARTITION_NAME.match(name)
+                if match and datetime.strptime(match.group(1), "%Y%m%d").date() < oldest_kept:
+                    await db.execute(text(f"DROP TABLE IF EXISTS {name}"))
+                    dropped += 1
+                    logger.info(f"Удалена партиция токенов {name}")
+
+            # В DEFAULT попадают токены дней без своей партиции — их чистим построчно
+            await db.execute(text("DELETE FROM auth_tokens_default WHERE expires_at < now()"))
+            await db.commit()
+
+        return dropped
+
+    async def refresh_table_size(self):
+        async with get_db() as db:
+            row = (await db.execute(_TABLE_SIZE)).first()
+        self.table_bytes = row.total_bytes
+        self.table_rows_estimate = row.estimated_rows
+
+    async def run_once(self):
+        started = time.perf_counter()
+
+        if self.partitioned:
+            self.partitions_dropped_total += await self.rotate_partitions()
+            rows = 0
+        else:
+            rows = await self.reap_expired()
+
+        await self.refresh_table_size()
+
+        self.runs += 1
+        self.last_run_rows = rows
+        self.rows_reaped_total += rows
+        self.last_run_ms = (time.perf_counter() - started) * 1000
+        if rows:
+            logger.info(f"Удалено просроченных токенов: {rows} за {self.last_run_ms:.0f} мс")
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Ошибка при очистке auth_tokens: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "partitioned": self.partitioned,
+            "runs": self.runs,
+            "rows_reaped_total": self.rows_reaped_total,
+            "partitions_dropped_total": self.partitions_dropped_total,
+            "last_run_rows": self.last_run_rows,
+            "last_run_ms": round(self.last_run_ms, 2),
+            "table_bytes": self.table_bytes,
+            "table_rows_estimate": self.table_rows_estimate,
+        }
+
+
+# Единый чистильщик на процесс
+token_reaper = TokenReaper()
@@ -1,21 +1,22 @@
 import random
 import string
 import logging
+from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from sqlalchemy.exc import SQLAlchemyError
 from app.models.models import User, Referrals
 from app.database import get_db
+from app.services.referrals import add_closure_node, link_referral_closure
+from app.services.balance_cache import balance_cache
 
 
-# Настройка логгера
+# Настройка логгера (обработчики настраивает app.logging_config)
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO)
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-console_handler.setFormatter(formatter)
-logger.addHandler(console_handler)
+
+# Стартовые балансы нового пользователя (как при /start)
+START_BALANCE = 100.0
+START_TRADE_BALANCE = 50.0
 
 
 
@@ -74,13 +75,18 @@ async def create_referral_data(db: AsyncSession, user_id: int, referrer_id: int
             user_id=user_id,
             telegram_id=user.telegram_id,
             referral_link=referral_link,
-            referrer_id=referrer_id,  # используем правильное имя поля
+            referrer_id=referrer.telegram_id if referrer else None,  # telegram_id реферера
             invited_count=0,
-            referred_by=referrer_id  # исправляем на правильное поле
+            referred_by=referrer_id  # users.id реферера
         )
 
         db.add(new_referral)
 
+        # Таблица замыкания обновляется в той же транзакции
+        await add_closure_node(db, user.telegram_id)
+        if referrer:
+            await link_referral_closure(db, user.telegram_id, referrer.telegram_id)
+
         # Если есть реферер — увеличиваем ему счетчик приглашенных
         if referrer_id:
             referrer_referral = await db.execute(select(Referrals).filter(Referrals.user_id == referrer_id))
@@ -187,9 +193,11 @@ async def add_referral(db: AsyncSession, telegram_id: int, referral_link: str):
             user_id=new_user.id,           # ID нового пользователя в системе
             telegram_id=telegram_id,       # Telegram ID приглашенного
             referral_link=referral_link,   # Ссылка с реферальным кодом
+            referrer_id=referrer.telegram_id,  # Telegram ID пригласившего
             referred_by=referrer.id        # ID пригласившего пользователя (ссылается на пользователя)
         )
         db.add(new_referral)
+        await link_referral_closure(db, telegram_id, referrer.telegram_id)
 
         # Увеличиваем счетчик приглашенных у реферера
         referrer_ref_result = await db.execute(select(Referrals).filter(Referrals.user_id == referrer.id))
@@ -225,3 +233,216 @@ def extract_telegram_id_from_link(referral_link: str) -> int:
         logger.error(f"Ошибка при извлечении Telegram ID из ссылки {referral_link}: {e}")
         return None
 
+
+
+# --- Массовая регистрация ---
+
+# Upsert пользователей: новые создаются, у существующих обновляется профиль.
+# Не переданные поля (NULL) не затирают сохраненные значения. (xmax = 0) отличает вставленную строку от обновленной.
+_UPSERT_USERS = text("""
+    INSERT INTO users (telegram_id, username, first_name, last_name, language_code, is_bot, photo_url)
+    SELECT * FROM unnest(
+        CAST(:telegram_ids AS BIGINT[]), CAST(:usernames AS VARCHAR[]), CAST(:first_names AS VARCHAR[]),
+        CAST(:last_names AS VARCHAR[]), CAST(:language_codes AS VARCHAR[]), CAST(:is_bots AS BOOLEAN[]),
+        CAST(:photo_urls AS VARCHAR[])
+    )
+    ON CONFLICT (telegram_id) DO UPDATE SET
+        username = COALESCE(EXCLUDED.username, users.username),
+        first_name = COALESCE(EXCLUDED.first_name, users.first_name),
+        last_name = COALESCE(EXCLUDED.last_name, users.last_name),
+        language_code = COALESCE(EXCLUDED.language_code, users.language_code),
+        photo_url = COALESCE(EXCLUDED.photo_url, users.photo_url),
+        updated_at = now()
+    RETURNING id, telegram_id, (xmax = 0) AS inserted
+""")
+
+# Стартовый баланс только тем, у кого его еще нет
+_INSERT_MISSING_BALANCES = text("""
+    INSERT INTO balances (user_id, balance, trade_balance, frozen_balance, earned_balance)
+    SELECT u.id, :balance, :trade_balance, 0, 0
+    FROM unnest(CAST(:user_ids AS INTEGER[])) AS u(id)
+    WHERE NOT EXISTS (SELECT 1 FROM balances AS b WHERE b.user_id = u.id)
+    RETURNING user_id
+""")
+
+# Реферальная запись только тем, у кого ее нет. Ссылка детерминирована (как в generate_unique_referral_code),
+# поэтому проверка уникальности в цикле не нужна. Реферер записывается по внешним ключам колонок:
+# referrer_id — его telegram_id (users.telegram_id), referred_by — его users.id.
+_INSERT_MISSING_REFERRALS = text("""
+    INSERT INTO referrals (user_id, telegram_id, referral_link, invited_count, referrer_id, referred_by)
+    SELECT i.user_id, i.telegram_id, 'https://app.com/ref/' || i.user_id || '-' || i.telegram_id, 0,
+           ru.telegram_id, ru.id
+    FROM unnest(CAST(:user_ids AS INTEGER[]), CAST(:telegram_ids AS BIGINT[]), CAST(:referrers AS BIGINT[]))
+        AS i(user_id, telegram_id, referrer)
+    LEFT JOIN users AS ru ON ru.telegram_id = i.referrer AND i.referrer <> i.telegram_id
+    WHERE NOT EXISTS (SELECT 1 FROM referrals AS r WHERE r.user_id = i.user_id)
+    RETURNING user_id, telegram_id, referrer_id
+""")
+
+_INCREMENT_INVITED = text("""
+    UPDATE referrals AS r
+    SET invited_count = r.invited_count + c.invited
+    FROM unnest(CAST(:referrers AS BIGINT[]), CAST(:counts AS INTEGER[])) AS c(telegram_id, invited)
+    WHERE r.telegram_id = c.telegram_id
+""")
+
+_INSERT_CLOSURE_SELF = text("""
+    INSERT INTO referral_closure (ancestor_id, descendant_id, depth)
+    SELECT t.id, t.id, 0 FROM unnest(CAST(:telegram_ids AS BIGINT[])) AS t(id)
+    ON CONFLICT DO NOTHING
+""")
+
+# Новые пользователи — листья: их предки — реферер и все его предки
+_LINK_CLOSURE = text("""
+    INSERT INTO referral_closure (ancestor_id, descendant_id, depth)
+    SELECT a.ancestor_id, c.child, a.depth + 1
+    FROM unnest(CAST(:children AS BIGINT[]), CAST(:parents AS BIGINT[])) AS c(child, parent)
+    JOIN referral_closure AS a ON a.descendant_id = c.parent
+    ON CONFLICT DO NOTHING
+""")
+
+
+def _closure_levels(links: dict) -> list:
+    """
+    Раскладывает новые связи ребенок -> реферер по уровням внутри пачки:
+    связь ребенка добавляется только после того, как в таблице замыкания появились предки его реферера.
+    """
+    levels = {}
+    for start in links:
+        # Поднимаемся до реферера вне пачки, уже посчитанного узла или цикла
+        path, seen, node = [], set(), start
+        while node in links and node not in levels and node not in seen:
+            path.append(node)
+            seen.add(node)
+            node = links[node]
+
+        level = levels.get(node, -1)
+        for child in reversed(path):
+            level += 1
+            levels[child] = level
+
+    grouped = {}
+    for child, level in levels.items():
+        grouped.setdefault(level, []).append(child)
+    return [grouped[level] for level in sorted(grouped)]
+
+
+def _referrer_cycle_breaks(profiles: list) -> set:
+    """
+    Находит циклы рефереров внутри пачки (A пригласил B, B пригласил A) — в таблице замыкания
+    они дали бы цикл. Из каждого цикла выбрасывается связь профиля, стоящего в пачке последним.
+
+    :return: telegram_id профилей, чей реферер не записывается
+    """
+    order = {profile["telegram_id"]: index for index, profile in enumerate(profiles)}
+    links = {
+        profile["telegram_id"]: profile.get("referrer_telegram_id") for profile in profiles
+        if profile.get("referrer_telegram_id") in order and profile.get("referrer_telegram_id") != profile["telegram_id"]
+    }
+
+    broken, done = set(), set()
+    for start in links:
+        path, position, node = [], {}, start
+        while node in links and node not in done and node not in position:
+            position[node] = len(path)
+            path.append(node)
+            node = links[node]
+        if node in position:
+            cycle = path[position[node]:]
+            broken.add(max(cycle, key=order.get))
+        done.update(path)
+    return broken
+
+
+async def bulk_register_users(db: AsyncSession, profiles: list, commit: bool = True) -> list:
+    """
+    Регистрирует пачку пользователей Telegram несколькими set-based запросами и одним COMMIT:
+    upsert users, недостающие balances и referrals, счетчики приглашенных и таблица замыкания.
+
+    :param profiles: Словари с telegram_id, username, first_name, last_name, language_code,
+                     is_bot, photo_url и необязательным referrer_telegram_id
+    :param commit: False — оставить изменения в транзакции вызывающего
+    :return: Итог по каждому профилю в исходном порядке
+    """
+    # Повтор telegram_id в одной пачке ломает ON CONFLICT DO UPDATE — берем последнее вхождение
+    latest = {}
+    for index, profile in enumerate(profiles):
+        latest[profile["telegram_id"]] = index
+    unique = [profiles[index] for index in sorted(latest.values())]
+
+    if not unique:
+        return []
+
+    cycle_breaks = _referrer_cycle_breaks(unique)
+    if cycle_breaks:
+        logger.warning(f"Массовая регистрация: рефереры образуют цикл, связь не записана для {sorted(cycle_breaks)}")
+
+    try:
+        result = await db.execute(_UPSERT_USERS, {
+            "telegram_ids": [profile["telegram_id"] for profile in unique],
+            "usernames": [profile.get("username") for profile in unique],
+            "first_names": [profile.get("first_name") for profile in unique],
+            "last_names": [profile.get("last_name") for profile in unique],
+            "language_codes": [profile.get("language_code") for profile in unique],
+            "is_bots": [bool(profile.get("is_bot", False)) for profile in unique],
+            "photo_urls": [profile.get("photo_url") for profile in unique],
+        })
+        users = {row.telegram_id: row for row in result.all()}
+        user_ids = [users[profile["telegram_id"]].id for profile in unique]
+
+        result = await db.execute(_INSERT_MISSING_BALANCES, {
+            "user_ids": user_ids, "balance": START_BALANCE, "trade_balance": START_TRADE_BALANCE,
+        })
+        balances_created = {row.user_id for row in result.all()}
+
+        result = await db.execute(_INSERT_MISSING_REFERRALS, {
+            "user_ids": user_ids,
+            "telegram_ids": [profile["telegram_id"] for profile in unique],
+            "referrers": [
+                None if profile["telegram_id"] in cycle_breaks else profile.get("referrer_telegram_id")
+                for profile in unique
+            ],
+        })
+        referrals_created = {row.telegram_id: row.referrer_id for row in result.all()}
+
+        links = {child: parent for child, parent in referrals_created.items() if parent is not None}
+        if links:
+            invited = {}
+            for parent in links.values():
+                invited[parent] = invited.get(parent, 0) + 1
+            await db.execute(_INCREMENT_INVITED, {"referrers": list(invited), "counts": list(invited.values())})
+
+        if referrals_created:
+            await db.execute(_INSERT_CLOSURE_SELF, {"telegram_ids": list(referrals_created)})
+            for children in _closure_levels(links):
+                await db.execute(_LINK_CLOSURE, {"children": children, "parents": [links[child] for child in children]})
+
+        if commit:
+            await db.commit()
+    except SQLAlchemyError as e:
+        logger.error(f"Ошибка массовой регистрации ({len(unique)} пользователей): {e}", exc_info=True)
+        await db.rollback()
+        raise
+
+    outcomes = []
+    for index, profile in enumerate(profiles):
+        telegram_id = profile["telegram_id"]
+        row = users[telegram_id]
+        if latest[telegram_id] != index:
+            outcomes.append({"telegram_id": telegram_id, "user_id": row.id, "status": "duplicate"})
+            continue
+        if not row.inserted:
+            # Профиль обновлен — снимок в кэше балансов устарел
+            balance_cache.invalidate(row.id)
+        outcomes.append({
+            "telegram_id": telegram_id,
+            "user_id": row.id,
+            "status": "created" if row.inserted else "updated",
+            "balance_created": row.id in balances_created,
+            "referral_created": telegram_id in referrals_created,
+            "referrer_telegram_id": referrals_created.get(telegram_id),
+        })
+
+    created = sum(1 for row in users.values() if row.inserted)
+    logger.info(f"Массовая регистрация: {len(unique)} профилей, новых {created}, обновлено {len(unique) - created}")
+    return outcomes
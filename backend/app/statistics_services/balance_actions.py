@@ -1,16 +1,36 @@
 # balance_actions.py
+import logging
+from datetime import datetime, timezone
 from sqlalchemy.ext.asyncio import AsyncSession
 from app.models.models import Transaction
+from app.statistics_services.ledger_writer import ledger_writer
 
-async def log_transaction(db: AsyncSession, user_id: int, amount: float, transaction_type: str):
-    from datetime import datetime
+logger = logging.getLogger(__name__)
+
+async def log_transaction(db: AsyncSession, user_id: int, amount: float, transaction_type: str, durable: bool = False):
+    """
+    Записывает операцию в журнал транзакций.
+    По умолчанию строка уходит в групповой писатель журнала (без отдельного COMMIT);
+    durable=True или остановленный писатель — запись сразу в сессии вызывающего с коммитом.
+    """
+    if not durable and ledger_writer.running:
+        ledger_writer.enqueue(user_id, amount, transaction_type)
+        if ledger_writer.queue_depth >= ledger_writer.max_queue:
+            # Очередь переполнена — сбрасываем синхронно, чтобы ограничить память.
+            # Изменение баланса уже зафиксировано: ошибка сброса не делает операцию неуспешной,
+            # строки остаются в очереди писателя
+            try:
+                await ledger_writer.flush()
+            except Exception as e:
+                logger.warning(f"Синхронный сброс журнала не удался, запись осталась в очереди: {e}")
+        return
 
     transaction = Transaction(
         user_id=user_id,
         amount=amount,
         transaction_type=transaction_type,
-        created_at=datetime.utcnow()  # записываем текущее время
+        created_at=datetime.now(timezone.utc)  # записываем текущее время
     )
-    
+
     db.add(transaction)
-    await db.commit()  # сохраняем транзакцию в базу данны
\ No newline at end of file
+    await db.commit()  # сохраняем транзакцию в базу данных
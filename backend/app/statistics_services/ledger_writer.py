@@ -0,0 +1,195 @@
+# ledger_writer.py
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from datetime import datetime, timezone
+from sqlalchemy import insert
+from sqlalchemy.exc import DataError, IntegrityError
+from app.database import AsyncSessionLocal
+from app.models.models import Transaction
+
+logger = logging.getLogger(__name__)
+
+# Параметры групповой записи журнала транзакций
+LEDGER_FLUSH_SIZE = int(os.getenv("LEDGER_FLUSH_SIZE", 500))  # Сбрасываем, как только накопилось N записей
+LEDGER_FLUSH_INTERVAL = float(os.getenv("LEDGER_FLUSH_INTERVAL", 0.5))  # ...или раз в N секунд
+LEDGER_MAX_QUEUE = int(os.getenv("LEDGER_MAX_QUEUE", 50000))  # Выше этого — сбрасываем синхронно
+LEDGER_MAX_BUFFER = int(os.getenv("LEDGER_MAX_BUFFER", 200000))  # Жесткий предел очереди при недоступной БД
+LEDGER_DEAD_LETTERS = int(os.getenv("LEDGER_DEAD_LETTERS", 1000))  # Сколько отброшенных строк держим для /stats
+
+# Ошибки в самих строках (внешний ключ, тип значения): повтор пачки не поможет, плохую строку нужно отделить
+_ROW_ERRORS = (IntegrityError, DataError)
+
+
+class LedgerWriter:
+    """
+    Асинхронный писатель журнала транзакций.
+    Копит строки Transaction в памяти и пишет их пачками (multi-row INSERT, один COMMIT на пачку).
+    Пачка с ошибочной строкой делится пополам, пока плохие строки не будут отделены:
+    они уходят в dead letters (и в лог), остальные записываются.
+    """
+
+    def __init__(self, flush_size: int = LEDGER_FLUSH_SIZE, flush_interval: float = LEDGER_FLUSH_INTERVAL,
+                 max_queue: int = LEDGER_MAX_QUEUE, max_buffer: int = LEDGER_MAX_BUFFER):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.max_buffer = max_buffer
+        self._buffer = []
+        self.dead_letters = deque(maxlen=LEDGER_DEAD_LETTERS)
+        self._lock = asyncio.Lock()
+        self._full = asyncio.Event()
+        self._task = None
+
+        # Статистика
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.failures = 0
+        self.dead_lettered = 0
+        self.dropped = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._buffer)
+
+    def enqueue(self, user_id: int, amount: float, transaction_type: str, created_at: datetime = None):
+        """Ставит запись в очередь; время операции фиксируется в момент постановки"""
+        self._buffer.append({
+            "user_id": user_id,
+            "amount": amount,
+            "transaction_type": transaction_type,
+            "created_at": created_at or datetime.now(timezone.utc),
+        })
+        if len(self._buffer) >= self.flush_size:
+            self._full.set()
+
+    async def _insert(self, rows: list):
+        async with AsyncSessionLocal() as db:
+            await db.execute(insert(Transaction), rows)
+            await db.commit()
+
+    async def _write(self, rows: list) -> int:
+        """
+        Пишет строки; при ошибке в данных делит пачку пополам и пишет половины отдельно.
+        При ошибке соединения еще не записанные строки возвращаются в очередь, а ошибка пробрасывается.
+
+        :return: Количество записанных строк
+        """
+        written = 0
+        pending = [rows]
+        while pending:
+            chunk = pending.pop()
+            try:
+                await self._insert(chunk)
+                written += len(chunk)
+            except _ROW_ERRORS as e:
+                if len(chunk) == 1:
+                    self._dead_letter(chunk[0], e)
+                    continue
+                middle = len(chunk) // 2
+                pending.append(chunk[middle:])
+                pending.append(chunk[:middle])
+            except Exception:
+                self._requeue(chunk + [row for part in reversed(pending) for row in part])
+                raise
+        return written
+
+    def _dead_letter(self, row: dict, error: Exception):
+        self.dead_lettered += 1
+        self.dead_letters.append({**row, "error": str(error.orig if hasattr(error, "orig") else error)[:500]})
+        logger.error(f"Запись журнала отброшена: {row}: {error}")
+
+    def _requeue(self, rows: list):
+        """Возвращает строки в начало очереди, не превышая max_buffer (самые старые сверх предела — в лог)"""
+        self._buffer = rows + self._buffer
+        overflow = len(self._buffer) - self.max_buffer
+        if overflow > 0:
+            dropped, self._buffer = self._buffer[:overflow], self._buffer[overflow:]
+            self.dropped += overflow
+            logger.error(f"Очередь журнала переполнена, отброшено {overflow} строк: {dropped}")
+
+    async def flush(self) -> int:
+        """
+        Сбрасывает все накопленные записи в БД и дожидается коммита.
+        Используется как «durable» путь для вызывающих, которым запись нужна прямо сейчас.
+
+        :return: Количество записанных строк
+        """
+        async with self._lock:
+            if not self._buffer:
+                return 0
+
+            rows, self._buffer = self._buffer, []
+            started = time.perf_counter()
+            try:
+                written = await self._write(rows)
+            except Exception as e:
+                # БД недоступна — незаписанные строки уже возвращены в очередь
+                self.failures += 1
+                logger.error(f"Ошибка при записи журнала транзакций ({len(rows)} строк): {e}")
+                raise
+
+            elapsed = (time.perf_counter() - started) * 1000
+            self.flushes += 1
+            self.flushed_rows += written
+            self.last_flush_ms = elapsed
+            self.max_flush_ms = max(self.max_flush_ms, elapsed)
+            self.total_flush_ms += elapsed
+            return written
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+
+            try:
+                await self.flush()
+            except Exception:
+                # Ошибка уже залогирована, строки остались в очереди
+                await asyncio.sleep(self.flush_interval)
+
+    async def start(self):
+        if not self.running:
+            self._task = asyncio.create_task(self._run())
+            logger.info("Писатель журнала транзакций запущен")
+
+    async def stop(self):
+        """Останавливает фоновую задачу и сбрасывает остаток очереди"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth,
+            "flushes": self.flushes,
+            "flushed_rows": self.flushed_rows,
+            "failures": self.failures,
+            "dead_lettered": self.dead_lettered,
+            "dropped": self.dropped,
+            "recent_dead_letters": list(self.dead_letters)[-10:],
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "max_flush_ms": round(self.max_flush_ms, 2),
+            "avg_flush_ms": round(self.total_flush_ms / self.flushes, 2) if self.flushes else 0.0,
+        }
+
+
+# Единый писатель журнала на процесс
+ledger_writer = LedgerWriter()
@@ -1,16 +1,12 @@
 import os
-import secrets
 from dotenv import load_dotenv
-from fastapi import HTTPException
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
 from telegram.ext import Application, CommandHandler, CallbackContext
-from app.services.balances import create_or_update_balance
 from app.database import get_db
-from app.services.users import register_user, create_referral_data
 import logging
-from app.routers.general_routes import get_user_by_telegram_id
-import httpx
-from app.services.telegram_service import generate_auth_token
+from app.services.onboarding import onboard_user, parse_start_payload
+from app.services.metrics import track_telegram_handler
+from app.services.telegram_dispatcher import update_dispatcher
 
 # Загружаем .env файл
 dotenv_path = os.path.join(os.path.dirname(__file__), '..', 'app', '.env')
@@ -25,12 +21,24 @@ if not TELEGRAM_API_TOKEN:
 # URL вашего сайта
 WEBSITE_URL = "https://your-website.com"  # Замените на ваш URL
 
+# Режим получения обновлений: polling (разработка) или webhook (через маршрут FastAPI)
+TELEGRAM_MODE = os.getenv("TELEGRAM_MODE", "polling")
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL")  # Публичный URL маршрута /telegram/webhook
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET")  # Telegram передает его в X-Telegram-Bot-Api-Secret-Token
+TELEGRAM_WEBHOOK_MAX_CONNECTIONS = int(os.getenv("TELEGRAM_WEBHOOK_MAX_CONNECTIONS", 40))
+
+if TELEGRAM_MODE == "webhook" and not (TELEGRAM_WEBHOOK_URL and TELEGRAM_WEBHOOK_SECRET):
+    raise ValueError("Для TELEGRAM_MODE=webhook нужны TELEGRAM_WEBHOOK_URL и TELEGRAM_WEBHOOK_SECRET")
+
+# Приложение PTB текущего процесса (создается в main)
+application = None
+
 # Настройка логирования
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
 
+@track_telegram_handler("start")
 async def start(update: Update, context: CallbackContext) -> None:
     user = update.effective_user
     chat_id = user.id
@@ -41,83 +49,47 @@ async def start(update: Update, context: CallbackContext) -> None:
     photo_url = user.photo_url if hasattr(user, 'photo_url') and user.photo_url else ""
 
     try:
-        logger.info(f"Обрабатываем /start для {chat_id}")
-        logger.info(f"Полученный photo_url: {photo_url}")
-
-        async with get_db() as db:
-            db_user = None
-
-            try:
-                db_user = await get_user_by_telegram_id(chat_id, db)
-                logger.info(f"Пользователь {chat_id} найден в БД. Имя: {db_user.first_name}")
-                is_new_user = False
-            except HTTPException as http_exc:
-                if http_exc.status_code == 404:
-                    logger.info(f"Пользователь {chat_id} не найден, создаем нового.")
-                    db_user = await register_user(db, chat_id, username, first_name, last_name, language_code, photo_url)
-
-                    logger.info(f"Зарегистрирован новый пользователь {db_user.first_name}. Photo URL: {db_user.photo_url}")
-
-                    referral_data = await create_referral_data(db, db_user.id)
-
-                    await create_or_update_balance(db, db_user.id, balance=100.0, trade_balance=50.0)
+        logger.info("Обрабатываем /start для %s", chat_id)
 
-                    logger.info(f"Пользователь {db_user.first_name} зарегистрирован с балансом.")
-
-                    backend_url = "http://localhost:8000/api/user-registered"
-
-                    async with httpx.AsyncClient() as client:
-                        response = await client.post(backend_url, json={
-                            "telegram_id": chat_id,
-                            "username": username,
-                            "first_name": first_name,
-                            "last_name": last_name,
-                            "language_code": language_code,
-                            "photo_url": photo_url
-                        })
-
-                    if response.status_code == 200:
-                        logger.info(f"Уведомление о регистрации пользователя {chat_id} успешно отправлено на бэкенд.")
-                    else:
-                        logger.error(f"Ошибка при отправке данных на бэкенд: {response.status_code}, {response.text}")
-
-                    is_new_user = True
-                else:
-                    raise
+        # Реферер из deep link: t.me/<bot>?start=<payload>
+        referrer_telegram_id = parse_start_payload(context.args)
 
+        # Поиск или регистрация пользователя и выпуск токена — одна транзакция, один COMMIT
+        async with get_db() as db:
             try:
-                logger.info(f"Вызываем generate_auth_token для пользователя {db_user.telegram_id}")
-                token = await generate_auth_token(db, db_user.telegram_id)
-                logger.info(f"Токен {token} успешно создан для {db_user.telegram_id}")
+                onboarded = await onboard_user(db, {
+                    "telegram_id": chat_id,
+                    "username": username,
+                    "first_name": first_name,
+                    "last_name": last_name,
+                    "language_code": language_code,
+                    "photo_url": photo_url,
+                }, referrer_telegram_id)
             except Exception as e:
-                logger.error(f"Ошибка при генерации токена: {e}", exc_info=True)
+                logger.error(f"Ошибка при регистрации или генерации токена: {e}", exc_info=True)
                 await update.message.reply_text("Ошибка при создании токена, попробуйте позже.")
                 return
 
-            auth_url = f"{WEBSITE_URL}/auth?token={token}"
+        auth_url = f"{WEBSITE_URL}/auth?token={onboarded.token}"
 
-            if is_new_user:
-                keyboard = [[InlineKeyboardButton("Перейти на сайт", url=auth_url)]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
+        if onboarded.is_new:
+            keyboard = [[InlineKeyboardButton("Перейти на сайт", url=auth_url)]]
+            reply_markup = InlineKeyboardMarkup(keyboard)
 
-                await update.message.reply_text(
-                    f"Привет, {db_user.first_name}! Ты успешно зарегистрирован.\n\n"
-                    f"Твоя реферальная ссылка: {referral_data.referral_link}\n\n"
-                    "Ты можешь использовать эту ссылку, чтобы приглашать других пользователей и получать бонусы!",
-                    reply_markup=reply_markup
-                )
-            else:
-                keyboard = [[InlineKeyboardButton("Открыть мини-приложение", web_app=WebAppInfo(url=auth_url))]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
+            await update.message.reply_text(
+                f"Привет, {onboarded.first_name}! Ты успешно зарегистрирован.\n\n"
+                f"Твоя реферальная ссылка: {onboarded.referral_link}\n\n"
+                "Ты можешь использовать эту ссылку, чтобы приглашать других пользователей и получать бонусы!",
+                reply_markup=reply_markup
+            )
+        else:
+            keyboard = [[InlineKeyboardButton("Открыть мини-приложение", web_app=WebAppInfo(url=auth_url))]]
+            reply_markup = InlineKeyboardMarkup(keyboard)
 
-                await update.message.reply_text(
-                    f"Привет, {db_user.first_name}! Ты уже в системе.",
-                    reply_markup=reply_markup
-                )
-
-    except HTTPException as http_exc:
-        logger.error(f"HTTP ошибка: {http_exc.detail}")
-        await update.message.reply_text(f"Ошибка: {http_exc.detail}")
+            await update.message.reply_text(
+                f"Привет, {onboarded.first_name}! Ты уже в системе.",
+                reply_markup=reply_markup
+            )
 
     except Exception as e:
         logger.error(f"Ошибка при обработке команды /start: {e}", exc_info=True)
@@ -128,11 +100,43 @@ async def start(update: Update, context: CallbackContext) -> None:
 
 
 
+def build_application() -> Application:
+    builder = Application.builder().token(TELEGRAM_API_TOKEN)
+    if TELEGRAM_MODE == "webhook":
+        # Обновления приносит маршрут вебхука, встроенный Updater не нужен
+        builder = builder.updater(None)
+    bot_application = builder.build()
+    bot_application.add_handler(CommandHandler("start", start))
+    return bot_application
+
+
 # Функция для запуска бота
 async def main() -> None:
-    application = Application.builder().token(TELEGRAM_API_TOKEN).build()
+    global application
+    application = build_application()
+
+    if TELEGRAM_MODE == "webhook":
+        # Обновления приходят на POST /telegram/webhook; обработка — в update_dispatcher
+        await application.initialize()
+        await application.start()
+        await application.bot.set_webhook(
+            url=TELEGRAM_WEBHOOK_URL,
+            secret_token=TELEGRAM_WEBHOOK_SECRET,
+            max_connections=TELEGRAM_WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        update_dispatcher.start(application)
+        logger.info("Telegram бот работает в режиме webhook: %s", TELEGRAM_WEBHOOK_URL)
+        return
+
+    # Режим polling — для разработки
+    await application.run_polling()
 
-    application.add_handler(CommandHandler("start", start))
 
-    # Запуск Telegram бота
-    await application.run_polling()
+async def stop() -> None:
+    """Останавливает бота в режиме webhook, дождавшись принятых обновлений"""
+    if application is None or TELEGRAM_MODE != "webhook":
+        return
+    await update_dispatcher.stop()
+    await application.stop()
+    await application.shutdown()
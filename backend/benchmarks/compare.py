@@ -0,0 +1,52 @@
+"""
+Сравнение двух прогонов бенчмарков.
+Код выхода 1, если p95 вырос больше порога или выросло число SQL-запросов на операцию.
+
+    python -m benchmarks.compare baseline.json candidate.json --threshold 10
+"""
+import argparse
+import json
+import sys
+
+
+def load(path: str) -> dict:
+    with open(path, encoding="utf-8") as file:
+        results = json.load(file)["results"]
+    return {(result["name"], json.dumps(result["params"], sort_keys=True)): result for result in results}
+
+
+def change(old: float, new: float) -> float:
+    return (new - old) / old * 100 if old else 0.0
+
+
+def compare(baseline: dict, candidate: dict, threshold: float) -> bool:
+    regressed = False
+    print(f"{'сценарий':<50} {'p50':>10} {'p95':>10} {'p99':>10} {'запросов/оп':>14}")
+    for key, new in candidate.items():
+        old = baseline.get(key)
+        title = f"{key[0]} {key[1]}"
+        if old is None:
+            print(f"{title:<50} (нет в базовом прогоне)")
+            continue
+
+        p95_change = change(old["p95_ms"], new["p95_ms"])
+        queries_grew = new["queries_per_op"] > old["queries_per_op"]
+        marker = ""
+        if p95_change > threshold or queries_grew:
+            regressed = True
+            marker = "  <-- РЕГРЕССИЯ"
+        print(
+            f"{title:<50} {change(old['p50_ms'], new['p50_ms']):>+9.1f}% {p95_change:>+9.1f}% "
+            f"{change(old['p99_ms'], new['p99_ms']):>+9.1f}% "
+            f"{old['queries_per_op']:>6} -> {new['queries_per_op']:<6}{marker}"
+        )
+    return regressed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Сравнение результатов бенчмарков")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=10.0, help="Допустимый рост p95, %%")
+    args = parser.parse_args()
+    sys.exit(1 if compare(load(args.baseline), load(args.candidate), args.threshold) else 0)
@@ -0,0 +1,121 @@
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import insert, text
+from app.database import AsyncSessionLocal, engine
+from app.models.models import Base, Balance, Referrals, Signal, SignalInvestment, User
+from app.services.referrals import backfill_referral_closure
+from app.services.schema import ensure_schema
+
+# Пачка строк на один multi-row INSERT
+SEED_CHUNK = 5000
+
+# Пользователи бенчмарка получают id == telegram_id: реферер записывается одним значением
+# и в referrer_id (telegram_id), и в referred_by (users.id)
+SEQUENCES = ("users", "balances", "referrals", "signals", "signal_investments", "transactions")
+
+
+async def reset_database():
+    """Создает схему и очищает все таблицы. Только для отдельной базы бенчмарков!"""
+    await ensure_schema()
+    tables = ", ".join(table.name for table in Base.metadata.sorted_tables)
+    async with engine.begin() as conn:
+        await conn.execute(text(f"TRUNCATE {tables} RESTART IDENTITY CASCADE"))
+
+
+async def _insert_chunked(model, rows: list):
+    async with AsyncSessionLocal() as db:
+        for start in range(0, len(rows), SEED_CHUNK):
+            await db.execute(insert(model), rows[start:start + SEED_CHUNK])
+        await db.commit()
+
+
+async def _sync_sequences():
+    async with engine.begin() as conn:
+        for table in SEQUENCES:
+            await conn.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), COALESCE((SELECT MAX(id) FROM {table}), 0) + 1, false)"
+            ))
+
+
+async def seed_users(first_id: int, count: int, balance: float = 1000.0, trade_balance: float = 1000.0,
+                     parents: dict = None) -> list:
+    """
+    Создает пользователей first_id .. first_id + count - 1 с балансами и записями referrals.
+    parents — {telegram_id: telegram_id реферера}.
+    """
+    parents = parents or {}
+    ids = list(range(first_id, first_id + count))
+    await _insert_chunked(User, [
+        {"id": user_id, "telegram_id": user_id, "username": f"bench{user_id}", "first_name": f"Bench {user_id}"}
+        for user_id in ids
+    ])
+    await _insert_chunked(Balance, [
+        {"user_id": user_id, "balance": balance, "trade_balance": trade_balance, "frozen_balance": 0.0,
+         "earned_balance": 0.0}
+        for user_id in ids
+    ])
+    await _insert_chunked(Referrals, [
+        {"user_id": user_id, "telegram_id": user_id, "referral_link": f"https://app.com/ref/bench{user_id}",
+         "invited_count": 0, "referrer_id": parents.get(user_id), "referred_by": parents.get(user_id)}
+        for user_id in ids
+    ])
+    await _sync_sequences()
+    return ids
+
+
+async def seed_referral_tree(root_id: int, depth: int, fanout: int) -> int:
+    """
+    Дерево рефералов под root_id: depth уровней по fanout детей у каждого узла
+    (fanout=1 — цепочка). Возвращает количество созданных потомков.
+    """
+    parents, level, next_id = {}, [root_id], root_id + 1
+    for _ in range(depth):
+        children = []
+        for parent in level:
+            for _ in range(fanout):
+                parents[next_id] = parent
+                children.append(next_id)
+                next_id += 1
+        level = children
+
+    await seed_users(root_id, 1)
+    await seed_users(root_id + 1, next_id - root_id - 1, parents=parents)
+    async with AsyncSessionLocal() as db:
+        await db.execute(text("TRUNCATE referral_closure"))
+        await backfill_referral_closure(db)
+    return next_id - root_id - 1
+
+
+async def seed_signal(joinable: bool = True, expired: bool = False, burn_chance: float = 0.3,
+                      profit_percent: float = 1.05) -> int:
+    now = datetime.now(timezone.utc)
+    if expired:
+        join_until, expires_at = now - timedelta(hours=2), now - timedelta(hours=1)
+    elif joinable:
+        join_until, expires_at = now + timedelta(hours=1), now + timedelta(hours=2)
+    else:
+        join_until, expires_at = now - timedelta(minutes=1), now + timedelta(hours=1)
+
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(insert(Signal).returning(Signal.id), [{
+            "name": "bench", "join_until": join_until, "expires_at": expires_at,
+            "burn_chance": burn_chance, "profit_percent": profit_percent,
+        }])
+        signal_id = result.scalar()
+        await db.commit()
+    return signal_id
+
+
+async def seed_investments(signal_id: int, user_ids: list, count: int, amount: float = 10.0):
+    """count инвестиций в сигнал по кругу пользователей; средства сразу заморожены"""
+    rows = [{"signal_id": signal_id, "user_id": user_ids[index % len(user_ids)], "amount": amount}
+            for index in range(count)]
+    await _insert_chunked(SignalInvestment, rows)
+
+    async with engine.begin() as conn:
+        await conn.execute(text("""
+            UPDATE balances AS b
+            SET frozen_balance = b.frozen_balance + s.total
+            FROM (SELECT user_id, SUM(amount) AS total FROM signal_investments
+                  WHERE signal_id = :signal_id GROUP BY user_id) AS s
+            WHERE b.user_id = s.user_id
+        """), {"signal_id": signal_id})
@@ -0,0 +1,101 @@
+import asyncio
+import json
+import os
+import platform
+import statistics
+import time
+from datetime import datetime, timezone
+from app.services.metrics import QueryStats, current_query_stats
+
+
+def percentile(samples: list, pct: float) -> float:
+    """Перцентиль по методу ближайшего ранга"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(int(round(pct / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+class Measurement:
+    """Задержки и количество SQL-запросов по операциям одного сценария"""
+
+    def __init__(self, name: str, params: dict = None):
+        self.name = name
+        self.params = params or {}
+        self.latencies = []
+        self.queries = []
+        self.errors = 0
+        self.wall_seconds = 0.0
+
+    async def measure(self, operation):
+        """Выполняет одну операцию, замеряя время и SQL-запросы (учет через события движка)"""
+        stats = QueryStats()
+        token = current_query_stats.set(stats)
+        started = time.perf_counter()
+        try:
+            result = await operation()
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self.latencies.append(time.perf_counter() - started)
+            self.queries.append(stats.count)
+            current_query_stats.reset(token)
+        return result
+
+    async def run_concurrent(self, operation_factory, total: int, concurrency: int):
+        """Выполняет total операций, не больше concurrency одновременно"""
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one(index: int):
+            async with semaphore:
+                try:
+                    await self.measure(lambda: operation_factory(index))
+                except Exception:
+                    pass
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(index) for index in range(total)))
+        self.wall_seconds += time.perf_counter() - started
+
+    def summary(self) -> dict:
+        ms = [latency * 1000 for latency in self.latencies]
+        operations = len(self.latencies)
+        return {
+            "name": self.name,
+            "params": self.params,
+            "operations": operations,
+            "errors": self.errors,
+            "p50_ms": round(percentile(ms, 50), 3),
+            "p95_ms": round(percentile(ms, 95), 3),
+            "p99_ms": round(percentile(ms, 99), 3),
+            "mean_ms": round(statistics.fmean(ms), 3) if ms else 0.0,
+            "queries_per_op": round(statistics.fmean(self.queries), 2) if self.queries else 0.0,
+            "throughput_ops": round(operations / self.wall_seconds, 2) if self.wall_seconds else None,
+        }
+
+
+def print_summary(summary: dict):
+    params = ", ".join(f"{key}={value}" for key, value in summary["params"].items())
+    throughput = f", {summary['throughput_ops']} оп/с" if summary["throughput_ops"] else ""
+    print(
+        f"{summary['name']:<28} [{params}] n={summary['operations']} err={summary['errors']} "
+        f"p50={summary['p50_ms']} мс p95={summary['p95_ms']} мс p99={summary['p99_ms']} мс "
+        f"запросов/оп={summary['queries_per_op']}{throughput}"
+    )
+
+
+def save_results(results: list, output_dir: str) -> str:
+    """Сохраняет результаты прогона в JSON для сравнения с другими прогонами"""
+    os.makedirs(output_dir, exist_ok=True)
+    started_at = datetime.now(timezone.utc)
+    path = os.path.join(output_dir, f"bench-{started_at.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump({
+            "started_at": started_at.isoformat(),
+            "python": platform.python_version(),
+            "host": platform.node(),
+            "results": results,
+        }, file, ensure_ascii=False, indent=2)
+    return path
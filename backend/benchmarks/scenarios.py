@@ -0,0 +1,184 @@
+from types import SimpleNamespace
+import httpx
+from fastapi import FastAPI
+from app.database import AsyncSessionLocal
+from app.routers import balances, general_routes, signals_routes, users
+from app.services.balance_cache import balance_cache
+from app.services.signal_cache import active_signals_cache
+from app.services.signals import process_signals
+from benchmarks import fixtures
+from benchmarks.harness import Measurement
+
+# Диапазоны id, чтобы данные сценариев не пересекались
+JOIN_USERS_FROM = 1_000_000
+READ_USERS_FROM = 2_000_000
+TREE_ROOT_DEEP = 3_000_000
+TREE_ROOT_WIDE = 4_000_000
+SETTLE_USERS_FROM = 5_000_000
+START_USERS_FROM = 6_000_000
+
+
+def build_app() -> FastAPI:
+    """Приложение с роутерами API, но без запуска бота и фоновых задач из main.py"""
+    app = FastAPI()
+    app.include_router(users.router)
+    app.include_router(balances.router)
+    app.include_router(signals_routes.signalis_router)
+    app.include_router(general_routes.router)
+    return app
+
+
+def client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=build_app()), base_url="http://bench")
+
+
+async def _checked(response: httpx.Response) -> httpx.Response:
+    if response.status_code >= 400:
+        raise RuntimeError(f"{response.request.url}: {response.status_code} {response.text[:200]}")
+    return response
+
+
+async def _checked_post(http: httpx.AsyncClient, url: str, payload: dict):
+    return await _checked(await http.post(url, json=payload))
+
+
+async def _checked_get(http: httpx.AsyncClient, url: str):
+    return await _checked(await http.get(url))
+
+
+async def bench_join_signal(total: int, concurrency: int) -> list:
+    """Вход в сигнал разными пользователями при заданной конкурентности"""
+    await fixtures.reset_database()
+    user_ids = await fixtures.seed_users(JOIN_USERS_FROM, total)
+    signal_id = await fixtures.seed_signal(joinable=True)
+
+    measurement = Measurement("join_signal", {"requests": total, "concurrency": concurrency})
+    async with client() as http:
+        await measurement.run_concurrent(
+            lambda index: _checked_post(http, "/signals/join", {
+                "telegram_id": user_ids[index], "signal_id": signal_id, "amount": 10.0,
+            }),
+            total, concurrency,
+        )
+    return [measurement.summary()]
+
+
+async def bench_process_signals(sizes: list, repeat: int) -> list:
+    """Расчет одного истекшего сигнала с разным количеством инвестиций"""
+    results = []
+    for size in sizes:
+        measurement = Measurement("process_signals", {"investments": size})
+        for _ in range(repeat):
+            await fixtures.reset_database()
+            user_ids = await fixtures.seed_users(SETTLE_USERS_FROM, min(size, 5000))
+            signal_id = await fixtures.seed_signal(expired=True)
+            await fixtures.seed_investments(signal_id, user_ids, size)
+
+            async def settle():
+                async with AsyncSessionLocal() as db:
+                    return await process_signals(db)
+
+            await measurement.measure(settle)
+        results.append(measurement.summary())
+    return results
+
+
+async def bench_referral_tree(repeat: int) -> list:
+    """Дерево рефералов: глубокая цепочка и широкое дерево"""
+    await fixtures.reset_database()
+    deep = await fixtures.seed_referral_tree(TREE_ROOT_DEEP, depth=50, fanout=1)
+    wide = await fixtures.seed_referral_tree(TREE_ROOT_WIDE, depth=2, fanout=200)
+
+    results = []
+    async with client() as http:
+        for name, root, nodes, max_depth in (("deep", TREE_ROOT_DEEP, deep, 50), ("wide", TREE_ROOT_WIDE, wide, 2)):
+            measurement = Measurement("referral_tree", {"shape": name, "nodes": nodes})
+            for _ in range(repeat):
+                await measurement.measure(
+                    lambda: _checked_get(http, f"/referral_tree/{root}?max_depth={max_depth}&max_fanout=1000")
+                )
+            results.append(measurement.summary())
+    return results
+
+
+async def bench_reads(total: int, concurrency: int) -> list:
+    """Задержка чтения /signals/active и /balance: с прогретым кэшем и без него"""
+    await fixtures.reset_database()
+    user_ids = await fixtures.seed_users(READ_USERS_FROM, min(total, 10000))
+    for _ in range(10):
+        await fixtures.seed_signal(joinable=True)
+
+    results = []
+    async with client() as http:
+        for cache in ("warm", "cold"):
+            def reset_caches():
+                if cache == "cold":
+                    active_signals_cache.invalidate()
+                    balance_cache.clear()
+
+            active = Measurement("signals_active", {"cache": cache, "concurrency": concurrency})
+
+            async def get_active(index):
+                reset_caches()
+                return await _checked_get(http, "/signals/active")
+
+            await active.run_concurrent(get_active, total, concurrency)
+
+            balance = Measurement("balance", {"cache": cache, "concurrency": concurrency})
+
+            async def get_balance(index):
+                reset_caches()
+                return await _checked_get(http, f"/balance/{user_ids[index % len(user_ids)]}")
+
+            await balance.run_concurrent(get_balance, total, concurrency)
+            results.extend([active.summary(), balance.summary()])
+    return results
+
+
+# Ответы обработчика /start, которыми он сообщает об ошибке вместо исключения
+BOT_ERROR_REPLIES = ("Ошибка", "Произошла ошибка")
+
+
+class FakeMessage:
+    """Сообщение Telegram, ответы которого складываются в список вместо отправки"""
+
+    def __init__(self):
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+def fake_start_update(telegram_id: int, args: list = None):
+    """Минимальные Update и CallbackContext для обработчика /start"""
+    user = SimpleNamespace(
+        id=telegram_id, username=f"bench{telegram_id}", first_name=f"Bench {telegram_id}", last_name="",
+        language_code="ru", photo_url=None, is_bot=False,
+    )
+    update = SimpleNamespace(
+        effective_user=user, effective_chat=SimpleNamespace(id=telegram_id), message=FakeMessage(),
+    )
+    return update, SimpleNamespace(args=args or [])
+
+
+async def bench_bot_start(total: int, concurrency: int) -> list:
+    """Обработка /start: новые пользователи и повторный /start уже зарегистрированных"""
+    from app.telegram_bot import start
+
+    await fixtures.reset_database()
+    results = []
+    for kind in ("new", "returning"):
+        measurement = Measurement("bot_start", {"users": kind, "concurrency": concurrency})
+
+        async def handle(index):
+            update, context = fake_start_update(START_USERS_FROM + index)
+            await start(update, context)
+            # Обработчик перехватывает свои ошибки и отвечает текстом — такой /start не считается успешным
+            failed = [reply for reply in update.message.replies if reply.startswith(BOT_ERROR_REPLIES)]
+            if failed:
+                raise RuntimeError(f"/start {START_USERS_FROM + index}: {failed[0]}")
+            return update.message.replies
+
+        await measurement.run_concurrent(handle, total, concurrency)
+        results.append(measurement.summary())
+    return results
@@ -0,0 +1,257 @@
+"""
+Синтетические данные для нагрузочного тестирования: пользователи с балансами, цепочки рефералов,
+сигналы, инвестиции и журнал транзакций. Строки загружаются через COPY пачками,
+id задаются явно, затем последовательности сдвигаются за последний id.
+
+Запуск из каталога backend (база из DATABASE_URL, данные добавляются к существующим):
+
+    python -m scripts.seed_data --users 1000000 --signals 5000 --investments 5000000 --transactions 5000000
+    python -m scripts.seed_data --users 100000 --referral-window 50 --max-referral-depth 30 --hot-signal-skew 1.3
+
+Сгенерированным пользователям telegram_id совпадает с id, поэтому реферер записывается одним значением
+и в referrals.referrer_id (telegram_id), и в referrals.referred_by (users.id).
+"""
+import argparse
+import asyncio
+import bisect
+import itertools
+import logging
+import os
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+# Логирование
+logger = logging.getLogger("seed_data")
+
+TRANSACTION_TYPES = ("balance_update", "trade_balance_update", "freeze", "unfreeze", "deposit", "referral_bonus")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Массовая генерация синтетических данных")
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--signals", type=int, default=1000)
+    parser.add_argument("--investments", type=int, default=1000000)
+    parser.add_argument("--transactions", type=int, default=1000000)
+    parser.add_argument("--referral-share", type=float, default=0.7, help="Доля пользователей с реферером")
+    parser.add_argument("--referral-window", type=int, default=1000,
+                        help="Реферер выбирается среди N предыдущих пользователей: меньше N — глубже цепочки")
+    parser.add_argument("--max-referral-depth", type=int, default=20, help="Ограничение глубины цепочки")
+    parser.add_argument("--hot-signal-skew", type=float, default=1.1,
+                        help="Показатель Ципфа для выбора сигнала инвестицией (0 — равномерно)")
+    parser.add_argument("--settled-share", type=float, default=0.9, help="Доля уже рассчитанных сигналов")
+    parser.add_argument("--history-days", type=int, default=180, help="Глубина истории created_at")
+    parser.add_argument("--batch", type=int, default=50000, help="Строк на один COPY")
+    parser.add_argument("--seed", type=int, default=42, help="Зерно генератора для воспроизводимости")
+    return parser.parse_args()
+
+
+class Seeder:
+    def __init__(self, conn, args):
+        from app.services.signals import current_moscow_time
+
+        self.conn = conn
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.now = datetime.now(timezone.utc)
+        # join_until/expires_at приложение хранит и сравнивает по шкале current_moscow_time()
+        self.signal_now = current_moscow_time()
+        self.signal_offset = self.signal_now - self.now
+
+    def _past(self) -> datetime:
+        return self.now - timedelta(seconds=self.random.uniform(0, self.args.history_days * 86400))
+
+    async def _next_id(self, table: str) -> int:
+        return await self.conn.fetchval(f"SELECT COALESCE(MAX(id), 0) + 1 FROM {table}")
+
+    async def _copy(self, table: str, columns: tuple, rows) -> int:
+        """Загружает строки генератора через COPY пачками по --batch"""
+        total = 0
+        started = time.perf_counter()
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, self.args.batch))
+            if not chunk:
+                break
+            await self.conn.copy_records_to_table(table, records=chunk, columns=columns)
+            total += len(chunk)
+        logger.info("%s: %s строк за %.1f с", table, total, time.perf_counter() - started)
+        return total
+
+    async def _sync_sequence(self, table: str):
+        await self.conn.execute(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), COALESCE((SELECT MAX(id) FROM {table}), 0) + 1, false)"
+        )
+
+    # --- Пользователи, балансы, рефералы ---
+
+    def _build_referral_parents(self, count: int) -> list:
+        """parents[i] — индекс реферера i-го пользователя или -1; глубина ограничена --max-referral-depth"""
+        args = self.args
+        parents, depths = [-1] * count, [0] * count
+        for index in range(1, count):
+            if self.random.random() >= args.referral_share:
+                continue
+            parent = index - self.random.randint(1, min(args.referral_window, index))
+            if depths[parent] >= args.max_referral_depth:
+                continue
+            parents[index] = parent
+            depths[index] = depths[parent] + 1
+        return parents
+
+    async def seed_users(self) -> list:
+        count = self.args.users
+        first_id = await self._next_id("users")
+        taken = await self.conn.fetchval(
+            "SELECT EXISTS (SELECT 1 FROM users WHERE telegram_id BETWEEN $1 AND $2)", first_id, first_id + count
+        )
+        if taken:
+            raise SystemExit(f"telegram_id {first_id}..{first_id + count} уже заняты — сгенерированные id пересекутся")
+
+        parents = self._build_referral_parents(count)
+        user_ids = range(first_id, first_id + count)
+
+        await self._copy("users", ("id", "telegram_id", "username", "first_name", "last_name", "language_code",
+                                   "is_bot", "photo_url", "created_at", "updated_at"), (
+            (user_id, user_id, f"user{user_id}", f"User {user_id}", "", self.random.choice(("ru", "en", "uk")),
+             False, "", self._past(), self.now)
+            for user_id in user_ids
+        ))
+
+        first_balance = await self._next_id("balances")
+        await self._copy("balances", ("id", "user_id", "balance", "trade_balance", "frozen_balance",
+                                      "earned_balance", "version"), (
+            (first_balance + index, user_id, round(self.random.lognormvariate(4.5, 1.2), 2),
+             round(self.random.lognormvariate(3.5, 1.2), 2), 0.0, round(self.random.expovariate(0.05), 2), 0)
+            for index, user_id in enumerate(user_ids)
+        ))
+
+        invited = [0] * count
+        for parent in parents:
+            if parent >= 0:
+                invited[parent] += 1
+
+        first_referral = await self._next_id("referrals")
+        await self._copy("referrals", ("id", "user_id", "telegram_id", "referral_link", "invited_count",
+                                       "referrer_id", "referred_by"), (
+            (first_referral + index, user_id, user_id, f"https://app.com/ref/{user_id}", invited[index],
+             first_id + parents[index] if parents[index] >= 0 else None,
+             first_id + parents[index] if parents[index] >= 0 else None)
+            for index, user_id in enumerate(user_ids)
+        ))
+
+        await self._copy("referral_closure", ("ancestor_id", "descendant_id", "depth"),
+                         self._closure_rows(first_id, parents))
+
+        for table in ("users", "balances", "referrals"):
+            await self._sync_sequence(table)
+        return list(user_ids)
+
+    @staticmethod
+    def _closure_rows(first_id: int, parents: list):
+        """Строки таблицы замыкания: сам пользователь и все его предки"""
+        for index in range(len(parents)):
+            descendant = first_id + index
+            yield descendant, descendant, 0
+            ancestor, depth = parents[index], 1
+            while ancestor >= 0:
+                yield first_id + ancestor, descendant, depth
+                ancestor, depth = parents[ancestor], depth + 1
+
+    # --- Сигналы и инвестиции ---
+
+    async def seed_signals(self) -> list:
+        first_id = await self._next_id("signals")
+        signals = []
+        for index in range(self.args.signals):
+            settled = self.random.random() < self.args.settled_share
+            join_until = self._past() + self.signal_offset if settled \
+                else self.signal_now + timedelta(minutes=self.random.randint(1, 120))
+            expires_at = join_until + timedelta(minutes=self.random.randint(5, 60))
+            burn_chance = round(self.random.uniform(0.1, 0.8), 2)
+            is_successful = (self.random.random() > burn_chance) if settled else None
+            signals.append((first_id + index, f"Сигнал {first_id + index}", join_until, expires_at, is_successful,
+                            burn_chance, round(self.random.uniform(0.01, 0.1), 3)))
+
+        await self._copy("signals", ("id", "name", "join_until", "expires_at", "is_successful", "burn_chance",
+                                     "profit_percent"), signals)
+        await self._sync_sequence("signals")
+        return signals
+
+    def _signal_picker(self, signals: list):
+        """Выбор сигнала с перекосом по Ципфу: первые сигналы получают основную массу инвестиций"""
+        skew = self.args.hot_signal_skew
+        cumulative = list(itertools.accumulate(1 / (rank ** skew) for rank in range(1, len(signals) + 1)))
+        total = cumulative[-1]
+        return lambda: signals[bisect.bisect_left(cumulative, self.random.random() * total)]
+
+    async def seed_investments(self, signals: list, user_ids: list):
+        if not signals or not user_ids:
+            return
+        first_id = await self._next_id("signal_investments")
+        pick_signal = self._signal_picker(signals)
+
+        def rows():
+            for index in range(self.args.investments):
+                signal_id, _, join_until, _, is_successful, _, profit_rate = pick_signal()
+                amount = round(self.random.uniform(1, 500), 2)
+                profit = None if is_successful is None else (amount * profit_rate if is_successful else -amount)
+                # created_at — обычное UTC, дедлайн сигнала переводим обратно со шкалы signal_now
+                created_at = min(join_until - self.signal_offset, self.now) - timedelta(seconds=self.random.randint(0, 3600))
+                yield first_id + index, signal_id, self.random.choice(user_ids), amount, profit, created_at
+
+        await self._copy("signal_investments", ("id", "signal_id", "user_id", "amount", "profit", "created_at"), rows())
+        await self._sync_sequence("signal_investments")
+
+        # Средства в нерассчитанных сигналах заморожены
+        await self.conn.execute("""
+            UPDATE balances AS b
+            SET frozen_balance = b.frozen_balance + s.total
+            FROM (
+                SELECT si.user_id, SUM(si.amount) AS total
+                FROM signal_investments AS si JOIN signals AS sg ON sg.id = si.signal_id
+                WHERE sg.is_successful IS NULL AND si.id >= $1
+                GROUP BY si.user_id
+            ) AS s
+            WHERE b.user_id = s.user_id
+        """, first_id)
+
+    async def seed_transactions(self, user_ids: list):
+        if not user_ids:
+            return
+        first_id = await self._next_id("transactions")
+        await self._copy("transactions", ("id", "user_id", "amount", "transaction_type", "created_at"), (
+            (first_id + index, self.random.choice(user_ids), round(self.random.uniform(-500, 500), 2),
+             self.random.choice(TRANSACTION_TYPES), self._past())
+            for index in range(self.args.transactions)
+        ))
+        await self._sync_sequence("transactions")
+
+
+async def main(args):
+    import asyncpg
+    from app.database import DATABASE_URL, engine
+    from app.services.schema import ensure_schema
+
+    await ensure_schema()
+    await engine.dispose()
+    conn = await asyncpg.connect(DATABASE_URL.replace("postgresql+asyncpg://", "postgresql://", 1))
+    started = time.perf_counter()
+    try:
+        seeder = Seeder(conn, args)
+        user_ids = await seeder.seed_users()
+        signals = await seeder.seed_signals()
+        await seeder.seed_investments(signals, user_ids)
+        await seeder.seed_transactions(user_ids)
+        await conn.execute("ANALYZE")
+    finally:
+        await conn.close()
+    logger.info("Генерация завершена за %.1f с", time.perf_counter() - started)
+
+
+if __name__ == "__main__":
+    os.environ.setdefault("LOG_LEVEL", "INFO")
+    from app.logging_config import setup_logging
+
+    setup_logging()
+    asyncio.run(main(parse_args()))